@@ -1,8 +1,15 @@
 # File: INKWISPS_post.py
+import io
 import os
+import re
 import time
 import json
+import base64
+import asyncio
 import logging
+import threading
+import contextvars
+from concurrent.futures import Future
 import requests
 import dropbox
 from telegram import Bot
@@ -10,12 +17,1511 @@ from datetime import datetime, timedelta
 from pytz import timezone, utc
 from moviepy.editor import VideoFileClip
 import random
+import uuid
+import heapq
+import math
+import mmap
+import shutil
+import tempfile
+from urllib.parse import urlparse, parse_qs
+
+
+LOG_SUBSYSTEMS = ("graph", "dropbox", "telegram", "media")
+
+# Secrets that must never reach the logs
+REDACTION_PATTERNS = (
+    (re.compile(r"((?:access_token|input_token|fb_exchange_token|client_secret|refresh_token)=)[^&\s\"']+"), r"\1[REDACTED]"),
+    (re.compile(r"(\"(?:access_token|refresh_token|client_secret)\":\s*\")[^\"]+"), r"\1[REDACTED]"),
+    (re.compile(r"\bEAA[A-Za-z0-9]{16,}"), "[REDACTED]"),
+    (re.compile(r"\bsl\.[A-Za-z0-9_\-]{16,}"), "[REDACTED]"),
+    (re.compile(r"bot\d+:[A-Za-z0-9_\-]{16,}"), "bot[REDACTED]"),
+    (re.compile(r"((?:OAuth|Bearer) )[A-Za-z0-9._\-]+"), r"\1[REDACTED]"),
+)
+
+
+def redact(text):
+    """Mask access tokens and secrets in a log line."""
+    for pattern, replacement in REDACTION_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class RedactingFormatter(logging.Formatter):
+    """Human-readable formatter that prefixes the script name and redacts tokens."""
+
+    def formatMessage(self, record):
+        if getattr(record, "script", None):
+            record = logging.makeLogRecord({**record.__dict__, "message": f"[{record.script}]\n{record.message}"})
+        return super().formatMessage(record)
+
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line with redacted message and any ``extra`` fields."""
+
+    STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record):
+        payload = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.STANDARD_ATTRS:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def configure_logging():
+    """Set up the root handler and per-subsystem levels from the environment.
+
+    LOG_FORMAT: "json" (default) or "text"; LOG_LEVEL: root level (INFO);
+    LOG_LEVELS: per-subsystem overrides, e.g. "graph=DEBUG,dropbox=WARNING".
+    Full Graph payloads are only dumped when the graph subsystem is at DEBUG.
+    """
+    handler = logging.StreamHandler()
+    if (os.getenv("LOG_FORMAT") or "json").lower() == "text":
+        handler.setFormatter(RedactingFormatter("%(asctime)s - %(levelname)s - %(message)s"))
+    else:
+        handler.setFormatter(JsonLogFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel((os.getenv("LOG_LEVEL") or "INFO").upper())
+    # Third-party HTTP clients log every request URL (tokens included) at INFO
+    for noisy in ("httpx", "urllib3"):
+        logging.getLogger(noisy).setLevel(logging.WARNING)
+    for spec in filter(None, (os.getenv("LOG_LEVELS") or "").split(",")):
+        name, _, level = spec.partition("=")
+        logging.getLogger(f"inkwisps.{name.strip()}").setLevel(level.strip().upper())
+
+
+# Per-attempt state (the classified failure) so concurrent async posts don't overwrite each other
+_attempt_state = contextvars.ContextVar("attempt_state")
+
+
+def hamming_distance(a, b):
+    """Number of differing bits between two integer hashes."""
+    return (a ^ b).bit_count()
+
+
+def _bits_to_int(bits):
+    """Pack a flat boolean NumPy array into a single integer hash."""
+    value = 0
+    for bit in bits.tolist():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def compute_dhash(gray, hash_size=8):
+    """Difference hash of a grayscale PIL image (hash_size**2 bits)."""
+    import numpy as np
+    from PIL import Image
+    pixels = np.asarray(gray.resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.float32)
+    return _bits_to_int((pixels[:, 1:] > pixels[:, :-1]).ravel())
+
+
+_DCT_MATRICES = {}
+
+
+def compute_phash(gray, hash_size=8, highfreq_factor=4):
+    """DCT-based perceptual hash of a grayscale PIL image (hash_size**2 bits)."""
+    import numpy as np
+    from PIL import Image
+    size = hash_size * highfreq_factor
+    pixels = np.asarray(gray.resize((size, size), Image.LANCZOS), dtype=np.float64)
+    dct = _DCT_MATRICES.get(size)
+    if dct is None:
+        n = np.arange(size)
+        dct = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+        _DCT_MATRICES[size] = dct
+    low = (dct @ pixels @ dct.T)[:hash_size, :hash_size]
+    return _bits_to_int((low > np.median(low)).ravel())
+
+
+def transcode_to_reel_spec(src_path, dst_path, fit="pad", max_bitrate_kbps=5000, crf=23, gop=60, height=1920):
+    """Normalize a video to 9:16 H.264/AAC at 30fps with fast-start and a capped bitrate.
+
+    ``crf``, ``gop`` (frames between keyframes) and ``height`` come from the
+    encode profile. Runs in a worker process; returns the output's properties.
+    """
+    import subprocess
+    from moviepy.config import get_setting
+    from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+    size = f"{height * 9 // 16}:{height}"
+    if fit == "crop":
+        video_filter = f"scale={size}:force_original_aspect_ratio=increase,crop={size},setsar=1"
+    else:
+        video_filter = f"scale={size}:force_original_aspect_ratio=decrease,pad={size}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+    cmd = [
+        get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error", "-i", src_path,
+        "-vf", video_filter,
+        "-c:v", "libx264", "-preset", "veryfast", "-profile:v", "high", "-pix_fmt", "yuv420p",
+        "-crf", str(crf), "-maxrate", f"{max_bitrate_kbps}k", "-bufsize", f"{max_bitrate_kbps * 2}k",
+        "-r", "30", "-g", str(gop),
+        "-c:a", "aac", "-b:a", "128k", "-ar", "48000", "-ac", "2",
+        "-movflags", "+faststart",
+        dst_path,
+    ]
+    subprocess.run(cmd, check=True, capture_output=True)
+    infos = ffmpeg_parse_infos(dst_path)
+    width, height = infos["video_size"]
+    duration = infos["duration"]
+    return {"width": width, "height": height, "duration": duration,
+            "bitrate_kbps": round(os.path.getsize(dst_path) * 8 / 1000 / duration) if duration else None,
+            "keyframe_interval": gop / 30}
+
+
+def probe_keyframe_interval(path, duration):
+    """Average seconds between keyframes of a local video (only keyframes are decoded); None if unknown."""
+    import subprocess
+    from moviepy.config import get_setting
+    cmd = [get_setting("FFMPEG_BINARY"), "-hide_banner", "-nostats", "-skip_frame", "nokey", "-i", path,
+           "-map", "0:v:0", "-vf", "showinfo", "-f", "null", "-"]
+    res = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+    keyframes = res.stderr.count("iskey:1")
+    return round(duration / keyframes, 2) if keyframes and duration else None
+
+
+def optimize_image_for_instagram(path, fit="crop", max_width=1440, quality=85):
+    """Re-encode an image file as a metadata-free progressive JPEG within IG's size and aspect limits.
+
+    Runs in a worker process, which maps the cached file itself rather than
+    receiving its bytes; returns (jpeg_bytes, width, height).
+    """
+    from io import BytesIO
+    from PIL import Image, ImageOps
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        img = Image.open(mm)
+        img.load()
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    width, height = img.size
+    aspect_ratio = width / height
+    target = min(max(aspect_ratio, 0.8), 1.91)
+    if abs(target - aspect_ratio) > 0.001:
+        if fit == "pad":
+            canvas_size = (round(height * target), height) if target > aspect_ratio else (width, round(width / target))
+            canvas = Image.new("RGB", canvas_size, (255, 255, 255))
+            canvas.paste(img, ((canvas_size[0] - width) // 2, (canvas_size[1] - height) // 2))
+            img = canvas
+        elif target > aspect_ratio:
+            new_height = round(width / target)
+            top = (height - new_height) // 2
+            img = img.crop((0, top, width, top + new_height))
+        else:
+            new_width = round(height * target)
+            left = (width - new_width) // 2
+            img = img.crop((left, 0, left + new_width, height))
+
+    if img.width > max_width:
+        img = img.resize((max_width, round(img.height * max_width / img.width)), Image.LANCZOS)
+
+    out = BytesIO()
+    img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue(), img.width, img.height
+
+
+def extract_keyframe_jpeg(video_url, offset_seconds):
+    """Grab the keyframe at/after ``offset_seconds`` as JPEG bytes.
+
+    Input-side ``-ss`` plus ``-skip_frame nokey`` makes ffmpeg seek via range
+    requests and decode a single keyframe instead of the whole stream.
+    """
+    import subprocess
+    from moviepy.config import get_setting
+    cmd = [
+        get_setting("FFMPEG_BINARY"), "-loglevel", "error",
+        "-skip_frame", "nokey", "-ss", f"{offset_seconds:.3f}", "-i", video_url,
+        "-frames:v", "1", "-q:v", "2", "-f", "image2", "-c:v", "mjpeg", "pipe:1",
+    ]
+    jpeg_bytes = subprocess.run(cmd, check=True, capture_output=True, timeout=60).stdout
+    if not jpeg_bytes:
+        raise ValueError(f"no keyframe at or after {offset_seconds:.1f}s")
+    return jpeg_bytes
+
+
+def score_cover_frame(jpeg_bytes):
+    """Score a frame by Laplacian sharpness, penalising very dark or blown-out frames."""
+    import numpy as np
+    from io import BytesIO
+    from PIL import Image
+    gray = Image.open(BytesIO(jpeg_bytes)).convert("L")
+    gray.thumbnail((256, 256))
+    pixels = np.asarray(gray, dtype=np.float32) / 255.0
+    laplacian = (pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1]
+                 - 4 * pixels[1:-1, 1:-1])
+    brightness = float(pixels.mean())
+    return float(laplacian.var()) * (1.0 - min(abs(brightness - 0.5) * 2, 1.0) ** 2)
+
+
+def mp4_has_faststart(head_bytes):
+    """Return True if the moov atom precedes mdat in the given leading bytes of an MP4."""
+    offset = 0
+    while offset + 8 <= len(head_bytes):
+        size = int.from_bytes(head_bytes[offset:offset + 4], "big")
+        box_type = head_bytes[offset + 4:offset + 8]
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if size == 1 and offset + 16 <= len(head_bytes):
+            size = int.from_bytes(head_bytes[offset + 8:offset + 16], "big")
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes for Hamming-radius lookups."""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = (key, value, {})
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(key, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (key, value, {})
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        """Return [(distance, value)] for every stored hash within max_distance."""
+        if self.root is None:
+            return []
+        matches = []
+        stack = [self.root]
+        while stack:
+            node_key, value, children = stack.pop()
+            distance = hamming_distance(key, node_key)
+            if distance <= max_distance:
+                matches.append((distance, value))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches, key=lambda m: m[0])
+
+
+class PriorityFileIndex:
+    """Per-media-type min-heaps of inbox files keyed by a time-invariant priority.
+
+    A file's priority at time t is ``log(weight) + age_rate * (t - added_at)``;
+    the ``age_rate * t`` term is shared by every file, so heaps are keyed by
+    ``age_rate * added_at - log(weight)`` and never need re-keying as files age.
+    Removed files are dropped lazily when they surface at the top of a heap.
+    """
+
+    def __init__(self, entries=None, heaps=None, cursor=None, weights_key=None):
+        self.entries = entries or {}
+        self.heaps = heaps or {}
+        self.cursor = cursor
+        self.weights_key = weights_key
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("entries"), data.get("heaps"), data.get("cursor"), data.get("weights_key"))
+
+    def to_dict(self):
+        return {"entries": self.entries, "heaps": self.heaps, "cursor": self.cursor, "weights_key": self.weights_key}
+
+    def add(self, path, media_type, key, added_at):
+        self.entries[path] = {"type": media_type, "key": key, "added_at": added_at}
+        heapq.heappush(self.heaps.setdefault(media_type, []), [key, path])
+
+    def remove(self, path):
+        self.entries.pop(path, None)
+
+    def rebuild(self, keys):
+        """Re-key every entry with ``keys[path]`` and heapify each media type in O(n)."""
+        self.heaps = {}
+        for path, entry in self.entries.items():
+            entry["key"] = keys[path]
+            self.heaps.setdefault(entry["type"], []).append([entry["key"], path])
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+
+    def top(self, media_type, count, eligible):
+        """Return up to ``count`` best eligible paths of a type without removing them."""
+        heap = self.heaps.get(media_type, [])
+        taken, skipped = [], []
+        while heap and len(taken) < count:
+            key, path = heapq.heappop(heap)
+            entry = self.entries.get(path)
+            if entry is None or entry["key"] != key:
+                continue  # stale: file left the inbox or was re-keyed
+            (taken if path in eligible else skipped).append([key, path])
+        for item in taken + skipped:
+            heapq.heappush(heap, item)
+        return [path for _, path in taken]
+
+
+class EncodeProfileTuner:
+    """Picks the Reels encode profile with the lowest expected Meta processing time.
+
+    Journal entries record the posted video's properties, the profile it was
+    encoded with ("original" = posted as-is) and how long the container took to
+    process. Each profile gets a least-squares model
+    ``seconds ≈ a + b·duration + c·megabits`` over its own history; profiles with
+    fewer than ``min_samples`` posts are tried with probability ``explore``.
+    """
+
+    # All within Reels spec: H.264 high, 9:16, 30fps, AAC, fast-start. "balanced" is the
+    # untuned default; its bitrate cap (None) is TRANSCODE_MAX_BITRATE_KBPS itself
+    PROFILES = {
+        "balanced": {"crf": 23, "max_bitrate_kbps": None, "gop": 60, "height": 1920},
+        "lean": {"crf": 26, "max_bitrate_kbps": 3500, "gop": 60, "height": 1920},
+        "short_gop": {"crf": 26, "max_bitrate_kbps": 3500, "gop": 30, "height": 1920},
+        "hd720": {"crf": 24, "max_bitrate_kbps": 2500, "gop": 60, "height": 1280},
+    }
+
+    def __init__(self, journal, max_bitrate_kbps=5000, min_samples=5, explore=0.2):
+        self.max_bitrate_kbps = max_bitrate_kbps
+        self.min_samples = min_samples
+        self.explore = explore
+        self.samples = {name: [] for name in ("original", *self.PROFILES)}
+        for entry in journal:
+            encode = entry.get("encode") or {}
+            if entry.get("processing_outcome") != "finished" or encode.get("profile") not in self.samples:
+                continue
+            if encode.get("duration") and encode.get("bitrate_kbps") and entry.get("processing_seconds") is not None:
+                megabits = encode["duration"] * encode["bitrate_kbps"] / 1000
+                self.samples[encode["profile"]].append((encode["duration"], megabits, entry["processing_seconds"]))
+
+    @classmethod
+    def profile(cls, name, max_bitrate_kbps):
+        """transcode_to_reel_spec settings of a profile, with the bitrate capped at ``max_bitrate_kbps``."""
+        settings = dict(cls.PROFILES[name])
+        settings["max_bitrate_kbps"] = min(settings["max_bitrate_kbps"] or max_bitrate_kbps, max_bitrate_kbps)
+        return settings
+
+    def predict(self, name, duration, bitrate_kbps):
+        """Expected processing seconds of posting the source with profile ``name``, or None without history."""
+        import numpy as np
+        samples = self.samples[name]
+        if len(samples) < self.min_samples:
+            return None
+        if name != "original":
+            bitrate_kbps = min(bitrate_kbps, self.profile(name, self.max_bitrate_kbps)["max_bitrate_kbps"])
+        X = np.array([[1.0, d, mb] for d, mb, _ in samples])
+        y = np.array([seconds for _, _, seconds in samples])
+        coef = np.linalg.lstsq(X, y, rcond=None)[0]
+        return max(0.0, float(coef @ [1.0, duration, duration * bitrate_kbps / 1000]))
+
+    def choose(self, duration, bitrate_kbps, allow_original):
+        """Return (profile name, reason); "original" is only allowed for already compliant sources."""
+        candidates = (["original"] if allow_original else []) + list(self.PROFILES)
+        untried = [name for name in candidates if len(self.samples[name]) < self.min_samples]
+        if untried and random.random() < self.explore:
+            name = min(untried, key=lambda n: len(self.samples[n]))
+            return name, f"exploring ({len(self.samples[name])} sample(s))"
+        expected = {name: self.predict(name, duration, bitrate_kbps) for name in candidates}
+        expected = {name: seconds for name, seconds in expected.items() if seconds is not None}
+        if not expected:
+            return ("original" if allow_original else "balanced"), "no processing history yet"
+        name = min(expected, key=expected.get)
+        return name, f"expected {expected[name]:.0f}s Meta processing"
+
+
+class MetricsRegistry:
+    """Thread-safe counters, gauges and histograms rendered in the Prometheus text format."""
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, prefix="inkwisps"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.types = {}
+        self.help = {}
+        self.values = {}      # (name, labels) -> float, for counters and gauges
+        self.histograms = {}  # (name, labels) -> [bucket_counts, sum, count]
+        self.buckets = {}
+
+    def _key(self, name, kind, doc, labels):
+        name = f"{self.prefix}_{name}"
+        self.types.setdefault(name, kind)
+        if doc:
+            self.help.setdefault(name, doc)
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, doc=None, **labels):
+        with self.lock:
+            key = self._key(name, "counter", doc, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, doc=None, **labels):
+        with self.lock:
+            self.values[self._key(name, "gauge", doc, labels)] = value
+
+    def observe(self, name, value, doc=None, buckets=None, **labels):
+        with self.lock:
+            key = self._key(name, "histogram", doc, labels)
+            bounds = self.buckets.setdefault(key[0], tuple(buckets or self.DEFAULT_BUCKETS))
+            hist = self.histograms.setdefault(key, [[0] * len(bounds), 0.0, 0])
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in pairs)
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        """Return the whole registry in the Prometheus text exposition format."""
+        with self.lock:
+            lines = []
+            for name in sorted(self.types):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {self.types[name]}")
+                if self.types[name] == "histogram":
+                    bounds = self.buckets[name]
+                    for (metric, labels), (counts, total, count) in sorted(self.histograms.items()):
+                        if metric != name:
+                            continue
+                        for bound, bucket_count in zip(bounds, counts):
+                            lines.append(f"{name}_bucket{self._labels(labels, [('le', repr(float(bound)))])} {bucket_count}")
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                        lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                        lines.append(f"{name}_count{self._labels(labels)} {count}")
+                else:
+                    for (metric, labels), value in sorted(self.values.items()):
+                        if metric == name:
+                            lines.append(f"{name}{self._labels(labels)} {value}")
+            return "\n".join(lines) + "\n"
+
+
+class VerificationSweep:
+    """Batches checks of published media IDs into one multi-ID Graph lookup per tick.
+
+    ``submit`` returns a Future resolved with the object's fields once it is
+    readable, or with None after ``attempts`` ticks or a 400 for that ID. A
+    background thread runs while anything is pending; IDs submitted with the
+    same base URL, fields and token share a ``?ids=a,b,c`` request.
+    """
+
+    def __init__(self, get, interval=5, attempts=10, gather=1, batch_size=50, sleep=time.sleep):
+        self.get = get
+        self.interval = interval
+        self.attempts = attempts
+        self.gather = gather
+        self.batch_size = batch_size
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.pending = {}  # (base, fields, token) -> {media_id: [future, attempts_left]}
+        self.thread = None
+        self.lookups = 0
+        self.resolved = 0
+
+    def submit(self, base, media_id, fields, token):
+        with self.lock:
+            group = self.pending.setdefault((base, fields, token), {})
+            if media_id not in group:
+                group[media_id] = [Future(), self.attempts]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="verification-sweep", daemon=True)
+                self.thread.start()
+            return group[media_id][0]
+
+    def run(self):
+        # Let posts published around the same moment join the first lookup
+        self.sleep(self.gather)
+        while True:
+            with self.lock:
+                groups = {key: list(ids) for key, ids in self.pending.items() if ids}
+                if not groups:
+                    self.pending.clear()
+                    self.thread = None
+                    return
+            for key, ids in groups.items():
+                for start in range(0, len(ids), self.batch_size):
+                    self.check(key, ids[start:start + self.batch_size])
+            with self.lock:
+                if not any(self.pending.values()):
+                    continue
+            self.sleep(self.interval)
+
+    def check(self, key, ids):
+        base, fields, token = key
+        self.lookups += 1
+        try:
+            res = self.get(f"{base}/", params={"ids": ",".join(ids), "fields": fields, "access_token": token})
+        except Exception:
+            res = None
+        if res is not None and res.status_code == 200:
+            found = res.json()
+            for media_id in ids:
+                self.settle(key, media_id, found.get(media_id))
+        elif res is not None and res.status_code == 400 and len(ids) > 1:
+            # One unreadable ID fails the whole lookup; check them one by one this tick
+            for media_id in ids:
+                self.check(key, [media_id])
+        else:
+            for media_id in ids:
+                self.settle(key, media_id, None, final=res is not None and res.status_code == 400)
+
+    def settle(self, key, media_id, data, final=False):
+        with self.lock:
+            entry = self.pending[key][media_id]
+            entry[1] -= 1
+            if data is None and not final and entry[1] > 0:
+                return
+            del self.pending[key][media_id]
+            self.resolved += 1
+        entry[0].set_result(data)
+
+    def drain(self, timeout=None):
+        """Block until every submitted ID has resolved and its callbacks have run (or ``timeout`` passes)."""
+        with self.lock:
+            thread = self.thread
+        if thread is not None:
+            # Futures resolve on the sweep thread, which runs their done-callbacks before it exits
+            thread.join(timeout)
+
+
+class MediaCache:
+    """Content-hash addressed on-disk cache of media bytes with a size cap and LRU eviction.
+
+    Entries are named by the source's content_hash, so a file is downloaded once no
+    matter how many stages (hashing, probing, transcoding, image prep) read it.
+    Recency is the file mtime, bumped on every hit. Entries used in the last
+    ``min_age`` seconds are never evicted, so in-flight stages keep their input
+    even when the working set is larger than the cap.
+    """
+
+    PARTIAL_PREFIX = ".partial-"
+    # Leftovers of crashed runs in the system temp dir
+    TEMP_PREFIX = "inkwisps_"
+    STALE_SECONDS = 3600
+
+    def __init__(self, root, max_bytes, min_age=600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.index = {}
+        for name in os.listdir(root):
+            if not name.startswith(self.PARTIAL_PREFIX):
+                self.index[os.path.splitext(name)[0]] = os.path.join(root, name)
+        self.cleanup()
+
+    def lookup(self, key):
+        """Return the cached path for ``key`` (marking it recently used), or None."""
+        with self.lock:
+            path = self.index.get(key)
+            if path is None:
+                return None
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                del self.index[key]
+                return None
+            return path
+
+    def fetch(self, key, ext, download):
+        """Return the local path for ``key``, calling ``download(tmp_path)`` on a miss."""
+        path = self.lookup(key)
+        if path:
+            return path
+        fd, tmp_path = tempfile.mkstemp(prefix=self.PARTIAL_PREFIX, dir=self.root)
+        os.close(fd)
+        try:
+            download(tmp_path)
+            path = os.path.join(self.root, f"{key}{ext}")
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self.lock:
+            self.index[key] = path
+        return path
+
+    def map(self, path):
+        """Read-only memory map of a cached file; use it as a context manager."""
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits its cap; returns the size kept."""
+        with self.lock:
+            entries = []
+            for key, path in list(self.index.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self.index[key]
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, key, path))
+            total = sum(entry[1] for entry in entries)
+            cutoff = time.time() - self.min_age
+            for mtime, size, key, path in sorted(entries):
+                if total <= self.max_bytes or mtime > cutoff:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                del self.index[key]
+                total -= size
+            return total
+
+    def cleanup(self):
+        """Remove stale partial downloads and temp files/dirs left behind by crashed runs."""
+        cutoff = time.time() - self.STALE_SECONDS
+        for folder, prefix in ((self.root, self.PARTIAL_PREFIX), (tempfile.gettempdir(), self.TEMP_PREFIX)):
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    if not name.startswith(prefix) or os.path.getmtime(path) > cutoff:
+                        continue
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+class MediaSourceError(Exception):
+    """A media source operation failed: missing path, lost move race, store error.
+
+    ``not_found`` is True only when the store confirmed the path does not exist,
+    as opposed to a network or store failure that says nothing about it.
+    """
+
+    def __init__(self, message, not_found=False):
+        super().__init__(message)
+        self.not_found = not_found
+
+
+class MediaFile:
+    """File metadata from stores other than Dropbox, shaped like Dropbox's FileMetadata."""
+
+    def __init__(self, path, size, content_hash, server_modified):
+        self.name = path.rsplit("/", 1)[-1]
+        # Case-sensitive stores keep the case: path_lower is what addresses the file
+        self.path_display = self.path_lower = path
+        self.size = size
+        self.content_hash = content_hash
+        self.server_modified = self.client_modified = server_modified
+
+    def __repr__(self):
+        return f"MediaFile({self.path_display!r}, size={self.size})"
+
+
+class MediaFolder:
+    def __init__(self, path):
+        self.name = path.rsplit("/", 1)[-1]
+        self.path_display = self.path_lower = path
+
+
+class MediaSource:
+    """Where the media lives: listing, metadata, links Meta can fetch, and archive operations.
+
+    Paths are absolute ("/inkwisp/a.jpg"). Files are FileMetadata-like objects
+    (name, path_lower, size, content_hash, server_modified as naive UTC).
+    Every operation raises MediaSourceError on failure.
+    """
+
+    def list_files(self, path):
+        raise NotImplementedError
+
+    def list_folders(self, path):
+        raise NotImplementedError
+
+    def list_changes(self, path, cursor=None):
+        """Return (files, removed_paths, cursor, full) for ``path`` since ``cursor``.
+
+        Stores without a change feed always return a full listing (``full`` is
+        True): anything not in ``files`` is gone.
+        """
+        return self.list_files(path), [], None, True
+
+    def get_metadata(self, path):
+        raise NotImplementedError
+
+    def media_info(self, path):
+        """(width, height, duration) known without downloading the file; Nones when unknown."""
+        return None, None, None
+
+    def download(self, path):
+        raise NotImplementedError
+
+    def download_to_file(self, local_path, path):
+        with open(local_path, "wb") as f:
+            f.write(self.download(path))
+
+    def upload(self, data, path):
+        """Write ``data`` to ``path``, replacing any existing file."""
+        raise NotImplementedError
+
+    def move(self, src, dst, autorename=False):
+        """Move a file or folder; fails if ``src`` is gone (another runner moved it first). Returns the new metadata."""
+        raise NotImplementedError
+
+    def delete(self, path):
+        """Delete a file or a whole folder."""
+        raise NotImplementedError
+
+    def temporary_link(self, path):
+        """A URL Meta (and ffmpeg) can fetch ``path`` from for at least TEMP_LINK_TTL."""
+        raise NotImplementedError
+
+
+class DropboxSource(MediaSource):
+    """The Dropbox app folder, through the official SDK client."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def call(self, method, *args, **kwargs):
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except dropbox.exceptions.ApiError as e:
+            raise MediaSourceError(str(e), not_found=self.is_not_found(e.error)) from e
+
+    @staticmethod
+    def is_not_found(error):
+        # Download/metadata/list errors carry the lookup as "path", deletes as "path_lookup", moves as "from_lookup"
+        for kind in ("path", "path_lookup", "from_lookup"):
+            if getattr(error, f"is_{kind}", lambda: False)():
+                lookup = getattr(error, f"get_{kind}")()
+                return bool(getattr(lookup, "is_not_found", lambda: False)())
+        return False
+
+    def list_entries(self, path):
+        result = self.call("files_list_folder", path)
+        entries = list(result.entries)
+        while result.has_more:
+            result = self.call("files_list_folder_continue", result.cursor)
+            entries += result.entries
+        return entries
+
+    def list_files(self, path):
+        return [e for e in self.list_entries(path) if isinstance(e, dropbox.files.FileMetadata)]
+
+    def list_folders(self, path):
+        return [e for e in self.list_entries(path) if isinstance(e, dropbox.files.FolderMetadata)]
+
+    def list_changes(self, path, cursor=None):
+        full = cursor is None
+        try:
+            result = self.call("files_list_folder_continue", cursor) if cursor else self.call("files_list_folder", path)
+        except MediaSourceError:
+            # Cursor expired: start over from a full listing
+            full = True
+            result = self.call("files_list_folder", path)
+        files, removed = [], []
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, dropbox.files.DeletedMetadata):
+                    removed.append(entry.path_lower)
+                elif isinstance(entry, dropbox.files.FileMetadata):
+                    files.append(entry)
+            if not result.has_more:
+                break
+            result = self.call("files_list_folder_continue", result.cursor)
+        return files, removed, result.cursor, full
+
+    def get_metadata(self, path):
+        return self.call("files_get_metadata", path)
+
+    def media_info(self, path):
+        metadata = self.call("files_get_metadata", path, include_media_info=True)
+        if getattr(metadata, "media_info", None) and not metadata.media_info.is_pending():
+            info = metadata.media_info.get_metadata()
+            width = height = None
+            if getattr(info, "dimensions", None) is not None:
+                width, height = info.dimensions.width, info.dimensions.height
+            duration = info.duration / 1000.0 if isinstance(info, dropbox.files.VideoMetadata) else None
+            return width, height, duration
+        return None, None, None
+
+    def download(self, path):
+        _, res = self.call("files_download", path)
+        return res.content
+
+    def download_to_file(self, local_path, path):
+        self.call("files_download_to_file", local_path, path)
+
+    def upload(self, data, path):
+        self.call("files_upload", data, path, mode=dropbox.files.WriteMode.overwrite)
+
+    def move(self, src, dst, autorename=False):
+        return self.call("files_move_v2", src, dst, autorename=autorename).metadata
+
+    def delete(self, path):
+        self.call("files_delete_v2", path)
+
+    def temporary_link(self, path):
+        return self.call("files_get_temporary_link", path).link
+
+
+class LocalDirSource(MediaSource):
+    """A local directory, served to Meta by a built-in HTTP server through signed, expiring links.
+
+    ``public_url`` is how Meta reaches the server (a tunnel or reverse proxy in
+    front of ``port``). Moves are os.rename, so claims stay atomic across runners
+    sharing the directory. content_hash uses Dropbox's algorithm, so caches keyed
+    by it carry over when a deployment switches stores. Hashes are kept by
+    (path, size, mtime) in ``hash_cache`` (a JSON file in the store), so a
+    one-shot run only reads files that are new or changed.
+    """
+
+    LINK_TTL = 4 * 60 * 60
+    HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, root, public_url=None, port=8089, secret=None, hash_cache=None):
+        self.root = os.path.abspath(root)
+        self.port = port
+        self.public_url = (public_url or f"http://localhost:{port}").rstrip("/")
+        self.secret = (secret or uuid.uuid4().hex).encode("utf-8")
+        self.hash_cache = hash_cache
+        self.hashes = None  # path -> [size, mtime_ns, content_hash], loaded on first use
+        self.hashes_dirty = False
+        self.hash_lock = threading.Lock()
+        self.server = None
+        self.lock = threading.Lock()
+
+    def local_path(self, path):
+        local = os.path.normpath(os.path.join(self.root, path.lstrip("/")))
+        if local != self.root and not local.startswith(self.root + os.sep):
+            raise MediaSourceError(f"{path} is outside {self.root}")
+        return local
+
+    def load_hashes(self):
+        if self.hashes is None:
+            self.hashes = {}
+            if self.hash_cache:
+                try:
+                    with open(self.local_path(self.hash_cache)) as f:
+                        self.hashes = json.load(f)
+                except (OSError, ValueError):
+                    pass
+        return self.hashes
+
+    def save_hashes(self):
+        """Persist newly computed hashes; entries for files that are gone are dropped."""
+        with self.hash_lock:
+            if not self.hash_cache or not self.hashes_dirty:
+                return
+            self.hashes = {path: entry for path, entry in self.hashes.items() if os.path.isfile(self.local_path(path))}
+            self.hashes_dirty = False
+            data = json.dumps(self.hashes).encode("utf-8")
+        try:
+            self.upload(data, self.hash_cache)
+        except MediaSourceError:
+            pass
+
+    def content_hash(self, path, local, stat):
+        import hashlib
+        with self.hash_lock:
+            cached = self.load_hashes().get(path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        blocks = hashlib.sha256()
+        with open(local, "rb") as f:
+            for block in iter(lambda: f.read(self.HASH_BLOCK_SIZE), b""):
+                blocks.update(hashlib.sha256(block).digest())
+        with self.hash_lock:
+            self.hashes[path] = [stat.st_size, stat.st_mtime_ns, blocks.hexdigest()]
+            self.hashes_dirty = True
+        return blocks.hexdigest()
+
+    def file_entry(self, path, local):
+        stat = os.stat(local)
+        return MediaFile(path, stat.st_size, self.content_hash(path, local, stat), datetime.utcfromtimestamp(stat.st_mtime))
+
+    def scan(self, path):
+        try:
+            return list(os.scandir(self.local_path(path)))
+        except OSError as e:
+            raise MediaSourceError(str(e), not_found=isinstance(e, FileNotFoundError)) from e
+
+    def list_files(self, path):
+        files = []
+        for entry in self.scan(path):
+            if not entry.is_file() or entry.name.startswith(MediaCache.PARTIAL_PREFIX):
+                continue
+            try:
+                files.append(self.file_entry(f"{path.rstrip('/')}/{entry.name}", entry.path))
+            except OSError:
+                # Moved away (claimed by another runner) while we listed
+                continue
+        self.save_hashes()
+        return files
+
+    def list_folders(self, path):
+        return [MediaFolder(f"{path.rstrip('/')}/{e.name}") for e in self.scan(path) if e.is_dir()]
+
+    def get_metadata(self, path):
+        local = self.local_path(path)
+        if os.path.isdir(local):
+            return MediaFolder(path)
+        try:
+            entry = self.file_entry(path, local)
+        except OSError as e:
+            raise MediaSourceError(str(e), not_found=isinstance(e, FileNotFoundError)) from e
+        self.save_hashes()
+        return entry
+
+    def media_info(self, path):
+        local = self.local_path(path)
+        try:
+            if path.lower().endswith((".mp4", ".mov")):
+                from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+                infos = ffmpeg_parse_infos(local)
+                return (*infos["video_size"], infos["duration"])
+            from PIL import Image
+            with Image.open(local) as img:
+                return img.width, img.height, None
+        except Exception:
+            return None, None, None
+
+    def download(self, path):
+        try:
+            with open(self.local_path(path), "rb") as f:
+                return f.read()
+        except OSError as e:
+            raise MediaSourceError(str(e), not_found=isinstance(e, FileNotFoundError)) from e
+
+    def download_to_file(self, local_path, path):
+        try:
+            shutil.copyfile(self.local_path(path), local_path)
+        except OSError as e:
+            raise MediaSourceError(str(e), not_found=isinstance(e, FileNotFoundError)) from e
+
+    def upload(self, data, path):
+        local = self.local_path(path)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=MediaCache.PARTIAL_PREFIX, dir=os.path.dirname(local))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, local)
+        except OSError as e:
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            raise MediaSourceError(str(e), not_found=isinstance(e, FileNotFoundError)) from e
+
+    def move(self, src, dst, autorename=False):
+        local_dst = self.local_path(dst)
+        if os.path.exists(local_dst):
+            if not autorename:
+                raise MediaSourceError(f"{dst} already exists")
+            base, ext = os.path.splitext(dst)
+            n = 1
+            while os.path.exists(self.local_path(f"{base} ({n}){ext}")):
+                n += 1
+            dst = f"{base} ({n}){ext}"
+            local_dst = self.local_path(dst)
+        try:
+            os.makedirs(os.path.dirname(local_dst), exist_ok=True)
+            os.rename(self.local_path(src), local_dst)
+        except OSError as e:
+            raise MediaSourceError(str(e), not_found=isinstance(e, FileNotFoundError)) from e
+        # rename keeps size and mtime, so known hashes follow the files
+        with self.hash_lock:
+            for path in [p for p in self.load_hashes() if p == src or p.startswith(src + "/")]:
+                self.hashes[dst + path[len(src):]] = self.hashes.pop(path)
+                self.hashes_dirty = True
+        return self.get_metadata(dst)
+
+    def delete(self, path):
+        local = self.local_path(path)
+        try:
+            if os.path.isdir(local):
+                shutil.rmtree(local)
+            else:
+                os.remove(local)
+        except OSError as e:
+            raise MediaSourceError(str(e), not_found=isinstance(e, FileNotFoundError)) from e
+
+    def sign(self, path, expires):
+        import hashlib
+        import hmac
+        return hmac.new(self.secret, f"{expires}:{path}".encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+    def temporary_link(self, path):
+        from urllib.parse import quote
+        if not os.path.isfile(self.local_path(path)):
+            raise MediaSourceError(f"{path} not found", not_found=True)
+        self.serve()
+        expires = int(time.time() + self.LINK_TTL)
+        return f"{self.public_url}/media/{expires}/{self.sign(path, expires)}{quote(path)}"
+
+    def resolve_link(self, url_path):
+        """Local file behind a /media/<expires>/<signature>/<path> link, or None if invalid or expired."""
+        import hmac
+        from urllib.parse import unquote
+        parts = unquote(url_path).split("/", 4)
+        if len(parts) < 5 or parts[1] != "media" or not parts[2].isdigit():
+            return None
+        expires, signature, path = int(parts[2]), parts[3], "/" + parts[4]
+        if expires < time.time() or not hmac.compare_digest(signature, self.sign(path, expires)):
+            return None
+        try:
+            local = self.local_path(path)
+        except MediaSourceError:
+            return None
+        return local if os.path.isfile(local) else None
+
+    def serve(self):
+        """Start the link server once, on a background thread (Range requests supported for ffmpeg seeks)."""
+        import mimetypes
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        with self.lock:
+            if self.server:
+                return
+            source = self
+
+            class MediaHandler(BaseHTTPRequestHandler):
+                def do_HEAD(self):
+                    self.respond(send_body=False)
+
+                def do_GET(self):
+                    self.respond(send_body=True)
+
+                def respond(self, send_body):
+                    local = source.resolve_link(self.path.split("?")[0])
+                    if local is None:
+                        self.send_error(404)
+                        return
+                    size = os.path.getsize(local)
+                    start, end = 0, size - 1
+                    match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+                    if match and any(match.groups()):
+                        if match.group(1):
+                            start, end = int(match.group(1)), min(int(match.group(2) or end), end)
+                        else:
+                            start = max(0, size - int(match.group(2)))
+                        if start > end:
+                            self.send_error(416)
+                            return
+                        self.send_response(206)
+                        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                    else:
+                        self.send_response(200)
+                    self.send_header("Content-Type", mimetypes.guess_type(local)[0] or "application/octet-stream")
+                    self.send_header("Accept-Ranges", "bytes")
+                    self.send_header("Content-Length", str(end - start + 1))
+                    self.end_headers()
+                    if not send_body:
+                        return
+                    with open(local, "rb") as f:
+                        f.seek(start)
+                        remaining = end - start + 1
+                        while remaining > 0:
+                            chunk = f.read(min(1024 * 1024, remaining))
+                            if not chunk:
+                                break
+                            self.wfile.write(chunk)
+                            remaining -= len(chunk)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(("0.0.0.0", self.port), MediaHandler)
+            threading.Thread(target=self.server.serve_forever, name="media-http", daemon=True).start()
+
+
+class S3Source(MediaSource):
+    """An S3-compatible bucket (AWS, MinIO, R2...) with presigned GET links.
+
+    S3 has no rename, so a move is a conditional copy + delete: the copy never
+    overwrites the destination (If-None-Match) and the source is only deleted
+    if it is still the object that was copied (If-Match). Of two runners moving
+    the same file, only one delete succeeds; the other drops its copy and
+    reports the file as already claimed. The store must support conditional
+    writes (AWS has since 2024).
+
+    content_hash is the object's ETag. That is the MD5 of the bytes only for
+    single-part, non-KMS uploads; a multipart ETag ("...-N") is derived from the
+    part digests and changes when a move copies the object, so near-duplicate
+    and retry bookkeeping see it as new content afterwards. Upload media in a
+    single PUT to keep the hashes stable.
+    """
+
+    LINK_TTL = 4 * 60 * 60
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, region=None):
+        import boto3
+        from botocore.exceptions import BotoCoreError, ClientError
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.errors = (BotoCoreError, ClientError)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def error(self, e):
+        code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        return MediaSourceError(str(e), not_found=code in ("404", "NoSuchKey", "NotFound"))
+
+    @staticmethod
+    def precondition_failed(e):
+        return getattr(e, "response", {}).get("Error", {}).get("Code") in ("412", "PreconditionFailed", "ConditionalRequestConflict")
+
+    def key(self, path):
+        return "/".join(filter(None, [self.prefix, path.strip("/")]))
+
+    def path(self, key):
+        return "/" + key[len(self.prefix):].lstrip("/") if self.prefix else "/" + key
+
+    def call(self, method, **kwargs):
+        try:
+            return getattr(self.client, method)(Bucket=self.bucket, **kwargs)
+        except self.errors as e:
+            raise self.error(e) from e
+
+    def file_entry(self, key, size, etag, modified):
+        return MediaFile(self.path(key), size, etag.strip('"'), modified.astimezone(utc).replace(tzinfo=None))
+
+    def list_entries(self, path):
+        files, folders = [], []
+        prefix = self.key(path)
+        prefix = prefix + "/" if prefix else ""
+        try:
+            for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix, Delimiter="/"):
+                files += [self.file_entry(o["Key"], o["Size"], o["ETag"], o["LastModified"])
+                          for o in page.get("Contents", []) if o["Key"] != prefix]
+                folders += [MediaFolder(self.path(p["Prefix"].rstrip("/"))) for p in page.get("CommonPrefixes", [])]
+        except self.errors as e:
+            raise self.error(e) from e
+        return files, folders
+
+    def list_files(self, path):
+        return self.list_entries(path)[0]
+
+    def list_folders(self, path):
+        return self.list_entries(path)[1]
+
+    def get_metadata(self, path):
+        head = self.call("head_object", Key=self.key(path))
+        return self.file_entry(self.key(path), head["ContentLength"], head["ETag"], head["LastModified"])
+
+    def exists(self, path):
+        try:
+            self.get_metadata(path)
+            return True
+        except MediaSourceError:
+            return False
+
+    def download(self, path):
+        return self.call("get_object", Key=self.key(path))["Body"].read()
+
+    def download_to_file(self, local_path, path):
+        try:
+            self.client.download_file(self.bucket, self.key(path), local_path)
+        except self.errors as e:
+            raise self.error(e) from e
+
+    def upload(self, data, path):
+        self.call("put_object", Key=self.key(path), Body=data)
+
+    def move(self, src, dst, autorename=False):
+        if self.exists(dst):
+            if not autorename:
+                raise MediaSourceError(f"{dst} already exists")
+            base, ext = os.path.splitext(dst)
+            n = 1
+            while self.exists(f"{base} ({n}){ext}"):
+                n += 1
+            dst = f"{base} ({n}){ext}"
+        files, folders = self.list_entries(src)
+        if files or folders:
+            # A "folder": move every object under it
+            for file in files:
+                self.move(file.path_lower, f"{dst}/{file.name}")
+            for folder in folders:
+                self.move(folder.path_lower, f"{dst}/{folder.name}")
+            return MediaFolder(dst)
+        etag = self.call("head_object", Key=self.key(src))["ETag"]
+        while True:
+            try:
+                self.client.copy_object(Bucket=self.bucket, Key=self.key(dst), IfNoneMatch="*",
+                                        CopySource={"Bucket": self.bucket, "Key": self.key(src)})
+                break
+            except self.errors as e:
+                if not self.precondition_failed(e):
+                    raise self.error(e) from e
+                # Someone else wrote the destination between the existence check and the copy
+                if not autorename:
+                    raise MediaSourceError(f"{dst} already exists") from e
+                base, ext = os.path.splitext(dst)
+                n = 1
+                while self.exists(f"{base} ({n}){ext}"):
+                    n += 1
+                dst = f"{base} ({n}){ext}"
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self.key(src), IfMatch=etag)
+        except self.errors as e:
+            # Another runner moved (or replaced) the source first; our copy is a stray
+            try:
+                self.client.delete_object(Bucket=self.bucket, Key=self.key(dst))
+            except self.errors:
+                pass
+            raise MediaSourceError(f"{src} was already claimed: {e}", not_found=self.error(e).not_found) from e
+        return self.get_metadata(dst)
+
+    def delete(self, path):
+        if self.exists(path):
+            self.call("delete_object", Key=self.key(path))
+            return
+        files, folders = self.list_entries(path)
+        if not files and not folders:
+            raise MediaSourceError(f"{path} not found", not_found=True)
+        for entry in files + folders:
+            self.delete(entry.path_lower)
+
+    def temporary_link(self, path):
+        try:
+            return self.client.generate_presigned_url("get_object", Params={"Bucket": self.bucket, "Key": self.key(path)},
+                                                      ExpiresIn=self.LINK_TTL)
+        except self.errors as e:
+            raise self.error(e) from e
+
+
+class CassetteMiss(LookupError):
+    """Raised in replay mode when a request has no recorded interaction left."""
+
+
+class HttpCassette:
+    """Recorded HTTP interactions for dry runs.
+
+    In "record" mode every request/response is captured (tokens redacted) and
+    written by ``save``. In "replay" mode requests are answered from the file:
+    interactions are matched by method, host, path, ``fields`` parameter and the
+    body fields that tell concurrent container POSTs apart, in recorded order,
+    so changing IDs in query strings and bodies do not break matching.
+    """
+
+    # Story, feed, carousel parent and carousel child containers all POST to /{ig_id}/media concurrently
+    BODY_MATCH_FIELDS = ("media_type", "is_carousel_item")
+    BODY_MATCH_PRESENCE = ("image_url", "video_url")
+
+    def __init__(self, path, mode, speed=0.0):
+        self.path = path
+        self.mode = mode
+        # Replay waits ``elapsed * speed`` per interaction: 0 = instant, 1 = real time
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.interactions = []
+        self.queues = {}
+        if mode == "replay":
+            with open(path) as f:
+                self.interactions = json.load(f)["interactions"]
+            for interaction in self.interactions:
+                # Keys are derived from the recorded request, so older recordings follow key changes
+                request = interaction["request"]
+                body_key = request.get("body_key", self.body_key(request.get("body")))
+                self.queues.setdefault(self.match_key(request["method"], request["url"], body_key), []).append(interaction)
+
+    @classmethod
+    def body_key(cls, body):
+        """The distinguishing fields of a form or JSON request body, "" when it has none."""
+        if isinstance(body, bytes):
+            try:
+                body = body.decode("utf-8")
+            except UnicodeDecodeError:
+                return ""
+        if not body:
+            return ""
+        try:
+            params = json.loads(body)
+        except ValueError:
+            params = {name: values[0] for name, values in parse_qs(body).items()}
+        if not isinstance(params, dict):
+            return ""
+        parts = [f"{name}={params[name]}" for name in cls.BODY_MATCH_FIELDS if name in params]
+        parts += [name for name in cls.BODY_MATCH_PRESENCE if name in params]
+        return ",".join(parts)
+
+    @staticmethod
+    def match_key(method, url, body_key=""):
+        parts = urlparse(str(url))
+        key = f"{method.upper()} {redact(f'{parts.scheme}://{parts.netloc}{parts.path}')}"
+        # Status polls and verification lookups share a path and run on different threads; keep their queues apart
+        fields = parse_qs(parts.query).get("fields")
+        if fields:
+            key = f"{key}?fields={fields[0]}"
+        return f"{key} [{body_key}]" if body_key else key
+
+    def replay(self, method, url, request_body=None):
+        key = self.match_key(method, url, self.body_key(request_body))
+        with self.lock:
+            queue = self.queues.get(key)
+            if not queue:
+                raise CassetteMiss(f"no recorded interaction left for {key}")
+            interaction = queue.pop(0)
+        response = interaction["response"]
+        body = base64.b64decode(response["body_b64"]) if "body_b64" in response else response["body"].encode("utf-8")
+        return response["status"], response["headers"], body, response["elapsed"]
+
+    def record(self, method, url, request_body, status, headers, body, elapsed):
+        # Taken before the body is truncated below
+        body_key = self.body_key(request_body)
+        if isinstance(request_body, bytes):
+            try:
+                request_body = request_body.decode("utf-8")
+            except UnicodeDecodeError:
+                request_body = f"<{len(request_body)} bytes>"
+        # Bodies are stored decoded, so transfer-level headers no longer apply
+        headers = {k: redact(v) for k, v in headers.items()
+                   if k.lower() not in ("content-encoding", "content-length", "transfer-encoding", "set-cookie")}
+        response = {"status": status, "headers": headers, "elapsed": round(elapsed, 4)}
+        try:
+            response["body"] = redact(body.decode("utf-8"))
+        except UnicodeDecodeError:
+            response["body_b64"] = base64.b64encode(body).decode("ascii")
+        with self.lock:
+            self.interactions.append({
+                "key": self.match_key(method, url, body_key),
+                "request": {"method": method, "url": redact(str(url)), "body": redact(request_body or "")[:2000],
+                            "body_key": body_key},
+                "response": response,
+            })
+
+    def unused(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with self.lock, open(tmp_path, "w") as f:
+            json.dump({"recorded_at": datetime.now(utc).isoformat(), "interactions": self.interactions}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class CassetteAdapter(requests.adapters.HTTPAdapter):
+    """requests transport adapter that records to or replays from an HttpCassette."""
+
+    def __init__(self, cassette):
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        if self.cassette.mode == "replay":
+            status, headers, body, elapsed = self.cassette.replay(request.method, request.url, request.body)
+            time.sleep(elapsed * self.cassette.speed)
+            response = requests.Response()
+            response.status_code = status
+            response.headers = requests.structures.CaseInsensitiveDict(headers)
+            response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+            response.raw = io.BytesIO(body)
+            response.url = request.url
+            response.request = request
+            response.reason = "REPLAYED"
+            return response
+        started = time.perf_counter()
+        response = super().send(request, **kwargs)
+        self.cassette.record(request.method, request.url, request.body, response.status_code,
+                             dict(response.headers), response.content, time.perf_counter() - started)
+        return response
+
 
 class DropboxToInstagramUploader:
     DROPBOX_TOKEN_URL = "https://api.dropbox.com/oauth2/token"
+    DROPBOX_TOKEN_REFRESH_MARGIN = 15 * 60
+    # Dropbox temporary links are valid for 4 hours; stop reusing them a little early
+    TEMP_LINK_TTL = 4 * 60 * 60
+    TEMP_LINK_REUSE_MARGIN = 10 * 60
     INSTAGRAM_API_BASE = "https://graph.facebook.com/v18.0"
     INSTAGRAM_REEL_STATUS_RETRIES = 10
     INSTAGRAM_REEL_STATUS_WAIT_TIME = 15
+    NEAR_DUPLICATE_VIDEO_SAMPLES = 5
+    NEAR_DUPLICATE_MAX_CANDIDATES = 5
+    FASTSTART_PROBE_BYTES = 64 * 1024
+    IMAGE_MAX_WIDTH = 1440
+    IMAGE_JPEG_QUALITY = 85
+    CAROUSEL_MAX_ITEMS = 10
+    REEL_COVER_CANDIDATE_OFFSETS = (0.15, 0.35, 0.55, 0.75)
+    # Posted video properties the encode tuner learns from
+    ENCODE_SAMPLE_KEYS = ("width", "height", "duration", "bitrate_kbps", "keyframe_interval")
+    CLAIM_MAX_ATTEMPTS = 5
+    # Graph API error classification (codes/subcodes from the Graph and IG Content Publishing docs)
+    GRAPH_TRANSIENT_CODES = {1, 2, 4, 17, 32, 341, 613, 9004, 9007, 80001, 80002}
+    GRAPH_TRANSIENT_SUBCODES = {2207001, 2207003, 2207008, 2207020, 2207027, 2207032}
+    GRAPH_MEDIA_INVALID_CODES = {352, 36000, 36001, 36003, 36004}
+    GRAPH_MEDIA_INVALID_SUBCODES = {2207004, 2207005, 2207006, 2207009, 2207026, 2207052, 2207053}
+    RETRY_BACKOFF_BASE_SECONDS = 30 * 60
+    RETRY_BACKOFF_MAX_SECONDS = 24 * 60 * 60
+    IG_INSIGHT_METRICS = ("reach", "likes", "comments", "saved", "shares", "total_interactions")
+    FB_INSIGHT_METRICS = {
+        "reel": ("blue_reels_play_count", "post_impressions_unique", "post_video_avg_time_watched"),
+        "video": ("total_video_views", "total_video_impressions", "total_video_avg_time_watched"),
+        "photo": ("post_impressions", "post_impressions_unique", "post_clicks"),
+        "post": ("post_impressions", "post_impressions_unique", "post_clicks"),
+    }
+    GRAPH_BATCH_SIZE = 50
+    SELECTION_ROTATION = ("REELS", "IMAGE")
+    # Hashtags in file names (e.g. "sunrise #calm #nature.mp4") drive tag weights
+    FILENAME_TAG_PATTERN = re.compile(r"#(\w+)")
+    # Files named "<prefix>__<n>.<ext>" are posted together as one carousel
+    CAROUSEL_NAME_PATTERN = re.compile(r"^(?P<prefix>.+?)__(?P<index>\d+)$")
+    # Daemon mode posts at these IST times unless scheduler/config.json lists "slots"
+    DEFAULT_POSTING_SLOTS = ("07:00", "10:00", "17:00", "21:00")
+    # IG containers can be published for 24h after creation; staged ones are dropped a little earlier
+    STAGED_CONTAINER_TTL = 24 * 3600
+    STAGED_CONTAINER_EXPIRY_MARGIN = 600
+    # Facebook only accepts scheduled_publish_time at least 10 minutes ahead
+    FB_SCHEDULE_MIN_LEAD_SECONDS = 900
+    # A staged post published this much ahead of its Facebook schedule pulls the Facebook post forward
+    FB_RESCHEDULE_TOLERANCE_SECONDS = 60
+    # Published IDs are verified together: one multi-ID lookup every VERIFY_INTERVAL_SECONDS, VERIFY_ATTEMPTS per ID
+    VERIFY_INTERVAL_SECONDS = 5
+    VERIFY_ATTEMPTS = 10
+    VERIFY_IG_FIELDS = "id,permalink,media_type,timestamp"
+    VERIFY_FB_FIELDS = "id,permalink_url,created_time,length"
+    # Stories: IG accepts story videos of up to 60s; a slow story container may delay the feed by this many status ticks
+    STORY_MAX_DURATION = 60
+    STORY_GRACE_CHECKS = 3
+    # Telegram getUpdates long-poll timeout for daemon-mode commands
+    COMMAND_POLL_TIMEOUT = 50
+    COMMAND_LIST_LIMIT = 10
+    # Host suffix -> service label for HTTP call metrics
+    METRICS_SERVICE_HOSTS = (
+        ("facebook.com", "graph"),
+        ("instagram.com", "graph"),
+        ("dropboxapi.com", "dropbox"),
+        ("dropbox.com", "dropbox"),
+        ("dropboxusercontent.com", "dropbox"),
+        ("telegram.org", "telegram"),
+    )
+    METRICS_POLL_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34)
 
     def __init__(self):
         self.script_name = "inkwisps_post.py"
@@ -23,13 +1529,9 @@ class DropboxToInstagramUploader:
         self.account_key = "inkwisps"
         self.schedule_file = "scheduler/config.json"
 
-        # Logging
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s - %(levelname)s - %(message)s",
-            handlers=[logging.StreamHandler()]
-        )
-        self.logger = logging.getLogger()
+        # Logging (handlers are set up by configure_logging in __main__)
+        self.logger = logging.getLogger("inkwisps")
+        self.loggers = {name: logging.getLogger(f"inkwisps.{name}") for name in LOG_SUBSYSTEMS}
 
         # Secrets from GitHub environment
         self.meta_token = os.getenv("META_TOKEN")
@@ -43,38 +1545,366 @@ class DropboxToInstagramUploader:
         self.dropbox_key = os.getenv("DROPBOX_APP_KEY")
         self.dropbox_secret = os.getenv("DROPBOX_APP_SECRET")
         self.dropbox_refresh = os.getenv("DROPBOX_REFRESH_TOKEN")
+        # Encrypted short-lived token cache (persisted between runs via actions/cache or the local disk)
+        self.dropbox_token_cache = os.getenv("DROPBOX_TOKEN_CACHE") or ".cache/dropbox_token.enc"
+        self.dropbox_token_expires_at = None
+
+        # Media source: "dropbox" (default), "local" (a directory served over HTTP) or "s3"
+        self.media_source_kind = (os.getenv("MEDIA_SOURCE") or "dropbox").lower()
+        self.media_local_root = os.getenv("MEDIA_LOCAL_ROOT") or "media"
+        # Public base URL Meta fetches local media from (a tunnel or proxy in front of MEDIA_HTTP_PORT)
+        self.media_public_url = os.getenv("MEDIA_PUBLIC_URL")
+        self.media_http_port = int(os.getenv("MEDIA_HTTP_PORT") or 8089)
+        self.media_link_secret = os.getenv("MEDIA_LINK_SECRET")
+        self.s3_bucket = os.getenv("S3_BUCKET")
+        self.s3_prefix = os.getenv("S3_PREFIX") or ""
+        self.s3_endpoint_url = os.getenv("S3_ENDPOINT_URL")
+        self.s3_region = os.getenv("S3_REGION")
+        self.media_source = None
+
+        self.inbox_folder = "/inkwisp"
+        self.state_folder = f"{self.inbox_folder}/.state"
+        self.duplicates_folder = f"{self.inbox_folder}/.duplicates"
+        self.normalized_folder = f"{self.inbox_folder}/.normalized"
+        self.optimized_folder = f"{self.inbox_folder}/.optimized"
+        self.covers_folder = f"{self.inbox_folder}/.covers"
+        self.claims_folder = f"{self.inbox_folder}/.claimed"
+        self.dead_letter_folder = f"{self.inbox_folder}/.failed"
+        self.staging_folder = f"{self.inbox_folder}/.staged"
+
+        # Lease-based claiming so overlapping runs never pick the same file
+        self.run_id = "-".join(filter(None, [os.getenv("GITHUB_RUN_ID"), os.getenv("GITHUB_RUN_ATTEMPT"), uuid.uuid4().hex[:8]]))
+        self.claim_folder = f"{self.claims_folder}/{self.run_id}"
+        self.claim_lease_seconds = int(os.getenv("CLAIM_LEASE_SECONDS") or 3600)
+        # Set to stop the heartbeat that keeps the lease alive while a claim is held
+        self.lease_heartbeat = None
+        self.lease_lock = threading.Lock()
+
+        # Container pre-staging: `--stage` prepares IG containers for slots in the next STAGING_LOOKAHEAD_HOURS;
+        # a slot run publishes staged containers whose slot is at most STAGING_SLOT_GRACE_MINUTES away
+        self.staging_lookahead_hours = float(os.getenv("STAGING_LOOKAHEAD_HOURS") or 20)
+        self.staging_slot_grace_minutes = float(os.getenv("STAGING_SLOT_GRACE_MINUTES") or 30)
+        # Upload the Facebook post during staging too, with Facebook publishing it at the slot
+        self.fb_scheduling = (os.getenv("FB_SCHEDULING") or "off").lower() in ("on", "true", "1")
+        # Daemon mode re-stages after every slot when CONTAINER_STAGING is on
+        self.container_staging = (os.getenv("CONTAINER_STAGING") or "off").lower() in ("on", "true", "1")
+        # Daemon-mode Telegram commands answer from these snapshots, refreshed whenever a run touches the media source
+        self.inbox_snapshot = None  # (listed_at, files)
+        self.state_snapshots = {}
+        self.last_run = None
+        self.last_outcomes = []
+        self.next_slot = None
+        self.daemon_started_at = None
+        self.run_in_progress = False
+        self.post_now = threading.Event()
+        # Set by commands that leave work for the daemon loop (/postnow, /skip of a staged post)
+        self.daemon_wake = threading.Event()
+        # Lowercased names /skip'ed from Telegram; held back until /unskip or the daemon restarts
+        self.skipped_files = set()
+        # Skipped staged entries whose scheduled Facebook post the daemon loop still has to cancel
+        self.pending_fb_cancellations = set()
+
+        # Failed posts: transient failures go back to the inbox with backoff until RETRY_MAX_ATTEMPTS
+        self.retry_max_attempts = int(os.getenv("RETRY_MAX_ATTEMPTS") or 3)
+        _attempt_state.set({})
+        # Guards read-modify-write of shared state documents across worker threads
+        self.state_lock = threading.RLock()
+
+        # Async engine: posts per run and how many may be in flight at once
+        self.posts_per_run = int(os.getenv("POSTS_PER_RUN") or 1)
+        self.async_concurrency = int(os.getenv("ASYNC_CONCURRENCY") or 10)
 
-        self.dropbox_folder = "/inkwisp"
+        # Insights collector: refresh posts younger than INSIGHTS_ACTIVE_DAYS at most every INSIGHTS_INTERVAL_HOURS
+        self.insights_enabled = (os.getenv("INSIGHTS") or "off").lower() in ("on", "true", "1")
+        self.insights_db = os.getenv("INSIGHTS_DB") or ".cache/insights.sqlite"
+        self.insights_active_days = int(os.getenv("INSIGHTS_ACTIVE_DAYS") or 28)
+        self.insights_interval_hours = float(os.getenv("INSIGHTS_INTERVAL_HOURS") or 6)
+
+        # File selection: "random" or "priority" (age, media-type rotation, filename tags, engagement)
+        self.selection_strategy = (os.getenv("SELECTION_STRATEGY") or "random").lower()
+        self.selection_age_weight = float(os.getenv("SELECTION_AGE_WEIGHT") or 0.02)
+        self.selection_tag_weights = json.loads(os.getenv("SELECTION_TAG_WEIGHTS") or "{}")
+        self.selection_index = None
+
+        # Near-duplicate detection: "off", "flag" (post and warn) or "skip" (move aside)
+        self.near_duplicate_mode = (os.getenv("NEAR_DUPLICATE_MODE") or "off").lower()
+        self.near_duplicate_threshold = int(os.getenv("NEAR_DUPLICATE_THRESHOLD") or 10)
+
+        # Pre-transcode: "off", "pad" or "crop" to 1080x1920
+        self.transcode_mode = (os.getenv("TRANSCODE_MODE") or "off").lower()
+        self.transcode_max_bitrate_kbps = int(os.getenv("TRANSCODE_MAX_BITRATE_KBPS") or 5000)
+        self.transcode_prefetch = int(os.getenv("TRANSCODE_PREFETCH") or 2)
+        self.transcode_workers = int(os.getenv("TRANSCODE_WORKERS") or os.cpu_count() or 1)
+        # Encode tuner: pick the profile (or no re-encode) with the lowest expected Meta processing time
+        self.encode_tuner_enabled = (os.getenv("ENCODE_TUNER") or "off").lower() in ("on", "true", "1")
+        self.encode_tuner_min_samples = int(os.getenv("ENCODE_TUNER_MIN_SAMPLES") or 5)
+        self.encode_tuner_explore = float(os.getenv("ENCODE_TUNER_EXPLORE") or 0.2)
+        # Image preparation: "off", "crop" or "pad" to IG's 4:5–1.91:1 range
+        self.image_prep_mode = (os.getenv("IMAGE_PREP_MODE") or "off").lower()
+        self.image_prep_prefetch = int(os.getenv("IMAGE_PREP_PREFETCH") or 2)
+        self.image_prep_workers = int(os.getenv("IMAGE_PREP_WORKERS") or os.cpu_count() or 1)
+        # Stories: also post every single IMAGE/REELS file as an IG story
+        self.stories_enabled = (os.getenv("INSTAGRAM_STORIES") or "off").lower() in ("on", "true", "1")
+        # Reel cover frames: pick a sharp, well-exposed keyframe instead of Meta's default
+        self.reel_cover_enabled = (os.getenv("REEL_COVER") or "off").lower() in ("on", "true", "1")
+        # Derived copy path -> content_hash of the source file it was made from
+        self.derived_sources = {}
+        # Source path -> (temporary link, fetched_at)
+        self.temp_link_cache = {}
+        # Known (width, height, duration) for files whose Dropbox media_info may still be pending
+        self.media_info_overrides = {}
+        # Local media cache shared by every stage that needs the actual bytes
+        self.media_cache_dir = os.getenv("MEDIA_CACHE_DIR") or ".cache/media"
+        self.media_cache_max_mb = int(os.getenv("MEDIA_CACHE_MAX_MB") or 1024)
         if self.telegram_token:
             self.telegram_bot = Bot(token=self.telegram_token)
         else:
             self.telegram_bot = None
 
-        self.start_time = time.time()
-        self.session = requests.Session()
+        # Metrics: Prometheus textfile and/or pushgateway at the end of each run, live /metrics in daemon mode
+        self.metrics = MetricsRegistry()
+        self.metrics_textfile = os.getenv("METRICS_TEXTFILE")
+        self.metrics_pushgateway = os.getenv("METRICS_PUSHGATEWAY_URL")
+        self.metrics_port = int(os.getenv("METRICS_PORT") or 9108)
+
+        # Dry runs: CASSETTE_MODE=replay answers every HTTP call from CASSETTE_PATH, "record" captures a real run
+        self.cassette = None
+        self.time_scale = 1.0
+        cassette_mode = (os.getenv("CASSETTE_MODE") or "off").lower()
+        if cassette_mode in ("record", "replay"):
+            self.setup_cassette(cassette_mode)
+
+        self.media_cache = MediaCache(self.media_cache_dir, self.media_cache_max_mb * 1024 * 1024)
+
+        self.start_time = time.time()
+        # requests sessions are not thread-safe: every thread that talks to Graph gets its own (see session)
+        self.thread_sessions = threading.local()
+        # The sweep runs on its own thread, so it gets its own session
+        self.verifier = VerificationSweep(self.new_session().get, interval=self.VERIFY_INTERVAL_SECONDS,
+                                          attempts=self.VERIFY_ATTEMPTS, sleep=self.pause)
+
+    def new_session(self):
+        """A requests session with the HTTP metrics hook and, on dry runs, the cassette mounted."""
+        session = requests.Session()
+        session.hooks["response"].append(self.observe_http_response)
+        self.mount_cassette(session)
+        return session
+
+    @property
+    def session(self):
+        """The calling thread's own session, so concurrent posts and their child pools never share one."""
+        session = getattr(self.thread_sessions, "session", None)
+        if session is None:
+            session = self.thread_sessions.session = self.new_session()
+        return session
+
+    def setup_cassette(self, mode):
+        """Make the run reproducible against a cassette and keep replays off real services."""
+        self.cassette = HttpCassette(os.getenv("CASSETTE_PATH") or ".cache/cassette.json", mode,
+                                     speed=float(os.getenv("CASSETTE_SPEED") or 0))
+        # Same selection and claim paths on record and replay
+        random.seed(int(os.getenv("CASSETTE_SEED") or 0))
+        self.run_id = "cassette"
+        self.claim_folder = f"{self.claims_folder}/{self.run_id}"
+        # Start from an empty media cache so downloads are part of the recording
+        self.media_cache_dir = tempfile.mkdtemp(prefix="inkwisps_cassette_media_")
+        # Always refresh the Dropbox token so the refresh call is part of the recording
+        self.dropbox_token_cache = None
+        # Cover frames are grabbed by ffmpeg straight from the temp link, outside any HTTP client
+        self.reel_cover_enabled = False
+        if mode == "replay":
+            self.time_scale = self.cassette.speed
+            self.insights_db = ":memory:"
+            self.metrics_pushgateway = None
+        self.log_console_only("📼 Cassette %s mode: %s", mode, self.cassette.path, level=logging.INFO)
+
+    def mount_cassette(self, session):
+        if self.cassette:
+            adapter = CassetteAdapter(self.cassette)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+
+    def cassette_transport(self):
+        """httpx transport for the async engine that records to / replays from the cassette."""
+        import httpx
+        cassette = self.cassette
+
+        async def replay(request):
+            status, headers, body, elapsed = cassette.replay(request.method, request.url, request.content)
+            await asyncio.sleep(elapsed * cassette.speed)
+            return httpx.Response(status, headers=headers, content=body)
+
+        if cassette.mode == "replay":
+            return httpx.MockTransport(replay)
+
+        class RecordingTransport(httpx.AsyncHTTPTransport):
+            async def handle_async_request(self, request):
+                started = time.perf_counter()
+                response = await super().handle_async_request(request)
+                body = await response.aread()
+                cassette.record(request.method, request.url, request.content, response.status_code,
+                                dict(response.headers), body, time.perf_counter() - started)
+                headers = [(k, v) for k, v in response.headers.items() if k.lower() not in ("content-encoding", "content-length", "transfer-encoding")]
+                return httpx.Response(response.status_code, headers=headers, content=body)
+
+        return RecordingTransport()
+
+    def pause(self, seconds):
+        """time.sleep, scaled down (or skipped) when replaying a cassette."""
+        time.sleep(seconds * self.time_scale)
+
+    async def pause_async(self, seconds):
+        await asyncio.sleep(seconds * self.time_scale)
+
+    @property
+    def last_failure(self):
+        """Classified failure of the current attempt (isolated per asyncio task)."""
+        return _attempt_state.get({}).get("failure")
+
+    @last_failure.setter
+    def last_failure(self, failure):
+        state = _attempt_state.get(None)
+        if state is None:
+            state = {}
+            _attempt_state.set(state)
+        state["failure"] = failure
+        if failure:
+            self.metrics.inc("failures_total", doc="Classified failures by stage, category and Graph error code",
+                             stage=failure["stage"], category=failure["category"], code=failure["code"] or "none")
+
+    def note_post_id(self, platform, media_id, kind=None):
+        """Remember a published media ID on the current attempt for the journal."""
+        if not media_id or media_id == "Unknown":
+            return
+        state = _attempt_state.get(None)
+        if state is None:
+            state = {}
+            _attempt_state.set(state)
+        state.setdefault("post_ids", {})[platform] = {"id": media_id, "kind": kind}
+        if state.get("started_at"):
+            self.metrics.observe("publish_latency_seconds", time.time() - state["started_at"],
+                                 "Seconds from the start of an attempt until the platform returned a media ID",
+                                 platform=platform)
 
     def send_message(self, msg, level=logging.INFO):
         prefix = f"[{self.script_name}]\n"
         full_msg = prefix + msg
         try:
-            if self.telegram_bot and self.telegram_chat_id:
+            if self.cassette and self.telegram_token and self.telegram_chat_id:
+                # The Bot client has its own HTTP stack; go through the session so the call is on the cassette
+                self.session.post(f"https://api.telegram.org/bot{self.telegram_token}/sendMessage",
+                                  data={"chat_id": self.telegram_chat_id, "text": full_msg})
+            elif self.telegram_bot and self.telegram_chat_id:
+                started = time.perf_counter()
                 self.telegram_bot.send_message(chat_id=self.telegram_chat_id, text=full_msg)
+                self.observe_http_call("telegram", "POST", 200, time.perf_counter() - started)
             # Also log the message to console with the specified level
-            if level == logging.ERROR:
-                self.logger.error(full_msg)
-            else:
-                self.logger.info(full_msg)
+            self.logger.log(level, msg, extra={"script": self.script_name, "telegram": True})
         except Exception as e:
-            self.logger.error(f"Telegram send error for message '{full_msg}': {e}")
+            self.loggers["telegram"].error("Telegram send error for message %r: %s", msg, e, extra={"script": self.script_name})
 
-    def log_console_only(self, msg, level=logging.INFO):
-        """Log message to console only, not to Telegram."""
-        prefix = f"[{self.script_name}]\n"
-        full_msg = prefix + msg
-        if level == logging.ERROR:
-            self.logger.error(full_msg)
-        else:
-            self.logger.info(full_msg)
+    def log_console_only(self, msg, *args, level=logging.INFO, subsystem=None):
+        """Log message to console only, not to Telegram.
+
+        ``msg`` is a %-style format string; ``args`` are only formatted when
+        the (subsystem) logger is enabled for ``level``.
+        """
+        logger = self.loggers.get(subsystem, self.logger)
+        if logger.isEnabledFor(level):
+            logger.log(level, msg, *args, extra={"script": self.script_name})
+
+    def log_payload(self, label, res, subsystem="graph"):
+        """Dump a full HTTP response body, only when the subsystem logs at DEBUG."""
+        logger = self.loggers[subsystem]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s (%s): %s", label, res.status_code, res.text, extra={"script": self.script_name})
+
+    def metrics_service(self, url):
+        """Map a request URL to the service label used in HTTP metrics."""
+        host = urlparse(str(url)).hostname or ""
+        for suffix, service in self.METRICS_SERVICE_HOSTS:
+            if host == suffix or host.endswith("." + suffix):
+                return service
+        return "other"
+
+    def observe_http_call(self, service, method, status, seconds):
+        self.metrics.observe("http_request_duration_seconds", seconds, "Latency of outbound API calls",
+                             service=service, method=method)
+        self.metrics.inc("http_requests_total", doc="Outbound API calls by service and HTTP status",
+                         service=service, status=status)
+
+    def observe_http_response(self, res, *args, **kwargs):
+        """requests response hook (shared session and the Dropbox SDK session)."""
+        self.observe_http_call(self.metrics_service(res.url), res.request.method, res.status_code, res.elapsed.total_seconds())
+
+    async def on_httpx_request(self, request):
+        request.extensions["started_at"] = time.perf_counter()
+
+    async def on_httpx_response(self, response):
+        started = response.request.extensions.get("started_at")
+        if started is not None:
+            self.observe_http_call(self.metrics_service(response.request.url), response.request.method,
+                                   response.status_code, time.perf_counter() - started)
+
+    def observe_container_wait(self, iterations, started, outcome):
+        """Record how many status polls (and how long) an IG container took to leave IN_PROGRESS."""
+        self.metrics.observe("container_poll_iterations", iterations, "Status polls per IG container",
+                             buckets=self.METRICS_POLL_BUCKETS, outcome=outcome)
+        self.metrics.observe("container_processing_seconds", time.time() - started,
+                             "Seconds IG spent processing a container", outcome=outcome)
+        # Journaled with the encode profile so the tuner can learn what Meta processes fastest
+        state = _attempt_state.get(None)
+        if state is not None:
+            state["processing"] = {"seconds": round(time.time() - started, 1), "outcome": outcome}
+
+    def export_metrics(self):
+        """Write the registry to METRICS_TEXTFILE and/or push it to METRICS_PUSHGATEWAY_URL."""
+        payload = self.metrics.render()
+        if self.metrics_textfile:
+            try:
+                os.makedirs(os.path.dirname(self.metrics_textfile) or ".", exist_ok=True)
+                # node_exporter may read at any moment: write aside, then rename atomically
+                tmp_path = f"{self.metrics_textfile}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(payload)
+                os.replace(tmp_path, self.metrics_textfile)
+                self.log_console_only("📈 Metrics written to %s", self.metrics_textfile, level=logging.INFO)
+            except OSError as e:
+                self.log_console_only("⚠️ Could not write metrics textfile: %s", e, level=logging.WARNING)
+        if self.metrics_pushgateway:
+            try:
+                res = requests.put(f"{self.metrics_pushgateway.rstrip('/')}/metrics/job/{self.account_key}",
+                                   data=payload.encode("utf-8"),
+                                   headers={"Content-Type": "text/plain; version=0.0.4"}, timeout=10)
+                if res.status_code >= 300:
+                    self.log_console_only("⚠️ Pushgateway rejected metrics (%s): %s", res.status_code, res.text[:200], level=logging.WARNING)
+            except requests.RequestException as e:
+                self.log_console_only("⚠️ Could not push metrics: %s", e, level=logging.WARNING)
+
+    def start_metrics_server(self):
+        """Serve the live registry on METRICS_PORT at /metrics from a background thread."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self.metrics
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("0.0.0.0", self.metrics_port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        self.log_console_only("📈 Serving live metrics on :%s/metrics", self.metrics_port, level=logging.INFO)
+        return server
 
     def send_token_expiry_info(self):
         """Get comprehensive token expiry info using debug_token endpoint."""
@@ -120,28 +1950,28 @@ class DropboxToInstagramUploader:
     def get_page_access_token(self):
         """Fetch short-lived Page Access Token from long-lived user token."""
         try:
-            self.log_console_only("🔐 Fetching Page Access Token from Meta API...", level=logging.INFO)
+            self.log_console_only("🔐 Fetching Page Access Token from Meta API...", level=logging.INFO, subsystem="graph")
             url = f"https://graph.facebook.com/v18.0/me/accounts"
             params = {"access_token": self.meta_token}
             
-            self.log_console_only(f"📡 API URL: {url}", level=logging.INFO)
+            self.log_console_only("📡 API URL: %s", url, level=logging.INFO, subsystem="graph")
             
             start_time = time.time()
             res = self.session.get(url, params=params)
             request_time = time.time() - start_time
             
-            self.log_console_only(f"⏱️ Page token request completed in {request_time:.2f} seconds", level=logging.INFO)
-            self.log_console_only(f"📊 Response status: {res.status_code}", level=logging.INFO)
+            self.log_console_only("⏱️ Page token request completed in %.2f seconds", request_time, level=logging.INFO, subsystem="graph")
+            self.log_console_only("📊 Response status: %s", res.status_code, level=logging.INFO, subsystem="graph")
 
             if res.status_code != 200:
                 self.send_message(f"❌ Failed to fetch Page token: {res.text}", level=logging.ERROR)
                 return None
 
             pages = res.json().get("data", [])
-            self.log_console_only(f"🔍 Found {len(pages)} pages in user account", level=logging.INFO)
+            self.log_console_only("🔍 Found %s pages in user account", len(pages), level=logging.INFO, subsystem="graph")
             
             # Show all available pages with details (console only)
-            self.log_console_only("📋 Available Pages:", level=logging.INFO)
+            self.log_console_only("📋 Available Pages:", level=logging.INFO, subsystem="graph")
             for i, page in enumerate(pages):
                 page_id = page.get("id", "Unknown")
                 page_name = page.get("name", "Unknown")
@@ -149,38 +1979,37 @@ class DropboxToInstagramUploader:
                 tasks = page.get("tasks", [])
                 page_access_token = page.get("access_token", "Not available")
                 
-                self.log_console_only(f"📄 Page {i+1}:", level=logging.INFO)
-                self.log_console_only(f"   📝 Name: {page_name}", level=logging.INFO)
-                self.log_console_only(f"   🆔 ID: {page_id}", level=logging.INFO)
-                self.log_console_only(f"   📂 Category: {category}", level=logging.INFO)
-                self.log_console_only(f"   🔧 Tasks: {', '.join(tasks)}", level=logging.INFO)
-                self.log_console_only(f"   🔐 Access Token: {page_access_token[:20]}..." if page_access_token != "Not available" else "   🔐 Access Token: Not available", level=logging.INFO)
+                self.log_console_only("📄 Page %s:", i + 1, level=logging.INFO, subsystem="graph")
+                self.log_console_only("   📝 Name: %s", page_name, level=logging.INFO, subsystem="graph")
+                self.log_console_only("   🆔 ID: %s", page_id, level=logging.INFO, subsystem="graph")
+                self.log_console_only("   📂 Category: %s", category, level=logging.INFO, subsystem="graph")
+                self.log_console_only("   🔧 Tasks: %s", ', '.join(tasks), level=logging.INFO, subsystem="graph")
+                self.log_console_only("   🔐 Access Token: %s", 'available' if page_access_token != 'Not available' else 'Not available', level=logging.INFO, subsystem="graph")
                 
                 # Check if this is the target page
                 if page_id == self.fb_page_id:
-                    self.log_console_only(f"   ✅ MATCH FOUND! This is your target page", level=logging.INFO)
+                    self.log_console_only("   ✅ MATCH FOUND! This is your target page", level=logging.INFO, subsystem="graph")
                     
                     # Use the page access token directly from the response
                     if page_access_token and page_access_token != "Not available":
                         self.send_message(f"✅ Page Access Token fetched successfully for: {page_name} (ID: {self.fb_page_id})")
-                        self.log_console_only(f"🔐 Using page access token: {page_access_token[:20]}...", level=logging.INFO)
                         return page_access_token
                     else:
                         self.send_message(f"❌ No access token found for page: {page_name}", level=logging.ERROR)
                         return None
                 else:
-                    self.log_console_only(f"   ❌ Not matching target page ID: {self.fb_page_id}", level=logging.INFO)
+                    self.log_console_only("   ❌ Not matching target page ID: %s", self.fb_page_id, level=logging.INFO, subsystem="graph")
 
             # If no match found, show configuration help
             self.send_message(f"⚠️ Page ID {self.fb_page_id} not found in user's account list.", level=logging.WARNING)
-            self.log_console_only("💡 To fix this, update your FB_PAGE_ID environment variable with one of the page IDs shown above.", level=logging.INFO)
+            self.log_console_only("💡 To fix this, update your FB_PAGE_ID environment variable with one of the page IDs shown above.", level=logging.INFO, subsystem="graph")
             return None
         except Exception as e:
             self.send_message(f"❌ Exception during Page token fetch: {e}", level=logging.ERROR)
             return None
 
     def refresh_dropbox_token(self):
-        self.logger.info("Refreshing Dropbox token...")
+        self.log_console_only("Refreshing Dropbox token...", subsystem='dropbox')
         data = {
             "grant_type": "refresh_token",
             "refresh_token": self.dropbox_refresh,
@@ -190,28 +2019,848 @@ class DropboxToInstagramUploader:
         r = self.session.post(self.DROPBOX_TOKEN_URL, data=data)
         if r.status_code == 200:
             new_token = r.json().get("access_token")
-            self.logger.info("Dropbox token refreshed.")
+            self.dropbox_token_expires_at = time.time() + int(r.json().get("expires_in", 14400))
+            self.log_console_only("Dropbox token refreshed.", subsystem='dropbox')
             return new_token
         else:
             self.send_message("❌ Dropbox refresh failed: " + r.text)
             raise Exception("Dropbox refresh failed.")
 
-    def list_dropbox_files(self, dbx):
+    def list_inbox_files(self, source):
         try:
-            files = dbx.files_list_folder(self.dropbox_folder).entries
+            files = source.list_files(self.inbox_folder)
             valid_exts = ('.mp4', '.mov', '.jpg', '.jpeg', '.png')
-            return [f for f in files if f.name.lower().endswith(valid_exts)]
+            files = [f for f in files if f.name.lower().endswith(valid_exts)]
+            videos = sum(1 for f in files if f.name.lower().endswith(('.mp4', '.mov')))
+            self.metrics.set("backlog_files", videos, "Media files waiting in the inbox", media_type="REELS")
+            self.metrics.set("backlog_files", len(files) - videos, media_type="IMAGE")
+            self.inbox_snapshot = (time.time(), files)
+            return files
         except Exception as e:
-            self.send_message(f"❌ Dropbox folder read failed: {e}", level=logging.ERROR)
+            self.send_message(f"❌ Inbox folder read failed: {e}", level=logging.ERROR)
             return []
 
-    def get_caption_from_config(self):
+    def get_temporary_link(self, source, path, force=False):
+        """Return a temporary link to ``path`` for Meta to fetch, reusing one made within its validity window."""
+        key = path.lower()
+        cached = self.temp_link_cache.get(key)
+        if cached and not force and time.time() - cached[1] < self.TEMP_LINK_TTL - self.TEMP_LINK_REUSE_MARGIN:
+            return cached[0]
+        link = source.temporary_link(path)
+        self.temp_link_cache[key] = (link, time.time())
+        return link
+
+    def check_link_alive(self, url):
+        """Check a media URL with HEAD (or a 1-byte range GET) without downloading the body.
+
+        Returns the HTTP status code, or None if the request itself failed.
+        """
+        try:
+            res = self.session.head(url, allow_redirects=True, timeout=10)
+            if res.status_code in (405, 501):
+                with self.session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=10) as res:
+                    return 200 if res.status_code == 206 else res.status_code
+            return res.status_code
+        except Exception as e:
+            self.log_console_only("❌ Exception checking link: %s", e, level=logging.ERROR, subsystem="dropbox")
+            return None
+
+    def load_state(self, source, name, default):
+        """Load a JSON state document from the state folder of the media source."""
+        try:
+            data = json.loads(source.download(f"{self.state_folder}/{name}"))
+            self.state_snapshots[name] = data
+            return data
+        except MediaSourceError:
+            return default
+        except Exception as e:
+            self.log_console_only("⚠️ Could not load state %s: %s", name, e, level=logging.WARNING, subsystem="dropbox")
+            return default
+
+    def save_state(self, source, name, data):
+        """Persist a JSON state document to the state folder of the media source."""
+        try:
+            payload = json.dumps(data, separators=(",", ":")).encode("utf-8")
+            source.upload(payload, f"{self.state_folder}/{name}")
+            self.state_snapshots[name] = data
+            return True
+        except Exception as e:
+            self.log_console_only("⚠️ Could not save state %s: %s", name, e, level=logging.WARNING, subsystem="dropbox")
+            return False
+
+    def append_journal_entry(self, source, entry):
+        """Append a published-post record to the run journal in the state folder."""
+        with self.state_lock:
+            journal = self.load_state(source, "journal.json", [])
+            journal.append(entry)
+            self.save_state(source, "journal.json", journal)
+        return journal
+
+    def get_local_media(self, source, file):
+        """Local path of a source file's bytes, downloaded at most once into the media cache."""
+        path = self.media_cache.lookup(file.content_hash)
+        self.metrics.inc("media_cache_requests_total", doc="Local media cache lookups", result="hit" if path else "miss")
+        if path:
+            return path
+        path = self.media_cache.fetch(file.content_hash, os.path.splitext(file.name)[1].lower(),
+                                      lambda tmp_path: source.download_to_file(tmp_path, file.path_lower))
+        self.metrics.set("media_cache_bytes", self.media_cache.evict(), "Bytes held in the local media cache")
+        return path
+
+    def compute_media_hashes(self, source, file):
+        """Return perceptual hashes for an image or sampled video frames as [(phash, dhash)]."""
+        from PIL import Image
+        path = self.get_local_media(source, file)
+        if file.name.lower().endswith((".mp4", ".mov")):
+            clip = VideoFileClip(path)
+            try:
+                samples = self.NEAR_DUPLICATE_VIDEO_SAMPLES
+                times = [clip.duration * (i + 0.5) / samples for i in range(samples)]
+                frames = [Image.fromarray(clip.get_frame(t)).convert("L") for t in times]
+            finally:
+                clip.close()
+        else:
+            with self.media_cache.map(path) as mm:
+                frames = [Image.open(mm).convert("L")]
+        return [(compute_phash(frame), compute_dhash(frame)) for frame in frames]
+
+    def build_published_hash_index(self, journal):
+        """Build a BK-tree over the pHashes of every journaled post."""
+        tree = BKTree()
+        for entry in journal:
+            for phash_hex, dhash_hex in entry.get("hashes", []):
+                tree.add(int(phash_hex, 16), (entry.get("file"), int(dhash_hex, 16)))
+        return tree
+
+    def find_near_duplicate(self, hashes, tree):
+        """Return the name of the published file most frames match, or None.
+
+        A frame matches when both its pHash and dHash are within the threshold;
+        a file is a near-duplicate when at least half of its frames match the
+        same published file.
+        """
+        if not hashes or tree.size == 0:
+            return None
+        votes = {}
+        for phash, dhash in hashes:
+            matched = set()
+            for _, (published_name, published_dhash) in tree.search(phash, self.near_duplicate_threshold):
+                if published_name not in matched and hamming_distance(dhash, published_dhash) <= self.near_duplicate_threshold:
+                    matched.add(published_name)
+            for published_name in matched:
+                votes[published_name] = votes.get(published_name, 0) + 1
+        if not votes:
+            return None
+        best_name, best_votes = max(votes.items(), key=lambda kv: kv[1])
+        return best_name if best_votes * 2 >= len(hashes) else None
+
+    def get_filename_tags(self, name):
+        return [tag.lower() for tag in self.FILENAME_TAG_PATTERN.findall(os.path.splitext(name)[0])]
+
+    def get_engagement_tag_weights(self):
+        """Per-tag multipliers from stored IG reach: tag average over overall average, clipped to [0.5, 2]."""
+        if not os.path.exists(self.insights_db):
+            return {}
+        conn = self.open_insights_db()
+        try:
+            rows = conn.execute("""
+                SELECT m.file, i.value FROM media m
+                JOIN insights i ON i.platform = m.platform AND i.media_id = m.media_id
+                WHERE m.platform = 'ig' AND i.metric = 'reach'""").fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return {}
+        overall = sum(value for _, value in rows) / len(rows)
+        if overall <= 0:
+            return {}
+        per_tag = {}
+        for name, value in rows:
+            for tag in self.get_filename_tags(name or ""):
+                per_tag.setdefault(tag, []).append(value)
+        return {tag: min(max(sum(values) / len(values) / overall, 0.5), 2.0) for tag, values in per_tag.items()}
+
+    def selection_key(self, name, added_at, tag_weights):
+        """Time-invariant heap key for a file (lower is better); see PriorityFileIndex."""
+        weight = 1.0
+        for tag in self.get_filename_tags(name):
+            weight *= tag_weights.get(tag, 1.0)
+        return self.selection_age_weight * added_at / 3600 - math.log(max(weight, 1e-6))
+
+    def sync_selection_index(self, source):
+        """Bring the persisted priority index up to date from the media source's change feed."""
+        if self.selection_index is None:
+            self.selection_index = PriorityFileIndex.from_dict(self.load_state(source, "selection_index.json", {}))
+        index = self.selection_index
+
+        tag_weights = dict(self.get_engagement_tag_weights())
+        for tag, weight in self.selection_tag_weights.items():
+            tag_weights[tag.lower()] = tag_weights.get(tag.lower(), 1.0) * float(weight)
+        weights_key = json.dumps([self.selection_age_weight, sorted(tag_weights.items())])
+
+        valid_exts = ('.mp4', '.mov', '.jpg', '.jpeg', '.png')
+        added, removed, cursor, full = source.list_changes(self.inbox_folder, index.cursor)
+        previous = set(index.entries)
+        if full:
+            # No cursor, an expired one, or a store without a change feed: rebuild from the listing
+            index.entries, index.heaps = {}, {}
+        for path in removed:
+            index.remove(path)
+        for entry in added:
+            if entry.name.lower().endswith(valid_exts):
+                media_type = "REELS" if entry.name.lower().endswith((".mp4", ".mov")) else "IMAGE"
+                added_at = entry.server_modified.replace(tzinfo=utc).timestamp()
+                index.add(entry.path_lower, media_type, self.selection_key(entry.name, added_at, tag_weights), added_at)
+        index.cursor = cursor
+        changes = len(previous ^ set(index.entries)) if full else len(added) + len(removed)
+
+        if index.weights_key != weights_key:
+            names = {path: path.rsplit("/", 1)[-1] for path in index.entries}
+            added = {path: entry.get("added_at", 0) for path, entry in index.entries.items()}
+            index.rebuild({path: self.selection_key(names[path], added[path], tag_weights) for path in index.entries})
+            index.weights_key = weights_key
+            self.log_console_only("⚖️ Selection weights changed, re-keyed %s file(s)", len(index.entries), level=logging.INFO, subsystem="dropbox")
+        self.log_console_only("📇 Selection index: %s file(s), %s change(s) since last run", len(index.entries), changes, level=logging.INFO, subsystem="dropbox")
+        self.save_state(source, "selection_index.json", index.to_dict())
+        return index
+
+    def rank_candidates(self, source, files, count):
+        """Return up to ``count`` files in the order the selection strategy prefers them."""
+        if self.selection_strategy != "priority":
+            return random.sample(files, min(len(files), count))
+        try:
+            index = self.sync_selection_index(source)
+        except Exception as e:
+            self.log_console_only("⚠️ Priority selection unavailable, falling back to random: %s", e, level=logging.WARNING, subsystem="media")
+            return random.sample(files, min(len(files), count))
+
+        by_path = {f.path_lower: f for f in files}
+        journal = self.load_state(source, "journal.json", [])
+        last_type = journal[-1].get("media_type") if journal else None
+        rotation = list(self.SELECTION_ROTATION)
+        if last_type in rotation:
+            start = (rotation.index(last_type) + 1) % len(rotation)
+            rotation = rotation[start:] + rotation[:start]
+
+        ranked = []
+        for media_type in rotation:
+            ranked += index.top(media_type, count - len(ranked), by_path)
+            if len(ranked) >= count:
+                break
+        candidates = [by_path[path] for path in ranked]
+        if not candidates:
+            return random.sample(files, min(len(files), count))
+        self.log_console_only("🏆 Priority candidates: %s", ', '.join((f.name for f in candidates)), level=logging.INFO, subsystem="media")
+        return candidates
+
+    def select_non_duplicate_file(self, source, files):
+        """Pick a file via the selection strategy, skipping or flagging near-duplicates of published media.
+
+        Returns (file, hashes). Hashes are cached by Dropbox content_hash so
+        each file is only hashed once across runs.
+        """
+        if self.near_duplicate_mode not in ("flag", "skip"):
+            return self.rank_candidates(source, files, 1)[0], None
+
+        journal = self.load_state(source, "journal.json", [])
+        tree = self.build_published_hash_index(journal)
+        hash_cache = self.load_state(source, "media_hashes.json", {})
+        cache_dirty = False
+        candidates = self.rank_candidates(source, files, self.NEAR_DUPLICATE_MAX_CANDIDATES)
+        self.log_console_only("🧬 Near-duplicate check against %s published hashes (%s candidates)", tree.size, len(candidates), level=logging.INFO, subsystem="media")
+
+        for file in candidates:
+            cached = hash_cache.get(file.content_hash)
+            if cached is not None:
+                hashes = [(int(p, 16), int(d, 16)) for p, d in cached]
+            else:
+                try:
+                    start_time = time.time()
+                    hashes = self.compute_media_hashes(source, file)
+                    self.log_console_only("⏱️ Hashed %s in %.2f seconds", file.name, time.time() - start_time, level=logging.INFO, subsystem="media")
+                except Exception as e:
+                    self.log_console_only("⚠️ Could not hash %s: %s", file.name, e, level=logging.WARNING, subsystem="media")
+                    return file, None
+                hash_cache[file.content_hash] = [[f"{p:016x}", f"{d:016x}"] for p, d in hashes]
+                cache_dirty = True
+
+            duplicate_of = self.find_near_duplicate(hashes, tree)
+            if not duplicate_of:
+                break
+            if self.near_duplicate_mode == "flag":
+                self.send_message(f"⚠️ Near-duplicate detected: {file.name} looks like already published {duplicate_of}", level=logging.WARNING)
+                break
+            # Claim first so only one concurrent runner moves (and reports) the duplicate
+            claimed = self.claim_file(source, file)
+            if claimed is not None:
+                self.send_message(f"♻️ Skipping near-duplicate: {file.name} looks like already published {duplicate_of}", level=logging.WARNING)
+                try:
+                    source.move(claimed.path_lower, f"{self.duplicates_folder}/{file.name}", autorename=True)
+                except Exception as e:
+                    # Left in the claim folder; release_claim keeps it for the reaper to return
+                    self.log_console_only("⚠️ Failed to move duplicate %s: %s", file.name, e, level=logging.WARNING, subsystem="media")
+            files = [f for f in files if f.path_lower != file.path_lower]
+        else:
+            file = self.rank_candidates(source, files, 1)[0] if files else None
+            hashes = None
+
+        if cache_dirty:
+            self.save_state(source, "media_hashes.json", hash_cache)
+        return file, hashes
+
+    def video_needs_transcode(self, source, file):
+        """Decide from source metadata and a small range read whether a video is out of Reels spec."""
+        width, height, duration = self.get_video_metadata(source, file)
+        if not width or not height or not duration:
+            return True, "metadata unavailable"
+        aspect_ratio = width / height
+        if abs(aspect_ratio - 0.5625) >= 0.01 or not 960 <= height <= 1920:
+            return True, f"{width}x{height} is not 9:16 within 540x960–1080x1920"
+        bitrate_kbps = file.size * 8 / 1000 / duration
+        if bitrate_kbps > self.transcode_max_bitrate_kbps:
+            return True, f"bitrate {bitrate_kbps:.0f}kbps exceeds {self.transcode_max_bitrate_kbps}kbps"
+        local_path = self.media_cache.lookup(file.content_hash)
+        if local_path:
+            with self.media_cache.map(local_path) as mm:
+                head = mm[:self.FASTSTART_PROBE_BYTES]
+        else:
+            temp_link = self.get_temporary_link(source, file.path_lower)
+            res = self.session.get(temp_link, headers={"Range": f"bytes=0-{self.FASTSTART_PROBE_BYTES - 1}"}, timeout=30)
+            head = res.content[:self.FASTSTART_PROBE_BYTES] if res.status_code in (200, 206) else None
+        if head is not None and not mp4_has_faststart(head):
+            return True, "moov atom is not at the start of the file"
+        return False, "compliant"
+
+    def pretranscode_videos(self, source, file, files):
+        """Normalize the selected video (plus a few upcoming ones) in a process pool.
+
+        Normalized outputs are uploaded to the .normalized folder and cached by
+        Dropbox content_hash so each source is transcoded at most once. Returns
+        the metadata of the file that should be posted in place of ``file``.
+        """
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        video_exts = (".mp4", ".mov")
+        if self.transcode_mode not in ("pad", "crop"):
+            if file.name.lower().endswith(video_exts):
+                self.note_encode(file, "original")
+            return file
+
+        cache = self.load_state(source, "transcode_cache.json", {})
+        tuner = None
+        if self.encode_tuner_enabled:
+            tuner = EncodeProfileTuner(self.load_state(source, "journal.json", []), self.transcode_max_bitrate_kbps,
+                                       self.encode_tuner_min_samples, self.encode_tuner_explore)
+        upcoming = [f for f in files if f.path_lower != file.path_lower and f.name.lower().endswith(video_exts)]
+        queue = [file] if file.name.lower().endswith(video_exts) else []
+        queue += random.sample(upcoming, min(len(upcoming), self.transcode_prefetch))
+
+        pending = []
+        for video in queue:
+            if video.content_hash in cache:
+                continue
+            try:
+                needed, reason = self.video_needs_transcode(source, video)
+            except Exception as e:
+                needed, reason = True, f"compliance check failed: {e}"
+            profile = "balanced" if needed else "original"
+            if tuner:
+                try:
+                    _, _, duration = self.get_video_metadata(source, video)
+                    if duration:
+                        profile, why = tuner.choose(duration, video.size * 8 / 1000 / duration, allow_original=not needed)
+                        self.log_console_only("🎛️ Encode profile for %s: %s (%s)", video.name, profile, why, level=logging.INFO, subsystem="media")
+                except Exception as e:
+                    self.log_console_only("⚠️ Encode tuner failed for %s: %s", video.name, e, level=logging.WARNING, subsystem="media")
+            if profile == "original":
+                cache[video.content_hash] = {"path": None, "profile": "original"}
+                continue
+            self.log_console_only("🎞️ Queueing %s transcode for %s: %s", profile, video.name, reason, level=logging.INFO, subsystem="media")
+            pending.append((video, profile))
+
+        if pending:
+            temp_dir = tempfile.mkdtemp(prefix=f"{MediaCache.TEMP_PREFIX}transcode_")
+            stage_start = time.time()
+            with ProcessPoolExecutor(max_workers=min(self.transcode_workers, len(pending))) as pool:
+                futures = {}
+                for video, profile in pending:
+                    dst_path = os.path.join(temp_dir, f"{video.content_hash}.mp4")
+                    try:
+                        src_path = self.get_local_media(source, video)
+                    except Exception as e:
+                        self.log_console_only("⚠️ Download for transcode failed for %s: %s", video.name, e, level=logging.WARNING, subsystem="media")
+                        continue
+                    future = pool.submit(transcode_to_reel_spec, src_path, dst_path, self.transcode_mode,
+                                         **EncodeProfileTuner.profile(profile, self.transcode_max_bitrate_kbps))
+                    futures[future] = (video, profile, src_path, dst_path)
+
+                for future in as_completed(futures):
+                    video, profile, src_path, dst_path = futures[future]
+                    try:
+                        info = future.result()
+                        info["profile"] = profile
+                        base_name = os.path.splitext(video.name)[0]
+                        target = f"{self.normalized_folder}/{video.content_hash}/{base_name}.mp4"
+                        with open(dst_path, "rb") as f:
+                            source.upload(f.read(), target)
+                        info["path"] = target
+                        cache[video.content_hash] = info
+                        self.log_console_only("✅ Normalized %s → %sx%s (%.2fMB → %.2fMB)", video.name, info['width'], info['height'], os.path.getsize(src_path) / 1024 / 1024, os.path.getsize(dst_path) / 1024 / 1024, level=logging.INFO, subsystem="media")
+                    except Exception as e:
+                        self.log_console_only("⚠️ Transcode failed for %s: %s", video.name, e, level=logging.WARNING, subsystem="media")
+                    finally:
+                        if os.path.exists(dst_path):
+                            os.remove(dst_path)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            self.log_console_only("⏱️ Transcode stage finished in %.2f seconds", time.time() - stage_start, level=logging.INFO, subsystem="media")
+            self.save_state(source, "transcode_cache.json", cache)
+        elif queue:
+            self.save_state(source, "transcode_cache.json", cache)
+
+        is_video = file.name.lower().endswith(video_exts)
+        entry = cache.get(file.content_hash)
+        if not entry or not entry.get("path"):
+            if is_video:
+                self.note_encode(file, "original")
+            return file
+        try:
+            normalized = source.get_metadata(entry["path"])
+        except Exception as e:
+            self.log_console_only("⚠️ Normalized copy missing for %s, posting original: %s", file.name, e, level=logging.WARNING, subsystem="media")
+            self.note_encode(file, "original")
+            return file
+        self.note_encode(normalized, entry.get("profile", "balanced"), entry)
+        self.media_info_overrides[normalized.path_lower] = (entry["width"], entry["height"], entry["duration"])
+        self.derived_sources[normalized.path_lower] = file.content_hash
+        self.log_console_only("🎞️ Posting normalized copy: %s", entry['path'], level=logging.INFO, subsystem="media")
+        return normalized
+
+    def note_encode(self, file, profile, info=None):
+        """Remember which file goes out with which encode profile; the tuner samples it once published."""
+        if not self.encode_tuner_enabled:
+            return
+        state = _attempt_state.get(None)
+        if state is not None:
+            state["encode"] = {"profile": profile, "path": file.path_lower}
+            if info is not None:
+                state["encode"].update({key: info.get(key) for key in self.ENCODE_SAMPLE_KEYS})
+
+    def sample_encode(self, source, encode):
+        """The encode tuner's sample of a published video: its profile and measured properties, or None."""
+        sample = {key: value for key, value in encode.items() if key != "path"}
+        if "duration" in sample or not encode.get("path"):
+            return sample
+        try:
+            file = source.get_metadata(encode["path"])
+            width, height, duration = self.get_video_metadata(source, file)
+            sample.update({"width": width, "height": height, "duration": duration,
+                           "bitrate_kbps": round(file.size * 8 / 1000 / duration) if duration else None})
+            # GOP structure needs the bytes; only probe copies the cache already holds
+            local_path = self.media_cache.lookup(file.content_hash)
+            sample["keyframe_interval"] = probe_keyframe_interval(local_path, duration) if local_path and duration else None
+            return sample
+        except Exception as e:
+            self.log_console_only("⚠️ Could not record encode properties of %s: %s", encode["path"], e, level=logging.WARNING, subsystem="media")
+            return None
+
+    def prepare_images(self, source, file, files):
+        """Optimize the selected image (plus a few upcoming ones) in a worker pool.
+
+        Optimized JPEGs are uploaded to the .optimized folder and cached by
+        Dropbox content_hash. Returns the metadata of the file that should be
+        posted in place of ``file``.
+        """
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        if self.image_prep_mode not in ("crop", "pad"):
+            return file
+
+        image_exts = (".jpg", ".jpeg", ".png")
+        cache = self.load_state(source, "image_cache.json", {})
+        upcoming = [f for f in files if f.path_lower != file.path_lower and f.name.lower().endswith(image_exts)]
+        queue = [file] if file.name.lower().endswith(image_exts) else []
+        queue += random.sample(upcoming, min(len(upcoming), self.image_prep_prefetch))
+        pending = [image for image in queue if image.content_hash not in cache]
+
+        if pending:
+            stage_start = time.time()
+            total_before = total_after = 0
+            with ProcessPoolExecutor(max_workers=min(self.image_prep_workers, len(pending))) as pool:
+                futures = {}
+                for image in pending:
+                    try:
+                        local_path = self.get_local_media(source, image)
+                    except Exception as e:
+                        self.log_console_only("⚠️ Download for optimization failed for %s: %s", image.name, e, level=logging.WARNING, subsystem="media")
+                        continue
+                    future = pool.submit(optimize_image_for_instagram, local_path, self.image_prep_mode, self.IMAGE_MAX_WIDTH, self.IMAGE_JPEG_QUALITY)
+                    futures[future] = (image, os.path.getsize(local_path), time.time())
+
+                for future in as_completed(futures):
+                    image, before_bytes, submitted = futures[future]
+                    try:
+                        jpeg_bytes, width, height = future.result()
+                        latency = time.time() - submitted
+                        base_name = os.path.splitext(image.name)[0]
+                        target = f"{self.optimized_folder}/{image.content_hash}/{base_name}.jpg"
+                        source.upload(jpeg_bytes, target)
+                        cache[image.content_hash] = {"path": target, "width": width, "height": height,
+                                                     "bytes_before": before_bytes, "bytes_after": len(jpeg_bytes)}
+                        total_before += before_bytes
+                        total_after += len(jpeg_bytes)
+                        self.log_console_only("🖼️ Optimized %s → %sx%s progressive JPEG (%.0fKB → %.0fKB) in %.2f seconds", image.name, width, height, before_bytes / 1024, len(jpeg_bytes) / 1024, latency, level=logging.INFO, subsystem="media")
+                    except Exception as e:
+                        self.log_console_only("⚠️ Image optimization failed for %s: %s", image.name, e, level=logging.WARNING, subsystem="media")
+            if total_before:
+                self.log_console_only("📊 Image prep stage: %s images, %.0fKB → %.0fKB (%.1f%% saved) in %.2f seconds", len(futures), total_before / 1024, total_after / 1024, 100 * (1 - total_after / total_before), time.time() - stage_start, level=logging.INFO, subsystem="media")
+            self.save_state(source, "image_cache.json", cache)
+
+        entry = cache.get(file.content_hash)
+        if not entry or not entry.get("path"):
+            return file
+        try:
+            optimized = source.get_metadata(entry["path"])
+        except Exception as e:
+            self.log_console_only("⚠️ Optimized copy missing for %s, posting original: %s", file.name, e, level=logging.WARNING, subsystem="media")
+            return file
+        self.media_info_overrides[optimized.path_lower] = (entry["width"], entry["height"], None)
+        self.derived_sources[optimized.path_lower] = file.content_hash
+        self.log_console_only("🖼️ Posting optimized copy: %s", entry['path'], level=logging.INFO, subsystem="media")
+        return optimized
+
+    def get_reel_cover(self, source, file, video_url):
+        """Return {"url", "offset_ms"} for the best-scoring cover keyframe, or None.
+
+        Candidates are grabbed straight from the Dropbox temp link, scored with
+        NumPy, and the winner is cached in Dropbox by the source content_hash.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        if not self.reel_cover_enabled:
+            return None
+        source_hash = self.derived_sources.get(file.path_lower, file.content_hash)
+        cache = self.load_state(source, "cover_cache.json", {})
+        entry = cache.get(source_hash)
+        if entry is None:
+            _, _, duration = self.get_video_metadata(source, file)
+            if not duration:
+                self.log_console_only("⚠️ Video duration unknown, skipping cover extraction", level=logging.WARNING, subsystem="media")
+                return None
+            stage_start = time.time()
+            offsets = [duration * fraction for fraction in self.REEL_COVER_CANDIDATE_OFFSETS]
+
+            # Seek in the local copy when another stage already fetched it
+            frame_source = self.media_cache.lookup(file.content_hash) or video_url
+
+            def grab(offset):
+                try:
+                    jpeg_bytes = extract_keyframe_jpeg(frame_source, offset)
+                    return offset, jpeg_bytes, score_cover_frame(jpeg_bytes)
+                except Exception as e:
+                    self.log_console_only("⚠️ Cover frame at %.1fs failed: %s", offset, e, level=logging.WARNING)
+                    return offset, None, -1.0
+
+            with ThreadPoolExecutor(max_workers=len(offsets)) as pool:
+                candidates = [c for c in pool.map(grab, offsets) if c[1]]
+            if not candidates:
+                return None
+            offset, jpeg_bytes, score = max(candidates, key=lambda c: c[2])
+            path = f"{self.covers_folder}/{source_hash}/cover.jpg"
+            try:
+                source.upload(jpeg_bytes, path)
+            except Exception as e:
+                self.log_console_only("⚠️ Could not upload cover frame: %s", e, level=logging.WARNING, subsystem="media")
+                return None
+            entry = {"path": path, "offset_ms": int(offset * 1000), "score": score}
+            cache[source_hash] = entry
+            self.save_state(source, "cover_cache.json", cache)
+            self.log_console_only("🖼️ Cover frame chosen at %.1fs (score %.4f) from %s candidates in %.2f seconds", offset, score, len(candidates), time.time() - stage_start, level=logging.INFO, subsystem="media")
+        try:
+            cover_url = self.get_temporary_link(source, entry["path"])
+        except Exception as e:
+            self.log_console_only("⚠️ Cached cover missing, using offset only: %s", e, level=logging.WARNING, subsystem="media")
+            cover_url = None
+        return {"url": cover_url, "offset_ms": entry["offset_ms"], "path": entry["path"]}
+
+    def discard_derived_copies(self, source, file):
+        """Remove normalized/optimized copies and their cache entries once the source file is gone."""
+        for enabled, cache_name, folder in (
+            (self.transcode_mode in ("pad", "crop"), "transcode_cache.json", self.normalized_folder),
+            (self.image_prep_mode in ("crop", "pad"), "image_cache.json", self.optimized_folder),
+            (self.reel_cover_enabled, "cover_cache.json", self.covers_folder),
+        ):
+            if not enabled:
+                continue
+            cache = self.load_state(source, cache_name, {})
+            entry = cache.pop(file.content_hash, None)
+            if entry is None:
+                continue
+            if entry.get("path"):
+                try:
+                    source.delete(f"{folder}/{file.content_hash}")
+                except Exception as e:
+                    self.log_console_only("⚠️ Failed to delete derived copy for %s: %s", file.name, e, level=logging.WARNING, subsystem="dropbox")
+            self.save_state(source, cache_name, cache)
+
+    def write_claim_lease(self, source):
+        """Create or extend this run's lease on its claim folder."""
+        now = time.time()
+        lease = {"run_id": self.run_id, "claimed_at": now, "expires_at": now + self.claim_lease_seconds}
+        try:
+            source.upload(json.dumps(lease).encode("utf-8"), f"{self.claim_folder}/lease.json")
+            return True
+        except Exception as e:
+            self.log_console_only("⚠️ Could not write claim lease: %s", e, level=logging.WARNING, subsystem="dropbox")
+            return False
+
+    def start_lease_heartbeat(self, source):
+        """Renew the lease in the background until release_claim, so slow transcodes and container polls never outlive it."""
+        if self.lease_heartbeat is not None:
+            return
+        stop = self.lease_heartbeat = threading.Event()
+        # Renew well before expiry so one failed write doesn't let a concurrent runner reap in-flight files
+        interval = max(self.claim_lease_seconds / 3, 1)
+
+        def beat():
+            while not stop.wait(interval):
+                with self.lease_lock:
+                    # release_claim may have stopped us while we waited for the lock
+                    if not stop.is_set():
+                        self.write_claim_lease(source)
+
+        threading.Thread(target=beat, name="claim-lease", daemon=True).start()
+
+    def claim_file(self, source, file):
+        """Atomically move a file into this run's claim folder.
+
+        Returns the claimed file's metadata, or None if another runner got it first.
+        """
+        try:
+            claimed = source.move(file.path_lower, f"{self.claim_folder}/{file.name}")
+            self.log_console_only("🔒 Claimed %s for run %s", file.name, self.run_id, level=logging.INFO, subsystem="dropbox")
+            return claimed
+        except MediaSourceError as e:
+            self.log_console_only("⚠️ Could not claim %s (already taken?): %s", file.name, e, level=logging.WARNING, subsystem="dropbox")
+            return None
+
+    def claim_selected_files(self, source, files):
+        """Select and claim one file plus its carousel siblings.
+
+        Returns (claimed_file, claimed_group, hashes, carousel_prefix); claimed_file is None when nothing could be claimed.
+        """
+        if not self.write_claim_lease(source):
+            return None, [], None, None
+        self.start_lease_heartbeat(source)
+        for _ in range(self.CLAIM_MAX_ATTEMPTS):
+            file, hashes = self.select_non_duplicate_file(source, files)
+            if file is None:
+                break
+            carousel_prefix, group = self.get_carousel_group(file, files)
+            claimed = self.claim_file(source, file)
+            if claimed is None:
+                files = [f for f in files if f.path_lower != file.path_lower]
+                if not files:
+                    break
+                continue
+            claimed_group = []
+            for item in group:
+                if item.path_lower == file.path_lower:
+                    claimed_group.append(claimed)
+                else:
+                    claimed_item = self.claim_file(source, item)
+                    if claimed_item is not None:
+                        claimed_group.append(claimed_item)
+            if len(claimed_group) < 2:
+                carousel_prefix, claimed_group = None, [claimed]
+            return claimed, claimed_group, hashes, carousel_prefix
+        return None, [], None, None
+
+    def release_claim(self, source):
+        """Stop renewing and drop the lease; the claim folder itself goes only once nothing else is in it.
+
+        Files a failed settle left behind stay in the lease-less folder, which
+        the next reap_stale_claims returns to the inbox.
+        """
+        with self.lease_lock:
+            if self.lease_heartbeat is not None:
+                self.lease_heartbeat.set()
+                self.lease_heartbeat = None
+        try:
+            source.delete(f"{self.claim_folder}/lease.json")
+            left = source.list_files(self.claim_folder)
+            if left:
+                self.send_message(f"⚠️ {len(left)} file(s) left in {self.claim_folder}; they return to the inbox on the next reap", level=logging.WARNING)
+                return
+            source.delete(self.claim_folder)
+        except MediaSourceError as e:
+            if not e.not_found:
+                self.log_console_only("⚠️ Could not release claim folder %s: %s", self.claim_folder, e, level=logging.WARNING, subsystem="dropbox")
+
+    def reap_stale_claims(self, source):
+        """Return files from expired claim folders to the inbox so crashed runs don't lose media."""
+        try:
+            claims = source.list_folders(self.claims_folder)
+        except MediaSourceError:
+            return 0
+        reaped = 0
+        now = time.time()
+        for claim in claims:
+            # Our own folder only while we hold it; in daemon mode a released one can hold leftovers
+            if claim.path_lower == self.claim_folder.lower() and self.lease_heartbeat is not None:
+                continue
+            try:
+                expires_at = json.loads(source.download(f"{claim.path_lower}/lease.json"))["expires_at"]
+            except MediaSourceError as e:
+                if not e.not_found:
+                    # Unknown is not expired: reaping a live claim would double-post its files
+                    self.log_console_only("⚠️ Could not read lease of claim %s: %s", claim.name, e, level=logging.WARNING, subsystem="dropbox")
+                    continue
+                expires_at = 0
+            except (ValueError, KeyError, TypeError) as e:
+                self.log_console_only("⚠️ Unreadable lease in claim %s, leaving it: %s", claim.name, e, level=logging.WARNING, subsystem="dropbox")
+                continue
+            if expires_at > now:
+                continue
+            try:
+                returned = 0
+                for entry in source.list_files(claim.path_lower):
+                    if entry.name == "lease.json":
+                        continue
+                    source.move(entry.path_lower, f"{self.inbox_folder}/{entry.name}", autorename=True)
+                    returned += 1
+                source.delete(claim.path_lower)
+                reaped += returned
+                self.send_message(f"♻️ Reaped expired claim {claim.name}: returned {returned} file(s) to {self.inbox_folder}", level=logging.WARNING)
+            except MediaSourceError as e:
+                # Another runner is reaping the same claim
+                self.log_console_only("⚠️ Could not reap claim %s: %s", claim.name, e, level=logging.WARNING, subsystem="dropbox")
+        return reaped
+
+    def classify_graph_error(self, status_code, error):
+        """Classify a Graph error as "transient", "media_invalid" or "permanent"."""
+        code = error.get("code")
+        subcode = error.get("error_subcode")
+        if subcode in self.GRAPH_MEDIA_INVALID_SUBCODES or code in self.GRAPH_MEDIA_INVALID_CODES:
+            return "media_invalid"
+        if (error.get("is_transient") or status_code >= 500 or status_code == 429
+                or code in self.GRAPH_TRANSIENT_CODES or subcode in self.GRAPH_TRANSIENT_SUBCODES):
+            return "transient"
+        return "permanent"
+
+    def record_graph_failure(self, stage, res):
+        """Remember the classified failure of a Graph call for the retry decision."""
+        try:
+            error = res.json().get("error", {})
+        except ValueError:
+            error = {}
+        self.last_failure = {
+            "stage": stage,
+            "category": self.classify_graph_error(res.status_code, error),
+            "status": res.status_code,
+            "code": error.get("code"),
+            "subcode": error.get("error_subcode"),
+            "message": error.get("message", res.text[:200]),
+        }
+        self.log_console_only("🏷️ Failure at %s classified as %s (code %s, subcode %s)", stage, self.last_failure['category'], self.last_failure['code'], self.last_failure['subcode'], level=logging.INFO, subsystem="graph")
+
+    def record_exception_failure(self, stage, exc):
+        """Classify an exception raised outside a Graph response (network, Dropbox, media probing)."""
+        self.last_failure = {
+            "stage": stage,
+            "category": "transient",
+            "status": None,
+            "code": None,
+            "subcode": None,
+            "message": str(exc)[:200],
+        }
+
+    def filter_retry_backoff(self, source, files):
+        """Drop files whose retry backoff has not elapsed yet."""
+        queue = self.load_state(source, "retry_queue.json", {})
+        now = time.time()
+        waiting = {h for h, entry in queue.items() if entry.get("next_attempt_at", 0) > now}
+        if waiting:
+            self.log_console_only("⏳ %s file(s) in retry backoff", len(waiting), level=logging.INFO, subsystem="dropbox")
+        return [f for f in files if f.content_hash not in waiting]
+
+    def drop_skipped_files(self, files):
+        """Drop files held back with the Telegram /skip command."""
+        if not self.skipped_files:
+            return files
+        kept = [f for f in files if f.name.lower() not in self.skipped_files]
+        if len(kept) < len(files):
+            self.log_console_only("⏭️ %s file(s) skipped via /skip", len(files) - len(kept), level=logging.INFO)
+        return kept
+
+    def remember_facebook_post(self, source, file, fb):
+        """Record that ``file`` is already live on Facebook, so its retry posts to Instagram only."""
+        with self.state_lock:
+            queue = self.load_state(source, "retry_queue.json", {})
+            queue.setdefault(file.content_hash, {"file": file.name, "attempts": 0})["fb"] = fb
+            self.save_state(source, "retry_queue.json", queue)
+        self.send_message(f"📘 Facebook {fb['kind']} {fb['id']} for {file.name} is already live; its retry posts to Instagram only", level=logging.WARNING)
+
+    def facebook_post_on_record(self, source, file):
+        """The Facebook post a retried file already went out as, noted on the attempt for the journal; None if any."""
+        fb = self.load_state(source, "retry_queue.json", {}).get(file.content_hash, {}).get("fb")
+        if fb:
+            self.note_post_id("fb", fb["id"], kind=fb["kind"])
+            self.log_console_only("📘 %s is already on Facebook as %s %s; skipping Facebook", file.name, fb["kind"], fb["id"], level=logging.INFO, subsystem="graph")
+        return fb
+
+    def settle_facebook_for_unpublished(self, source, file, fb, page_token):
+        """Keep Facebook in step when a staged Instagram post will not go out: cancel its scheduled post, or remember it if it is live."""
+        if fb["scheduled_at"] > time.time() and page_token and self.cancel_facebook_post(fb, page_token):
+            return
+        self.remember_facebook_post(source, file, fb)
+
+    def settle_attempt(self, source, group, success):
+        """Delete, requeue or dead-letter the claimed files according to the attempt's outcome."""
+        with self.state_lock:
+            queue = self.load_state(source, "retry_queue.json", {})
+            failure = self.last_failure or {"category": "transient", "stage": "unknown", "message": "no error recorded"}
+            key = group[0].content_hash
+            entry = queue.pop(key, {"file": group[0].name, "attempts": 0})
+            entry["attempts"] += 1
+            entry["last_error"] = failure
+
+            if success:
+                action, target = "delete", None
+            elif failure["category"] == "media_invalid":
+                action, target = "delete", None
+            elif failure["category"] == "permanent" or entry["attempts"] >= self.retry_max_attempts:
+                action, target = "dead_letter", self.dead_letter_folder
+            else:
+                action, target = "retry", self.inbox_folder
+                delay = min(self.RETRY_BACKOFF_BASE_SECONDS * 2 ** (entry["attempts"] - 1), self.RETRY_BACKOFF_MAX_SECONDS)
+                entry["next_attempt_at"] = time.time() + delay
+                queue[key] = entry
+
+            for item in group:
+                try:
+                    if action == "delete":
+                        source.delete(item.path_lower)
+                        self.log_console_only("🗑️ Deleted file after attempt: %s", item.name, subsystem="dropbox")
+                    else:
+                        source.move(item.path_lower, f"{target}/{item.name}", autorename=True)
+                except Exception as e:
+                    self.log_console_only("⚠️ Failed to %s file %s: %s", action.replace('_', '-'), item.name, e, level=logging.WARNING, subsystem="dropbox")
+                if action != "retry":
+                    self.discard_derived_copies(source, item)
+
+            if action == "retry":
+                self.send_message(f"🔁 {group[0].name} queued for retry ({entry['attempts']}/{self.retry_max_attempts}) after {failure['category']} failure at {failure['stage']}: {failure['message']}", level=logging.WARNING)
+            elif action == "dead_letter":
+                self.send_message(f"📮 {group[0].name} moved to {self.dead_letter_folder} after {entry['attempts']} attempt(s): {failure['category']} failure at {failure['stage']}: {failure['message']}", level=logging.ERROR)
+            elif not success:
+                self.send_message(f"🗑️ {group[0].name} discarded: media rejected at {failure['stage']}: {failure['message']}", level=logging.ERROR)
+            self.save_state(source, "retry_queue.json", queue)
+            return action
+
+    def get_caption_from_config(self, day=None):
         try:
             with open(self.schedule_file, 'r') as f:
                 config = json.load(f)
             
-            # Get today's caption from config
-            today = datetime.now(self.ist).strftime("%A")
+            # Get today's (or the given slot's) caption from config
+            today = (day or datetime.now(self.ist)).strftime("%A")
             day_config = config.get(self.account_key, {}).get(today, {})
             
             caption = day_config.get("caption", "✨ #inkwisps ✨")
@@ -231,229 +2880,356 @@ class DropboxToInstagramUploader:
         first_line = base_name[:100]
         return f"{first_line}\n\n{original_caption}"
 
-    def post_to_instagram(self, dbx, file, caption, description):
-        name = file.name
-        ext = name.lower()
-        media_type = "REELS" if ext.endswith((".mp4", ".mov")) else "IMAGE"
-
-        self.send_message(f"🚀 Starting upload process for: {name}", level=logging.INFO)
-        
-        temp_link = dbx.files_get_temporary_link(file.path_lower).link
-        file_size = f"{file.size / 1024 / 1024:.2f}MB"
-        total_files = len(self.list_dropbox_files(dbx))
-
-        self.log_console_only(f"📸 Instagram upload details:\n📂 Type: {media_type}\n📐 Size: {file_size}\n📦 Remaining: {total_files}")
-
+    def get_verified_page_token(self):
+        """Fetch the Page token and check it and the IG connection; None on failure."""
         # Get Facebook page access token for both Instagram and Facebook
-        self.log_console_only("🔐 Step 1: Retrieving Facebook Page Access Token...", level=logging.INFO)
+        self.log_console_only("🔐 Step 1: Retrieving Facebook Page Access Token...", level=logging.INFO, subsystem="graph")
         page_token = self.get_page_access_token()
         if not page_token:
             self.send_message("❌ Could not retrieve Facebook Page access token. Aborting upload.", level=logging.ERROR)
-            return False
+            return None
 
-        self.log_console_only("✅ Facebook Page Access Token retrieved successfully", level=logging.INFO)
+        self.log_console_only("✅ Facebook Page Access Token retrieved successfully", level=logging.INFO, subsystem="graph")
 
         # Test the page token to ensure it works
         if not self.test_page_token(page_token):
             self.send_message("❌ Page token test failed. Aborting upload.", level=logging.ERROR)
-            return False
+            return None
 
         # Check if Instagram is properly connected to the Facebook page
         if not self.check_instagram_page_connection(page_token):
             self.send_message("❌ Instagram account not properly connected to Facebook page. Aborting upload.", level=logging.ERROR)
-            return False
-
-        # Build captions with file name as first line
-        caption = self.build_caption_with_filename(file, caption)
-        description = self.build_caption_with_filename(file, description)
-
-        upload_url = f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media"
-        data = {
-            "access_token": page_token,
-            "caption": caption
-        }
+            return None
+        return page_token
 
-        if media_type == "REELS":
-            data.update({"media_type": "REELS", "video_url": temp_link, "share_to_feed": "true"})
-        else:
-            data["image_url"] = temp_link
+    def get_carousel_group(self, file, files):
+        """Return (prefix, files) for the carousel ``file`` belongs to, or (None, [file])."""
+        match = self.CAROUSEL_NAME_PATTERN.match(os.path.splitext(file.name)[0])
+        if not match:
+            return None, [file]
+        prefix = match.group("prefix")
+        group = []
+        for f in files:
+            m = self.CAROUSEL_NAME_PATTERN.match(os.path.splitext(f.name)[0])
+            if m and m.group("prefix") == prefix:
+                group.append((int(m.group("index")), f))
+        group = [f for _, f in sorted(group, key=lambda item: item[0])]
+        if len(group) < 2:
+            return None, [file]
+        if len(group) > self.CAROUSEL_MAX_ITEMS:
+            self.log_console_only("⚠️ Carousel %s has %s files, posting the first %s", prefix, len(group), self.CAROUSEL_MAX_ITEMS, level=logging.WARNING)
+            group = group[:self.CAROUSEL_MAX_ITEMS]
+        return prefix, group
 
-        self.log_console_only("🔄 Step 2: Sending media creation request to Instagram API...", level=logging.INFO)
-        self.log_console_only(f"📡 API URL: {upload_url}", level=logging.INFO)
-        
-        start_time = time.time()
-        res = self.session.post(upload_url, data=data)
-        request_time = time.time() - start_time
-        
-        self.log_console_only(f"⏱️ API request completed in {request_time:.2f} seconds", level=logging.INFO)
-        self.log_console_only(f"📊 Response status: {res.status_code}", level=logging.INFO)
-        
-        if res.status_code != 200:
-            err = res.json().get("error", {}).get("message", "Unknown")
-            code = res.json().get("error", {}).get("code", "N/A")
-            self.send_message(f"❌ Instagram upload failed: {name}\n📸 Error: {err}\n📸 Code: {code}\n📸 Status: {res.status_code}", level=logging.ERROR)
-            return False, media_type
+    def poll_container_statuses(self, creation_ids, page_token):
+        """Poll several IG containers with one multi-ID request per tick until all are FINISHED.
 
-        creation_id = res.json().get("id")
-        if not creation_id:
-            self.send_message(f"❌ No media ID returned for: {name}", level=logging.ERROR)
-            return False, media_type
+        Returns True when every container finished, False on ERROR or timeout.
+        """
+        return self.wait_for_containers(creation_ids, page_token)[0]
 
-        self.log_console_only(f"✅ Media creation successful! Creation ID: {creation_id}", level=logging.INFO)
+    def wait_for_containers(self, creation_ids, page_token, optional=()):
+        """Multi-ID container polling; IDs in ``optional`` (story containers) ride along.
 
-        if media_type == "REELS":
-            self.log_console_only("⏳ Step 3: Processing video for Instagram...", level=logging.INFO)
-            processing_start = time.time()
-            for attempt in range(self.INSTAGRAM_REEL_STATUS_RETRIES):
-                self.log_console_only(f"🔄 Processing attempt {attempt + 1}/{self.INSTAGRAM_REEL_STATUS_RETRIES}", level=logging.INFO)
-                
-                status_response = self.session.get(
-                    f"{self.INSTAGRAM_API_BASE}/{creation_id}?fields=status_code&access_token={page_token}"
-                )
-                
-                if status_response.status_code != 200:
-                    self.send_message(f"❌ Status check failed: {status_response.status_code}", level=logging.ERROR)
-                    return False
-                
-                status = status_response.json()
+        An optional container's ERROR or timeout only drops it. Returns (ok, finished_ids)
+        where ok is True when every required container finished.
+        """
+        pending = set(creation_ids) | set(optional)
+        finished = set()
+        processing_start = time.time()
+        required_done_at = None
+        for attempt in range(self.INSTAGRAM_REEL_STATUS_RETRIES):
+            self.log_console_only("🔄 Status check %s/%s for %s container(s)", attempt + 1, self.INSTAGRAM_REEL_STATUS_RETRIES, len(pending), level=logging.INFO, subsystem="graph")
+            res = self.session.get(f"{self.INSTAGRAM_API_BASE}/", params={
+                "ids": ",".join(sorted(pending)),
+                "fields": "status_code",
+                "access_token": page_token,
+            })
+            if res.status_code != 200:
+                self.record_graph_failure("status", res)
+                self.send_message(f"❌ Status check failed: {res.status_code}", level=logging.ERROR)
+                return False, finished
+            for creation_id, status in res.json().items():
                 current_status = status.get("status_code", "UNKNOWN")
-                
-                self.log_console_only(f"📊 Current status: {current_status}", level=logging.INFO)
-                
                 if current_status == "FINISHED":
-                    processing_time = time.time() - processing_start
-                    self.log_console_only(f"✅ Instagram video processing completed in {processing_time:.2f} seconds!", level=logging.INFO)
-                    
-                    # Wait 8 seconds after FINISHED status before publishing (reduced from 15)
-                    self.log_console_only("⏳ Waiting 15 seconds before publishing...", level=logging.INFO)
-                    time.sleep(15)
-                    break
+                    pending.discard(creation_id)
+                    finished.add(creation_id)
+                elif current_status == "ERROR" and creation_id in optional:
+                    pending.discard(creation_id)
+                    self.send_message(f"⚠️ Story container {creation_id} failed processing; posting to the feed only", level=logging.WARNING)
                 elif current_status == "ERROR":
-                    self.send_message(f"❌ Instagram processing failed: {name}\n📸 Status: ERROR", level=logging.ERROR)
-                    return False
-                
-                self.log_console_only(f"⏳ Waiting {self.INSTAGRAM_REEL_STATUS_WAIT_TIME} seconds before next check...", level=logging.INFO)
-                time.sleep(self.INSTAGRAM_REEL_STATUS_WAIT_TIME)
+                    self.last_failure = {"stage": "processing", "category": "media_invalid", "status": 200,
+                                         "code": None, "subcode": None, "message": f"container {creation_id} status ERROR"}
+                    self.observe_container_wait(attempt + 1, processing_start, "error")
+                    self.send_message(f"❌ Instagram processing failed for container {creation_id}", level=logging.ERROR)
+                    return False, finished
+            if required_done_at is None and set(creation_ids) <= finished:
+                # Timed when the required containers finish, so story processing never skews the tuner's samples
+                required_done_at = attempt
+                self.observe_container_wait(attempt + 1, processing_start, "finished")
+            if not pending:
+                self.log_console_only("✅ All containers finished in %.2f seconds", time.time() - processing_start, level=logging.INFO, subsystem="graph")
+                return True, finished
+            # Only story containers left: give them a few more ticks, then don't hold the feed post
+            if required_done_at is not None and attempt - required_done_at >= self.STORY_GRACE_CHECKS:
+                break
+            self.pause(self.INSTAGRAM_REEL_STATUS_WAIT_TIME)
+        if set(creation_ids) <= finished:
+            self.log_console_only("⚠️ Story container(s) %s not ready; posting to the feed only", ", ".join(sorted(pending)), level=logging.WARNING, subsystem="graph")
+            return True, finished
+        self.last_failure = {"stage": "processing", "category": "transient", "status": None, "code": None, "subcode": None,
+                             "message": f"container(s) still processing after {self.INSTAGRAM_REEL_STATUS_RETRIES} checks"}
+        self.observe_container_wait(self.INSTAGRAM_REEL_STATUS_RETRIES, processing_start, "timeout")
+        self.send_message(f"❌ {len(pending)} container(s) still processing after {self.INSTAGRAM_REEL_STATUS_RETRIES} checks", level=logging.ERROR)
+        return False, finished
 
-        self.log_console_only("📤 Step 4: Publishing to Instagram...", level=logging.INFO)
-        publish_url = f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media_publish"
-        publish_data = {"creation_id": creation_id, "access_token": page_token}
-        
-        self.log_console_only(f"📡 Publishing to: {publish_url}", level=logging.INFO)
-        
-        publish_start = time.time()
-        pub = self.session.post(publish_url, data=publish_data)
-        publish_time = time.time() - publish_start
-        
-        self.log_console_only(f"⏱️ Publish request completed in {publish_time:.2f} seconds", level=logging.INFO)
-        self.log_console_only(f"📊 Publish response status: {pub.status_code}", level=logging.INFO)
-        
-        # Track Instagram and Facebook results separately
-        instagram_success = False
-        facebook_success = False
-        
-        if pub.status_code == 200:
-            response_data = pub.json()
-            instagram_id = response_data.get("id", "Unknown")
-            
-            if not instagram_id:
-                self.send_message("⚠️ Instagram publish succeeded but no media ID returned", level=logging.WARNING)
-                instagram_success = False
-            else:
-                self.send_message(f"✅ Instagram post published successfully!\n📸 Media ID: {instagram_id}\n📸 Account ID: {self.ig_id}\n📦 Files left: {total_files - 1}")
-                instagram_success = True
-                
-                # Verify the post is live using the published media_id (not creation_id)
-                self.verify_instagram_post_by_media_id(instagram_id, page_token)
-            
-            # Also post to Facebook Page for both REELS and IMAGE
-            if media_type == "REELS":
-                self.log_console_only("📘 Step 5: Starting Facebook Page upload...", level=logging.INFO)
-                facebook_success = self.post_to_facebook_page(dbx, file, caption, page_token)
-            elif media_type == "IMAGE":
-                self.log_console_only("📘 Step 5: Starting Facebook Page upload for image...", level=logging.INFO)
-                facebook_success = self.post_to_facebook_page(dbx, file, caption, page_token)
-                # Telegram log for Facebook image upload
-                if facebook_success:
-                    self.send_message(f"✅ Facebook Page photo published successfully for file: {file.name}", level=logging.INFO)
-                else:
-                    self.send_message(f"❌ Facebook Page photo upload failed for file: {file.name}", level=logging.ERROR)
-            else:
-                facebook_success = True  # No Facebook post needed for other types
-            
-            # Return success status for both platforms
-            return True, media_type, instagram_success, facebook_success
+    def create_carousel_child(self, temp_link, is_video, page_token):
+        """Create one carousel child container and return its creation ID (None on failure)."""
+        data = {"access_token": page_token, "is_carousel_item": "true"}
+        if is_video:
+            data.update({"media_type": "VIDEO", "video_url": temp_link})
         else:
-            error_msg = pub.json().get("error", {}).get("message", "Unknown error")
-            error_code = pub.json().get("error", {}).get("code", "N/A")
-            self.send_message(f"❌ Instagram publish failed: {name}\n📸 Error: {error_msg}\n📸 Code: {error_code}\n📸 Status: {pub.status_code}", level=logging.ERROR)
-            # Do not attempt verification with creation_id, as it is invalid after publish
-            return False, media_type, instagram_success, facebook_success
+            data["image_url"] = temp_link
+        res = self.session.post(f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media", data=data)
+        if res.status_code != 200:
+            self.record_graph_failure("container", res)
+            error = res.json().get("error", {})
+            self.send_message(f"❌ Carousel item creation failed\n📸 Error: {error.get('message', 'Unknown')}\n📸 Code: {error.get('code', 'N/A')}", level=logging.ERROR)
+            return None
+        return res.json().get("id")
+
+    def post_carousel_to_instagram(self, source, prefix, items, caption, description, post_facebook=True):
+        """Publish a group of files as one IG carousel, creating child containers concurrently."""
+        media_type = "CAROUSEL"
+        self.send_message(f"🚀 Starting carousel upload for: {prefix} ({len(items)} items)", level=logging.INFO)
+
+        page_token = self.get_verified_page_token()
+        if not page_token:
+            return False, media_type, False, False
+
+        created = self.create_carousel_container(source, prefix, items, caption, page_token)
+        if created is None:
+            return False, media_type, False, False
+        creation_id, temp_links, carousel_caption = created
+
+        self.log_console_only("📤 Step 4: Publishing carousel to Instagram...", level=logging.INFO, subsystem="graph")
+        instagram_id = self.publish_container(creation_id, page_token)
+        if not instagram_id:
+            self.send_message(f"❌ Instagram carousel publish failed: {prefix}\n📸 Error: {self.last_failure['message']}\n📸 Code: {self.last_failure['code']}", level=logging.ERROR)
+            return False, media_type, False, False
+        self.note_post_id("ig", instagram_id)
+        self.send_message(f"✅ Instagram carousel published successfully!\n📸 Media ID: {instagram_id}\n🖼️ Items: {len(items)}")
+        self.verify_instagram_post_by_media_id(instagram_id, page_token)
+
+        if not post_facebook:
+            return True, media_type, True, True
+        self.log_console_only("📘 Step 5: Starting Facebook Page multi-photo post...", level=logging.INFO, subsystem="graph")
+        facebook_success = self.post_album_to_facebook_page(items, temp_links, carousel_caption, page_token)
+        return True, media_type, True, facebook_success
+
+    def create_carousel_container(self, source, prefix, items, caption, page_token):
+        """Create the children and the CAROUSEL container and wait until all are FINISHED.
+
+        Returns (creation_id, temp_links, carousel_caption), or None with the failure recorded.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        video_exts = (".mp4", ".mov")
+        with ThreadPoolExecutor(max_workers=len(items)) as pool:
+            temp_links = list(pool.map(lambda f: self.get_temporary_link(source, f.path_lower), items))
+            self.log_console_only("🔄 Step 2: Creating %s carousel items concurrently...", len(items), level=logging.INFO, subsystem="graph")
+            start_time = time.time()
+            # Run each child in a copy of this attempt's context so failures are recorded on it
+            jobs = [(contextvars.copy_context(), link, f.name.lower().endswith(video_exts)) for link, f in zip(temp_links, items)]
+            child_ids = list(pool.map(
+                lambda job: job[0].run(self.create_carousel_child, job[1], job[2], page_token),
+                jobs,
+            ))
+        self.log_console_only("⏱️ Carousel items created in %.2f seconds", time.time() - start_time, level=logging.INFO, subsystem="graph")
+        if not all(child_ids):
+            return None
+
+        self.log_console_only("⏳ Step 3: Waiting for carousel items to finish processing...", level=logging.INFO, subsystem="graph")
+        if not self.poll_container_statuses(child_ids, page_token):
+            return None
+
+        carousel_caption = f"{prefix.replace('_', ' ')[:100]}\n\n{caption}"
+        res = self.session.post(f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media", data={
+            "access_token": page_token,
+            "media_type": "CAROUSEL",
+            "children": ",".join(child_ids),
+            "caption": carousel_caption,
+        })
+        if res.status_code != 200 or not res.json().get("id"):
+            self.record_graph_failure("container", res)
+            self.send_message(f"❌ Carousel container creation failed: {res.text}", level=logging.ERROR)
+            return None
+        creation_id = res.json()["id"]
+        if not self.poll_container_statuses([creation_id], page_token):
+            return None
+        return creation_id, temp_links, carousel_caption
+
+    def post_album_to_facebook_page(self, items, temp_links, caption, page_token, scheduled_at=None):
+        """Post image carousel items to the Page as one multi-photo feed post (optionally scheduled)."""
+        from concurrent.futures import ThreadPoolExecutor
+        if not self.fb_page_id:
+            self.send_message("⚠️ Facebook Page ID not configured, skipping Facebook post", level=logging.WARNING)
+            return False
+        if any(f.name.lower().endswith((".mp4", ".mov")) for f in items):
+            self.send_message("⚠️ Carousel contains videos, skipping Facebook multi-photo post", level=logging.WARNING)
+            return False
+
+        def upload_unpublished(link):
+            res = self.session.post(f"https://graph.facebook.com/{self.fb_page_id}/photos", data={
+                "access_token": page_token, "url": link, "published": "false",
+            })
+            return res.json().get("id") if res.status_code == 200 else None
+
+        with ThreadPoolExecutor(max_workers=len(temp_links)) as pool:
+            photo_ids = list(pool.map(upload_unpublished, temp_links))
+        if not all(photo_ids):
+            self.send_message("❌ Facebook photo upload failed for one or more carousel items", level=logging.ERROR)
+            return False
+        data = {"access_token": page_token, "message": caption, **self.facebook_schedule_fields(scheduled_at)}
+        for i, photo_id in enumerate(photo_ids):
+            data[f"attached_media[{i}]"] = json.dumps({"media_fbid": photo_id})
+        res = self.session.post(f"https://graph.facebook.com/{self.fb_page_id}/feed", data=data)
+        if res.status_code == 200:
+            self.note_post_id("fb", res.json().get("id"), kind="post")
+            if scheduled_at:
+                self.send_message(f"🗓️ Facebook Page multi-photo post scheduled for {self.format_slot_time(scheduled_at)}\n📘 Post ID: {res.json().get('id', 'Unknown')}")
+                return True
+            self.send_message(f"✅ Facebook Page multi-photo post published!\n📘 Post ID: {res.json().get('id', 'Unknown')}")
+            return True
+        self.send_message(f"❌ Facebook multi-photo post failed: {res.text}", level=logging.ERROR)
+        return False
+
+    def add_media_fields(self, source, file, media_type, temp_link, data):
+        """Fill the media fields of an IMAGE/REELS container request; returns the chosen Reel cover."""
+        if media_type != "REELS":
+            data["image_url"] = temp_link
+            return None
+        data.update({"media_type": "REELS", "video_url": temp_link, "share_to_feed": "true"})
+        cover = None
+        try:
+            cover = self.get_reel_cover(source, file, temp_link)
+        except Exception as e:
+            self.log_console_only("⚠️ Cover frame stage failed: %s", e, level=logging.WARNING, subsystem="graph")
+        if cover and cover["url"]:
+            data["cover_url"] = cover["url"]
+        elif cover:
+            data["thumb_offset"] = str(cover["offset_ms"])
+        return cover
+
+    def story_container_fields(self, source, file, media_type, temp_link, page_token):
+        """STORIES container request for a file already prepared for the feed, or None if it can't be a story."""
+        if not self.stories_enabled:
+            return None
+        data = {"access_token": page_token, "media_type": "STORIES"}
+        if media_type != "REELS":
+            data["image_url"] = temp_link
+            return data
+        # Source metadata (or the override noted for a normalized copy): no download on the posting path
+        try:
+            _, _, duration = self.get_video_metadata(source, file)
+        except Exception as e:
+            self.log_console_only("⚠️ Could not read metadata of %s for a story: %s", file.name, e, level=logging.WARNING, subsystem="media")
+            return None
+        # Unknown duration: try anyway, a rejected story container only drops the story
+        if duration is not None and duration > self.STORY_MAX_DURATION:
+            self.log_console_only("⏭️ %s is %.0fs, too long for a story; feed only", file.name, duration, level=logging.INFO, subsystem="media")
+            return None
+        data["video_url"] = temp_link
+        return data
+
+    def story_creation_id(self, future, name):
+        """Creation ID from a STORIES container request; a failed story (or a raised request) never fails the feed post."""
+        try:
+            res = future.result()
+            if res.status_code == 200 and res.json().get("id"):
+                return res.json()["id"]
+            message = res.json().get("error", {}).get("message", "Unknown")
+        except Exception as e:
+            message = str(e)
+        self.metrics.inc("stories_total", doc="Instagram story attempts by outcome", outcome="container_failed")
+        self.send_message(f"⚠️ Story container failed for {name}; feed only\n📸 Error: {message}", level=logging.WARNING)
+        return None
+
+    def note_story_published(self, res, name):
+        if res.status_code == 200 and res.json().get("id"):
+            story_id = res.json()["id"]
+            self.note_post_id("ig_story", story_id)
+            self.metrics.inc("stories_total", doc="Instagram story attempts by outcome", outcome="published")
+            self.send_message(f"✅ Instagram story published for {name}\n📸 Media ID: {story_id}")
+            return True
+        error = res.json().get("error", {})
+        self.metrics.inc("stories_total", doc="Instagram story attempts by outcome", outcome="publish_failed")
+        self.send_message(f"⚠️ Instagram story publish failed for {name}\n📸 Error: {error.get('message', 'Unknown')}", level=logging.WARNING)
+        return False
+
+    def publish_container(self, creation_id, page_token):
+        """media_publish a FINISHED container; returns the media ID, or None with the failure recorded."""
+        pub = self.session.post(f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media_publish",
+                                data={"creation_id": creation_id, "access_token": page_token})
+        if pub.status_code != 200 or not pub.json().get("id"):
+            self.record_graph_failure("publish", pub)
+            return None
+        return pub.json()["id"]
+
+    def publish_story(self, story_id, page_token, name):
+        res = self.session.post(f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media_publish",
+                                data={"creation_id": story_id, "access_token": page_token})
+        return self.note_story_published(res, name)
 
     def is_supported_aspect_ratio(self, video_path):
         clip = VideoFileClip(video_path)
         width, height = clip.size
         aspect_ratio = width / height
         duration = clip.duration
-        self.log_console_only(f"🎬 Video duration: {duration:.2f}s", level=logging.INFO)
+        self.log_console_only("🎬 Video duration: %.2fs", duration, level=logging.INFO)
         if duration < 3 or duration > 90:
             self.send_message(f'❌ Video duration {duration:.2f}s not supported for Reels (must be 3–90s).', level=logging.ERROR)
             return False
         return 0.5625 <= aspect_ratio <= 1.7778
 
-    def get_video_aspect_and_duration(self, video_url):
-        """Download video to temp file, return (aspect_ratio, duration, temp_file_path)."""
-        import tempfile
-        import requests
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4')
-        with requests.get(video_url, stream=True) as r:
-            r.raise_for_status()
-            for chunk in r.iter_content(chunk_size=8192):
-                temp_file.write(chunk)
-        temp_file.close()
-        from moviepy.editor import VideoFileClip
-        clip = VideoFileClip(temp_file.name)
-        width, height = clip.size
-        aspect_ratio = width / height
-        duration = clip.duration
-        return aspect_ratio, duration, temp_file.name
+    def get_video_aspect_and_duration(self, source, file):
+        """Probe the cached local copy of a video, return (aspect_ratio, duration, local_path)."""
+        path = self.get_local_media(source, file)
+        clip = VideoFileClip(path)
+        try:
+            width, height = clip.size
+            aspect_ratio = width / height
+            duration = clip.duration
+        finally:
+            clip.close()
+        return aspect_ratio, duration, path
 
-    def get_dropbox_video_metadata(self, dbx, file):
-        """Get width, height, duration from Dropbox file metadata (no download)."""
-        from dropbox.files import VideoMetadata, PhotoMetadata
-        metadata = dbx.files_get_metadata(file.path_lower, include_media_info=True)
-        if hasattr(metadata, 'media_info') and metadata.media_info:
-            info = metadata.media_info.get_metadata()
-            width = None
-            height = None
-            if getattr(info, 'dimensions', None) is not None:
-                width = info.dimensions.width
-                height = info.dimensions.height
-            if isinstance(info, VideoMetadata):
-                duration = info.duration / 1000.0  # ms to seconds
-            else:
-                duration = None
-            return width, height, duration
-        return None, None, None
+    def get_video_metadata(self, source, file):
+        """Get width, height, duration from the media source's metadata (no download)."""
+        if file.path_lower in self.media_info_overrides:
+            return self.media_info_overrides[file.path_lower]
+        return source.media_info(file.path_lower)
+
+    def post_to_facebook_page(self, source, file, caption, page_token=None, as_reel=None, cover=None, scheduled_at=None):
+        """Publish the video to the Facebook Page as a Reel or regular video. Uses source metadata for decision.
 
-    def post_to_facebook_page(self, dbx, file, caption, page_token=None, as_reel=None):
-        """Publish the video to the Facebook Page as a Reel or regular video. Uses Dropbox metadata for decision."""
+        With ``scheduled_at`` (unix time) the media is uploaded now and Facebook publishes it then.
+        """
         import requests
         import os
-        media_url = dbx.files_get_temporary_link(file.path_lower).link
+        media_url = self.get_temporary_link(source, file.path_lower)
         if not self.fb_page_id:
             self.send_message("⚠️ Facebook Page ID not configured, skipping Facebook post", level=logging.WARNING)
             return False
         if not page_token:
-            self.log_console_only("🔐 Fetching fresh Facebook Page Access Token...", level=logging.INFO)
+            self.log_console_only("🔐 Fetching fresh Facebook Page Access Token...", level=logging.INFO, subsystem="graph")
             page_token = self.get_page_access_token()
             if not page_token:
                 self.send_message("❌ Could not retrieve Facebook Page access token. Aborting Facebook upload.", level=logging.ERROR)
                 return False
         else:
-            self.log_console_only("🔐 Using shared Facebook Page Access Token for Facebook upload", level=logging.INFO)
-        # Use Dropbox metadata for decision
-        width, height, duration = self.get_dropbox_video_metadata(dbx, file)
+            self.log_console_only("🔐 Using shared Facebook Page Access Token for Facebook upload", level=logging.INFO, subsystem="graph")
+        # Use source metadata for decision
+        width, height, duration = self.get_video_metadata(source, file)
         aspect_ratio = width / height if width and height else None
         decision_msg = f"\n📦 File: {file.name}\n📏 Width: {width}\n📏 Height: {height}\n⏱️ Duration: {duration}s\n📐 Aspect Ratio: {aspect_ratio:.4f}" if aspect_ratio else f"\n📦 File: {file.name}\n📏 Width: {width}\n📏 Height: {height}\n⏱️ Duration: {duration}s\n📐 Aspect Ratio: N/A"
         # Strict 9:16 check for Reels
@@ -462,18 +3238,18 @@ class DropboxToInstagramUploader:
             if height >= 960 and width >= 540 and abs(aspect_ratio - 0.5625) < 0.01:
                 as_reel = True
                 decision_msg += "\n🚀 Will upload as: Facebook Reel (strict 9:16 portrait)"
-                self.log_console_only("✅ Strict 9:16 portrait detected. Will upload as Facebook Reel.", level=logging.INFO)
+                self.log_console_only("✅ Strict 9:16 portrait detected. Will upload as Facebook Reel.", level=logging.INFO, subsystem="graph")
             else:
                 as_reel = False
                 decision_msg += f"\n🚀 Will upload as: Regular Facebook Video (aspect ratio: {aspect_ratio:.4f})"
-                self.log_console_only(f"❌ Not strict 9:16 portrait (aspect ratio: {aspect_ratio:.4f}). Will upload as regular Facebook video.", level=logging.INFO)
+                self.log_console_only("❌ Not strict 9:16 portrait (aspect ratio: %.4f). Will upload as regular Facebook video.", aspect_ratio, level=logging.INFO, subsystem="graph")
         else:
-            self.log_console_only("Could not get Dropbox video metadata, defaulting to regular video.", level=logging.WARNING)
+            self.log_console_only("Could not get video metadata, defaulting to regular video.", level=logging.WARNING, subsystem="graph")
             as_reel = False
             decision_msg += "\n🚀 Will upload as: Regular Facebook Video (metadata unavailable)"
         self.send_message(decision_msg, level=logging.INFO)
         if as_reel:
-            self.log_console_only("📘 Starting Facebook Page upload (Reels API, hosted file)...", level=logging.INFO)
+            self.log_console_only("📘 Starting Facebook Page upload (Reels API, hosted file)...", level=logging.INFO, subsystem="graph")
             # 1. Start upload session
             start_url = f"https://graph.facebook.com/v23.0/{self.fb_page_id}/video_reels"
             start_data = {"upload_phase": "start", "access_token": page_token}
@@ -486,7 +3262,7 @@ class DropboxToInstagramUploader:
             if not video_id or not upload_url:
                 self.send_message(f"❌ No video_id or upload_url returned: {start_res.text}", level=logging.ERROR)
                 return False
-            # 2. Upload video using hosted file (Dropbox temp link)
+            # 2. Upload video using hosted file (media source temp link)
             headers = {
                 "Authorization": f"OAuth {page_token}",
                 "file_url": media_url
@@ -501,62 +3277,69 @@ class DropboxToInstagramUploader:
                 "access_token": page_token,
                 "video_id": video_id,
                 "description": caption,
-                "video_state": "PUBLISHED",
+                "video_state": "SCHEDULED" if scheduled_at else "PUBLISHED",
                 "share_to_feed": "true"
             }
+            if scheduled_at:
+                finish_data["scheduled_publish_time"] = str(int(scheduled_at))
             finish_res = self.session.post(start_url, data=finish_data)
             if finish_res.status_code == 200:
                 response_data = finish_res.json()
                 fb_video_id = response_data.get("id", video_id)
+                self.note_post_id("fb", fb_video_id, kind="reel")
+                if cover:
+                    self.set_facebook_video_thumbnail(source, video_id, cover, page_token)
+                if scheduled_at:
+                    self.send_message(f"🗓️ Facebook Reel scheduled for {self.format_slot_time(scheduled_at)}\n📘 Video ID: {fb_video_id}")
+                    return True
                 self.send_message(f"✅ Facebook Reel published successfully!\n📘 Video ID: {fb_video_id}\n📘 Page ID: {self.fb_page_id}")
                 self.verify_facebook_post_by_video_id(fb_video_id, page_token)
                 # Fetch and log the list of Reels for the Page
                 try:
                     reels_url = f'https://graph.facebook.com/v23.0/{self.fb_page_id}/video_reels?access_token={page_token}'
                     reels_res = self.session.get(reels_url)
-                    self.log_console_only(f'📄 Reels list response: {reels_res.text}', level=logging.INFO)
+                    self.log_console_only("📄 Reels list response: %s", reels_res.text, level=logging.INFO, subsystem="graph")
                 except Exception as e:
-                    self.log_console_only(f'⚠️ Could not fetch Reels list: {e}', level=logging.WARNING)
+                    self.log_console_only("⚠️ Could not fetch Reels list: %s", e, level=logging.WARNING, subsystem="graph")
                 return True
             else:
                 self.send_message(f"❌ Facebook Reels publish failed: {finish_res.text}", level=logging.ERROR)
                 return False
         else:
-            self.log_console_only("📘 Starting Facebook Page upload (Regular Video)...", level=logging.INFO)
+            self.log_console_only("📘 Starting Facebook Page upload (Regular Video)...", level=logging.INFO, subsystem="graph")
             # Detect if file is an image
             image_exts = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp')
             is_image = file.name.lower().endswith(image_exts)
             if is_image:
-                self.log_console_only("🖼️ Detected image file. Uploading as Facebook photo.", level=logging.INFO)
+                self.log_console_only("🖼️ Detected image file. Uploading as Facebook photo.", level=logging.INFO, subsystem="graph")
                 self.send_message(f"\n📦 File: {file.name}\n🖼️ Will upload as: Facebook Photo", level=logging.INFO)
                 post_url = f"https://graph.facebook.com/{self.fb_page_id}/photos"
-                self.log_console_only(f"🌐 Dropbox image URL: {media_url}", level=logging.INFO)
-                # Check if Dropbox link is accessible
-                try:
-                    check_res = requests.get(media_url, timeout=10)
-                    if check_res.status_code == 200:
-                        self.log_console_only(f"✅ Dropbox link is accessible (status 200)", level=logging.INFO)
-                    else:
-                        self.log_console_only(f"❌ Dropbox link returned status {check_res.status_code}", level=logging.ERROR)
-                except Exception as e:
-                    self.log_console_only(f"❌ Exception checking Dropbox link: {e}", level=logging.ERROR)
+                self.log_console_only("🌐 Image URL: %s", media_url, level=logging.INFO, subsystem="graph")
+                # Check if the media link is accessible (headers only), fetching a fresh link if not
+                link_status = self.check_link_alive(media_url)
+                if link_status == 200:
+                    self.log_console_only("✅ Media link is accessible (status 200)", level=logging.INFO, subsystem="graph")
+                else:
+                    self.log_console_only("❌ Media link returned status %s, fetching a fresh link", link_status, level=logging.ERROR, subsystem="graph")
+                    media_url = self.get_temporary_link(source, file.path_lower, force=True)
                 data = {
                     "access_token": page_token,
                     "url": media_url,
-                    "caption": caption
+                    "caption": caption,
+                    **self.facebook_schedule_fields(scheduled_at),
                 }
                 try:
-                    self.log_console_only("🔄 Sending image upload request to Facebook API...", level=logging.INFO)
-                    self.log_console_only(f"📡 Facebook API URL: {post_url}", level=logging.INFO)
+                    self.log_console_only("🔄 Sending image upload request to Facebook API...", level=logging.INFO, subsystem="graph")
+                    self.log_console_only("📡 Facebook API URL: %s", post_url, level=logging.INFO, subsystem="graph")
                     res = self.session.post(post_url, data=data)
-                    self.log_console_only(f"📊 Facebook response status: {res.status_code}", level=logging.INFO)
-                    try:
-                        response_json = res.json()
-                        self.log_console_only(f"📄 Facebook response: {json.dumps(response_json, indent=2)}", level=logging.INFO)
-                    except:
-                        self.log_console_only(f"📄 Facebook response text: {res.text}", level=logging.INFO)
+                    self.log_console_only("📊 Facebook response status: %s", res.status_code, level=logging.INFO, subsystem="graph")
+                    self.log_payload("📄 Facebook response", res)
                     if res.status_code == 200:
                         photo_id = res.json().get("id", "Unknown")
+                        self.note_post_id("fb", photo_id, kind="photo")
+                        if scheduled_at:
+                            self.send_message(f"🗓️ Facebook Page photo scheduled for {self.format_slot_time(scheduled_at)}\n🖼️ Photo ID: {photo_id}")
+                            return True
                         self.send_message(f"✅ Facebook Page photo published successfully!\n🖼️ Photo ID: {photo_id}\n📘 Page ID: {self.fb_page_id}")
                         return True
                     else:
@@ -567,34 +3350,34 @@ class DropboxToInstagramUploader:
                     self.send_message(f"❌ Facebook Page photo upload exception:\n🖼️ Error: {str(e)}", level=logging.ERROR)
                     return False
             else:
-                self.log_console_only("📘 Starting Facebook Page upload (Regular Video)...", level=logging.INFO)
+                self.log_console_only("📘 Starting Facebook Page upload (Regular Video)...", level=logging.INFO, subsystem="graph")
                 post_url = f"https://graph.facebook.com/{self.fb_page_id}/videos"
                 data = {
                     "access_token": page_token,
                     "file_url": media_url,
-                    "description": caption
+                    "description": caption,
+                    **self.facebook_schedule_fields(scheduled_at),
                 }
-                self.log_console_only(f"🔐 Using page token for Facebook upload: {page_token[:20]}...", level=logging.INFO)
-                self.log_console_only(f"📄 Page ID for upload: {self.fb_page_id}", level=logging.INFO)
-                self.log_console_only(f"📹 Video URL: {media_url[:50]}...", level=logging.INFO)
-                self.log_console_only(f"📝 Caption: {caption[:50]}...", level=logging.INFO)
-                self.log_console_only("🔄 Skipping token verification for Facebook upload...", level=logging.INFO)
+                self.log_console_only("📄 Page ID for upload: %s", self.fb_page_id, level=logging.INFO, subsystem="graph")
+                self.log_console_only("📹 Video URL: %s...", media_url[:50], level=logging.INFO, subsystem="graph")
+                self.log_console_only("📝 Caption: %s...", caption[:50], level=logging.INFO, subsystem="graph")
+                self.log_console_only("🔄 Skipping token verification for Facebook upload...", level=logging.INFO, subsystem="graph")
                 try:
-                    self.log_console_only("🔄 Sending request to Facebook API...", level=logging.INFO)
-                    self.log_console_only(f"📡 Facebook API URL: {post_url}", level=logging.INFO)
+                    self.log_console_only("🔄 Sending request to Facebook API...", level=logging.INFO, subsystem="graph")
+                    self.log_console_only("📡 Facebook API URL: %s", post_url, level=logging.INFO, subsystem="graph")
                     start_time = time.time()
                     res = self.session.post(post_url, data=data)
                     request_time = time.time() - start_time
-                    self.log_console_only(f"⏱️ Facebook API request completed in {request_time:.2f} seconds", level=logging.INFO)
-                    self.log_console_only(f"📊 Facebook response status: {res.status_code}", level=logging.INFO)
-                    try:
-                        response_json = res.json()
-                        self.log_console_only(f"📄 Facebook response: {json.dumps(response_json, indent=2)}", level=logging.INFO)
-                    except:
-                        self.log_console_only(f"📄 Facebook response text: {res.text}", level=logging.INFO)
+                    self.log_console_only("⏱️ Facebook API request completed in %.2f seconds", request_time, level=logging.INFO, subsystem="graph")
+                    self.log_console_only("📊 Facebook response status: %s", res.status_code, level=logging.INFO, subsystem="graph")
+                    self.log_payload("📄 Facebook response", res)
                     if res.status_code == 200:
                         response_data = res.json()
                         video_id = response_data.get("id", "Unknown")
+                        self.note_post_id("fb", video_id, kind="video")
+                        if scheduled_at:
+                            self.send_message(f"🗓️ Facebook Page video scheduled for {self.format_slot_time(scheduled_at)}\n📘 Video ID: {video_id}")
+                            return True
                         self.send_message(f"✅ Facebook Page post published successfully!\n📘 Video ID: {video_id}\n📘 Page ID: {self.fb_page_id}")
                         self.verify_facebook_post_by_video_id(video_id, page_token)
                         return True
@@ -616,76 +3399,347 @@ class DropboxToInstagramUploader:
                     self.send_message("⚠️ Facebook upload exception, but Instagram upload was successful", level=logging.WARNING)
                     return False
 
+    def set_facebook_video_thumbnail(self, source, video_id, cover, page_token):
+        """Attach the cached cover frame to a Facebook video as its preferred thumbnail."""
+        try:
+            thumb_res = self.session.post(
+                f"https://graph.facebook.com/v23.0/{video_id}/thumbnails",
+                data={"access_token": page_token, "is_preferred": "true"},
+                files={"source": ("cover.jpg", source.download(cover["path"]), "image/jpeg")},
+            )
+            if thumb_res.status_code == 200:
+                self.log_console_only("🖼️ Facebook Reel cover set from cached frame", level=logging.INFO, subsystem="graph")
+            else:
+                self.log_console_only("⚠️ Facebook Reel cover upload failed: %s", thumb_res.text, level=logging.WARNING, subsystem="graph")
+        except Exception as e:
+            self.log_console_only("⚠️ Could not set Facebook Reel cover: %s", e, level=logging.WARNING, subsystem="graph")
+
+    def open_insights_db(self):
+        """Open (and create if needed) the local SQLite insights store."""
+        import sqlite3
+        os.makedirs(os.path.dirname(self.insights_db) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.insights_db)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS media (
+                platform TEXT, media_id TEXT, kind TEXT, file TEXT, posted_at TEXT, collected_at REAL,
+                PRIMARY KEY (platform, media_id));
+            CREATE TABLE IF NOT EXISTS insights (
+                platform TEXT, media_id TEXT, metric TEXT, value REAL, collected_at REAL,
+                PRIMARY KEY (platform, media_id, metric));
+        """)
+        return conn
+
+    def parse_insight_values(self, insights):
+        """Map a Graph insights ``data`` list to {metric: value}."""
+        values = {}
+        for metric in insights or []:
+            if metric.get("total_value") is not None:
+                value = metric["total_value"].get("value")
+            else:
+                value = (metric.get("values") or [{}])[-1].get("value")
+            if isinstance(value, (int, float)):
+                values[metric.get("name")] = value
+        return values
+
+    def collect_instagram_insights(self, due, page_token):
+        """Page through /{ig_id}/media with expanded insights; return {media_id: {metric: value}}."""
+        wanted = set(due)
+        oldest = min(posted_at for posted_at in due.values())
+        results = {}
+        url = f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media"
+        params = {
+            "fields": f"id,timestamp,insights.metric({','.join(self.IG_INSIGHT_METRICS)})",
+            "limit": 50,
+            "access_token": page_token,
+        }
+        pages = 0
+        while url and wanted:
+            res = self.session.get(url, params=params)
+            pages += 1
+            if res.status_code != 200:
+                self.log_console_only("⚠️ IG insights page failed: %s", res.text[:200], level=logging.WARNING, subsystem="graph")
+                break
+            body = res.json()
+            for item in body.get("data", []):
+                if item.get("id") in wanted:
+                    results[item["id"]] = self.parse_insight_values(item.get("insights", {}).get("data"))
+                    wanted.discard(item["id"])
+            timestamps = [item.get("timestamp", "") for item in body.get("data", [])]
+            if timestamps and min(timestamps)[:19] < oldest[:19]:
+                break
+            url, params = body.get("paging", {}).get("next"), None
+        self.log_console_only("📈 IG insights: %s post(s) from %s page(s)", len(results), pages, level=logging.INFO, subsystem="graph")
+        return results
+
+    def facebook_insight_requests(self, media_id, kind, index):
+        """Graph batch request(s) for one FB post's insights; the last one answers with the metrics."""
+        metrics = ','.join(self.FB_INSIGHT_METRICS[kind])
+        if kind in ("reel", "video"):
+            return [{"method": "GET", "relative_url": f"{media_id}/video_insights?metric={metrics}"}]
+        if kind == "post":
+            return [{"method": "GET", "relative_url": f"{media_id}/insights?metric={metrics}"}]
+        # A photo ID has no insights edge: look up the Page post carrying it within the same batch
+        name = f"photo{index}"
+        return [
+            {"method": "GET", "name": name, "relative_url": f"{media_id}?fields=page_story_id", "omit_response_on_success": False},
+            {"method": "GET", "relative_url": f"{{result={name}:$.page_story_id}}/insights?metric={metrics}"},
+        ]
+
+    def collect_facebook_insights(self, due, page_token):
+        """Fetch FB reel, video, photo and feed post insights with Graph batch requests; return {media_id: {metric: value}}."""
+        results = {}
+        jobs = [(media_id, self.facebook_insight_requests(media_id, kind, index))
+                for index, (media_id, kind) in enumerate(due.items()) if kind in self.FB_INSIGHT_METRICS]
+        # A photo's lookup and its insights request must land in the same batch
+        chunks, chunk, size = [], [], 0
+        for job in jobs:
+            if chunk and size + len(job[1]) > self.GRAPH_BATCH_SIZE:
+                chunks.append(chunk)
+                chunk, size = [], 0
+            chunk.append(job)
+            size += len(job[1])
+        if chunk:
+            chunks.append(chunk)
+        for chunk in chunks:
+            res = self.session.post("https://graph.facebook.com/v18.0", data={
+                "access_token": page_token,
+                "include_headers": "false",
+                "batch": json.dumps([request for _, batch in chunk for request in batch]),
+            })
+            if res.status_code != 200:
+                self.log_console_only("⚠️ FB insights batch failed: %s", res.text[:200], level=logging.WARNING, subsystem="graph")
+                continue
+            responses = iter(res.json())
+            for media_id, batch in chunk:
+                response = [next(responses, None) for _ in batch][-1]
+                if response and response.get("code") == 200:
+                    results[media_id] = self.parse_insight_values(json.loads(response["body"]).get("data"))
+        self.log_console_only("📈 FB insights: %s post(s) in %s batch request(s)", len(results), len(chunks), level=logging.INFO, subsystem="graph")
+        return results
+
+    def collect_insights(self, source):
+        """Incrementally refresh insights for journaled posts still inside their active window."""
+        if not self.insights_enabled:
+            return
+        journal = self.load_state(source, "journal.json", [])
+        conn = self.open_insights_db()
+        now = time.time()
+        window_start = datetime.now(utc) - timedelta(days=self.insights_active_days)
+        try:
+            collected = {(row[0], row[1]): row[2] for row in conn.execute("SELECT platform, media_id, collected_at FROM media")}
+            due_ig, due_fb = {}, {}
+            for entry in journal:
+                posted_at = entry.get("posted_at")
+                if not posted_at or datetime.fromisoformat(posted_at) < window_start:
+                    continue
+                for platform, media_id, kind in (("ig", entry.get("ig_media_id"), entry.get("media_type")),
+                                                 ("fb", entry.get("fb_id"), entry.get("fb_kind"))):
+                    if not media_id:
+                        continue
+                    conn.execute("INSERT OR IGNORE INTO media VALUES (?, ?, ?, ?, ?, NULL)",
+                                 (platform, media_id, kind, entry.get("file"), posted_at))
+                    last = collected.get((platform, media_id))
+                    if last and now - last < self.insights_interval_hours * 3600:
+                        continue
+                    if platform == "ig":
+                        due_ig[media_id] = posted_at
+                    else:
+                        due_fb[media_id] = kind
+            if not due_ig and not due_fb:
+                self.log_console_only("📈 Insights up to date, nothing to collect", level=logging.INFO, subsystem="graph")
+                conn.commit()
+                return
+
+            page_token = self.get_page_access_token()
+            if not page_token:
+                return
+            results = []
+            if due_ig:
+                results += [("ig", media_id, values) for media_id, values in self.collect_instagram_insights(due_ig, page_token).items()]
+            if due_fb:
+                results += [("fb", media_id, values) for media_id, values in self.collect_facebook_insights(due_fb, page_token).items()]
+            for platform, media_id, values in results:
+                conn.executemany("INSERT OR REPLACE INTO insights VALUES (?, ?, ?, ?, ?)",
+                                 [(platform, media_id, metric, value, now) for metric, value in values.items()])
+                conn.execute("UPDATE media SET collected_at = ? WHERE platform = ? AND media_id = ?", (now, platform, media_id))
+            conn.commit()
+            self.log_console_only("📈 Stored insights for %s post(s) in %s", len(results), self.insights_db, level=logging.INFO, subsystem="graph")
+        finally:
+            conn.close()
+
+    def get_token_cipher(self):
+        """Fernet cipher keyed from the Dropbox app secret and refresh token, or None if unavailable."""
+        try:
+            import hashlib
+            from cryptography.fernet import Fernet
+        except ImportError:
+            return None
+        if not self.dropbox_secret or not self.dropbox_refresh:
+            return None
+        digest = hashlib.sha256(f"{self.dropbox_secret}:{self.dropbox_refresh}".encode("utf-8")).digest()
+        return Fernet(base64.urlsafe_b64encode(digest))
+
+    def load_cached_dropbox_token(self):
+        """Return (access_token, expires_at) from the encrypted cache if it is still fresh enough."""
+        if not self.dropbox_token_cache:
+            return None, None
+        cipher = self.get_token_cipher()
+        if cipher is None or not os.path.exists(self.dropbox_token_cache):
+            return None, None
+        try:
+            with open(self.dropbox_token_cache, "rb") as f:
+                cached = json.loads(cipher.decrypt(f.read()))
+        except Exception as e:
+            self.log_console_only("⚠️ Ignoring unreadable Dropbox token cache: %s", e, level=logging.WARNING, subsystem="dropbox")
+            return None, None
+        remaining = cached.get("expires_at", 0) - time.time()
+        if remaining < self.DROPBOX_TOKEN_REFRESH_MARGIN:
+            return None, None
+        self.log_console_only("🔐 Reusing cached Dropbox token (%.0f min left)", remaining / 60, level=logging.INFO, subsystem="dropbox")
+        return cached["access_token"], cached["expires_at"]
+
+    def save_cached_dropbox_token(self, access_token, expires_at):
+        """Write the short-lived Dropbox token to the encrypted cache file."""
+        if not self.dropbox_token_cache:
+            return
+        cipher = self.get_token_cipher()
+        if cipher is None:
+            self.log_console_only("⚠️ cryptography not installed, not caching Dropbox token", level=logging.WARNING, subsystem="dropbox")
+            return
+        try:
+            os.makedirs(os.path.dirname(self.dropbox_token_cache) or ".", exist_ok=True)
+            payload = cipher.encrypt(json.dumps({"access_token": access_token, "expires_at": expires_at}).encode("utf-8"))
+            with open(self.dropbox_token_cache, "wb") as f:
+                f.write(payload)
+            os.chmod(self.dropbox_token_cache, 0o600)
+        except Exception as e:
+            self.log_console_only("⚠️ Could not write Dropbox token cache: %s", e, level=logging.WARNING, subsystem="dropbox")
+
     def authenticate_dropbox(self):
-        """Authenticate with Dropbox and return the client."""
+        """Authenticate with Dropbox and return the client.
+
+        A cached token is reused until it is close to expiry; the client also
+        gets the refresh token so the SDK refreshes by itself during long runs.
+        """
         try:
-            access_token = self.refresh_dropbox_token()
-            return dropbox.Dropbox(oauth2_access_token=access_token)
+            access_token, expires_at = self.load_cached_dropbox_token()
+            if not access_token:
+                access_token = self.refresh_dropbox_token()
+                expires_at = self.dropbox_token_expires_at
+                self.save_cached_dropbox_token(access_token, expires_at)
+            self.dropbox_token_expires_at = expires_at
+            session = dropbox.create_session()
+            session.hooks["response"].append(self.observe_http_response)
+            self.mount_cassette(session)
+            return dropbox.Dropbox(
+                oauth2_access_token=access_token,
+                oauth2_access_token_expiration=datetime.utcfromtimestamp(expires_at),
+                oauth2_refresh_token=self.dropbox_refresh,
+                app_key=self.dropbox_key,
+                app_secret=self.dropbox_secret,
+                session=session,
+            )
         except Exception as e:
             self.send_message(f"❌ Dropbox authentication failed: {str(e)}", level=logging.ERROR)
             raise
 
-    def get_remaining_files_count(self, dbx):
-        """Get the count of remaining files in Dropbox folder."""
+    def open_media_source(self):
+        """The configured MediaSource; Dropbox re-authenticates per run, the others are built once."""
+        if self.media_source_kind == "dropbox":
+            return DropboxSource(self.authenticate_dropbox())
+        if self.media_source is None:
+            if self.media_source_kind == "local":
+                if not self.media_public_url:
+                    self.log_console_only("⚠️ MEDIA_PUBLIC_URL is not set: Meta cannot fetch media from localhost", level=logging.WARNING)
+                self.media_source = LocalDirSource(self.media_local_root, self.media_public_url, self.media_http_port,
+                                                   self.media_link_secret, f"{self.state_folder}/content_hashes.json")
+            elif self.media_source_kind == "s3":
+                if not self.s3_bucket:
+                    raise ValueError("MEDIA_SOURCE=s3 needs S3_BUCKET")
+                self.media_source = S3Source(self.s3_bucket, self.s3_prefix, self.s3_endpoint_url, self.s3_region)
+            else:
+                raise ValueError(f"Unknown MEDIA_SOURCE {self.media_source_kind!r} (expected dropbox, local or s3)")
+        return self.media_source
+
+    def get_remaining_files_count(self, source):
+        """Get the count of remaining files in the inbox folder."""
         try:
-            files = self.list_dropbox_files(dbx)
+            files = self.list_inbox_files(source)
             return len(files)
         except Exception as e:
-            self.log_console_only(f"⚠️ Could not count remaining files: {e}", level=logging.WARNING)
+            self.log_console_only("⚠️ Could not count remaining files: %s", e, level=logging.WARNING, subsystem="dropbox")
             return 0
 
-    def process_files_with_retries(self, dbx, caption, description, max_retries=1):
-        files = self.list_dropbox_files(dbx)
-        if not files:
-            self.log_console_only("📭 No files found in Dropbox folder.", level=logging.INFO)
-            return False
+    def prepare_post_media(self, source, file, group, carousel_prefix, files):
+        """Run the pre-posting stages and return the file (or carousel items) to publish."""
+        if carousel_prefix:
+            self.log_console_only("🖼️ %s is part of carousel %s (%s items)", file.name, carousel_prefix, len(group), level=logging.INFO)
+            return [self.prepare_images(source, self.pretranscode_videos(source, item, [item]), [item]) for item in group]
+        post_file = self.pretranscode_videos(source, file, files)
+        return self.prepare_images(source, post_file, files)
 
-        # Process only the first file - no retries
-        file = random.choice(files)
-        self.log_console_only(f"🎯 Processing single file: {file.name}", level=logging.INFO)
-        
-        try:
-            result = self.post_to_instagram(dbx, file, caption, description)
-            if isinstance(result, tuple):
-                if len(result) == 4:
-                    success, media_type, instagram_success, facebook_success = result
-                elif len(result) == 2:
-                    success, media_type = result
-                    instagram_success = success
-                    facebook_success = False
-                else:
-                    success = result
-                    media_type = None
-                    instagram_success = success
-                    facebook_success = False
-            else:
-                success = result
-                media_type = None
-                instagram_success = success
-                facebook_success = False
-        except Exception as e:
-            self.send_message(f"❌ Exception during post for {file.name}: {e}", level=logging.ERROR)
-            success = False
-            media_type = None
-            instagram_success = False
-            facebook_success = False
+    def unpack_post_result(self, result):
+        """Normalize the various post_* return shapes to (media_type, instagram_success, facebook_success)."""
+        if isinstance(result, tuple):
+            _, media_type, instagram_success, facebook_success = result
+            return media_type, instagram_success, facebook_success
+        return None, result, False
 
-        # Always delete the file after an attempt
-        try:
-            dbx.files_delete_v2(file.path_lower)
-            self.log_console_only(f"🗑️ Deleted file after attempt: {file.name}")
-        except Exception as e:
-            self.log_console_only(f"⚠️ Failed to delete file {file.name}: {e}", level=logging.WARNING)
+    def finish_attempt(self, source, file, group, hashes, carousel_prefix, media_type, instagram_success):
+        """Journal a successful post and delete/requeue/dead-letter the claimed files."""
+        if instagram_success:
+            self.append_journal_entry(source, {
+                "file": carousel_prefix or file.name,
+                "content_hash": file.content_hash,
+                "media_type": media_type,
+                "posted_at": datetime.now(utc).isoformat(),
+                "hashes": [[f"{p:016x}", f"{d:016x}"] for p, d in hashes or []],
+                **self.get_post_ids_for_journal(),
+                **self.get_encode_fields_for_journal(source),
+            })
+
+        failure = self.last_failure or {}
+        self.metrics.inc("posts_total", doc="Post attempts by media type and outcome",
+                         media_type=media_type or "unknown",
+                         outcome="published" if instagram_success else failure.get("category", "failed"))
 
-        # Get remaining files count
-        remaining_files = self.get_remaining_files_count(dbx)
+        # Delete on success or invalid media, requeue transient failures, dead-letter the rest
+        self.settle_attempt(source, group, instagram_success)
 
-        # Report results for each platform separately
+    def get_post_ids_for_journal(self):
+        """Flatten the IDs noted during this attempt into journal fields."""
+        post_ids = _attempt_state.get({}).get("post_ids", {})
+        fields = {}
+        if "ig" in post_ids:
+            fields["ig_media_id"] = post_ids["ig"]["id"]
+        if "ig_story" in post_ids:
+            fields["ig_story_id"] = post_ids["ig_story"]["id"]
+        if "fb" in post_ids:
+            fields["fb_id"] = post_ids["fb"]["id"]
+            fields["fb_kind"] = post_ids["fb"]["kind"]
+        return fields
+
+    def get_encode_fields_for_journal(self, source):
+        """Posted video properties, encode profile and Meta processing time noted during this attempt."""
+        state = _attempt_state.get({})
+        fields = {}
+        encode = self.sample_encode(source, state["encode"]) if state.get("encode") else None
+        if encode:
+            fields["encode"] = encode
+        if state.get("processing"):
+            fields["processing_seconds"] = state["processing"]["seconds"]
+            fields["processing_outcome"] = state["processing"]["outcome"]
+        return fields
+
+    def report_attempt(self, group, media_type, instagram_success, facebook_success, remaining_files):
+        """Report results for each platform separately."""
         if instagram_success:
             if media_type == "REELS":
                 self.send_message("✅ Successfully posted one reel to Instagram", level=logging.INFO)
             elif media_type == "IMAGE":
                 self.send_message("✅ Successfully posted one image to Instagram", level=logging.INFO)
+            elif media_type == "CAROUSEL":
+                self.send_message(f"✅ Successfully posted one carousel ({len(group)} items) to Instagram", level=logging.INFO)
             else:
                 self.send_message("✅ Successfully posted to Instagram", level=logging.INFO)
         else:
@@ -699,57 +3753,828 @@ class DropboxToInstagramUploader:
         
         # Final summary with remaining files count
         if media_type == "REELS":
-            self.log_console_only(f"📊 Final Status: Instagram {'✅' if instagram_success else '❌'} | Facebook {'✅' if facebook_success else '❌'} | 📦 Remaining files: {remaining_files}", level=logging.INFO)
+            self.log_console_only("📊 Final Status: Instagram %s | Facebook %s | 📦 Remaining files: %s", '✅' if instagram_success else '❌', '✅' if facebook_success else '❌', remaining_files, level=logging.INFO)
         elif media_type == "IMAGE":
-            self.log_console_only(f"📊 Final Status: Instagram {'✅' if instagram_success else '❌'} | Facebook {'✅' if facebook_success else '❌'} (image) | 📦 Remaining files: {remaining_files}", level=logging.INFO)
+            self.log_console_only("📊 Final Status: Instagram %s | Facebook %s (image) | 📦 Remaining files: %s", '✅' if instagram_success else '❌', '✅' if facebook_success else '❌', remaining_files, level=logging.INFO)
+        elif media_type == "CAROUSEL":
+            self.log_console_only("📊 Final Status: Instagram %s | Facebook %s (carousel) | 📦 Remaining files: %s", '✅' if instagram_success else '❌', '✅' if facebook_success else '❌', remaining_files, level=logging.INFO)
         else:
-            self.log_console_only(f"📊 Final Status: Instagram {'✅' if instagram_success else '❌'} | Facebook N/A | 📦 Remaining files: {remaining_files}", level=logging.INFO)
-        
-        # Return overall success (Instagram success is primary)
-        return instagram_success
+            self.log_console_only("📊 Final Status: Instagram %s | Facebook N/A | 📦 Remaining files: %s", '✅' if instagram_success else '❌', remaining_files, level=logging.INFO)
 
-    def run(self):
-        """Main execution method that orchestrates the posting process."""
-        self.log_console_only(f"📡 Run started at: {datetime.now(self.ist).strftime('%Y-%m-%d %H:%M:%S')}", level=logging.INFO)
-        
+    def create_instagram_container(self, source, file, caption, page_token):
+        """Create an IMAGE/REELS container (plus its story container) and wait until it is FINISHED.
+
+        Returns (creation_id, media_type, cover, story_id), or None with the failure recorded.
+        story_id is None when stories are off or the story container failed.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        media_type = "REELS" if file.name.lower().endswith((".mp4", ".mov")) else "IMAGE"
+        media_url = f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media"
+        temp_link = self.get_temporary_link(source, file.path_lower)
+        story_data = self.story_container_fields(source, file, media_type, temp_link, page_token)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # The story container is created while the cover is chosen and the feed container requested,
+            # on the pool thread's own session
+            story_future = pool.submit(lambda: self.session.post(media_url, data=story_data)) if story_data else None
+            data = {"access_token": page_token, "caption": caption}
+            cover = self.add_media_fields(source, file, media_type, temp_link, data)
+            res = self.session.post(media_url, data=data)
+            story_id = self.story_creation_id(story_future, file.name) if story_future else None
+        if res.status_code != 200 or not res.json().get("id"):
+            self.record_graph_failure("container", res)
+            self.send_message(f"❌ Instagram container creation failed: {file.name}\n📸 Error: {self.last_failure['message']}\n📸 Code: {self.last_failure['code']}", level=logging.ERROR)
+            return None
+        creation_id = res.json()["id"]
+        ok, finished = self.wait_for_containers([creation_id], page_token, optional=[story_id] if story_id else [])
+        if not ok:
+            return None
+        return creation_id, media_type, cover, story_id if story_id in finished else None
+
+    def expire_staged_containers(self, source, staged):
+        """Return the files of staged containers that would expire before publishing to the inbox."""
+        now = time.time()
+        live = []
+        for entry in staged:
+            if entry["expires_at"] - self.STAGED_CONTAINER_EXPIRY_MARGIN > now:
+                live.append(entry)
+                continue
+            returned = []
+            for path in entry["paths"]:
+                try:
+                    returned.append(source.move(path, f"{self.inbox_folder}/{os.path.basename(path)}", autorename=True))
+                except MediaSourceError as e:
+                    self.log_console_only("⚠️ Could not return staged file %s: %s", path, e, level=logging.WARNING, subsystem="dropbox")
+            self.send_message(f"⌛ Staged container for {entry['name']} (slot {entry['slot']}) expired unpublished; file(s) returned to the inbox", level=logging.WARNING)
+            if entry.get("fb") and returned:
+                page_token = self.get_verified_page_token() if entry["fb"]["scheduled_at"] > now else None
+                self.settle_facebook_for_unpublished(source, returned[0], entry["fb"], page_token)
+        return live
+
+    def stage_containers(self, source):
+        """Claim files for the upcoming slots and create their IG containers ahead of time.
+
+        Staged files wait in .staged and their containers in staged_containers.json
+        (slot, creation_id, 24h expiry) until the slot run publishes them.
+        Returns the number of containers staged.
+        """
+        page_token = self.get_verified_page_token()
+        if not page_token:
+            return 0
+        now = datetime.now(self.ist)
+        with self.state_lock:
+            staged = self.expire_staged_containers(source, self.load_state(source, "staged_containers.json", []))
+            self.save_state(source, "staged_containers.json", staged)
+        taken = {entry["slot"] for entry in staged}
+        slots = [slot for slot in self.get_upcoming_slots(now, now + timedelta(hours=self.staging_lookahead_hours))
+                 if slot.isoformat() not in taken]
+        if not slots:
+            self.log_console_only("📦 Every slot in the next %.0fh already has a staged container", self.staging_lookahead_hours, level=logging.INFO)
+            return 0
+
+        self.reap_stale_claims(source)
+        files = self.drop_skipped_files(self.filter_retry_backoff(source, self.list_inbox_files(source)))
+        count = 0
+        # Files claimed (or moved to .staged) for the slot in hand that are not on record yet
+        pending = None
+        try:
+            for slot in slots:
+                if not files:
+                    break
+                _attempt_state.set({})
+                file, group, hashes, carousel_prefix = self.claim_selected_files(source, files)
+                if file is None:
+                    break
+                pending, fb = group, None
+                claimed_names = {item.name for item in group}
+                files = [f for f in files if f.name not in claimed_names]
+                caption, _ = self.get_caption_from_config(slot)
+                self.log_console_only("📦 Staging %s for slot %s", carousel_prefix or file.name, slot.strftime('%a %H:%M'), level=logging.INFO)
+                try:
+                    post_media = self.prepare_post_media(source, file, group, carousel_prefix, files)
+                    if carousel_prefix:
+                        created = self.create_carousel_container(source, carousel_prefix, post_media, caption, page_token)
+                        if created:
+                            created = (created[0], "CAROUSEL", None, None, created[2])
+                        post_media = list(post_media)
+                    else:
+                        caption = self.build_caption_with_filename(post_media, caption)
+                        created = self.create_instagram_container(source, post_media, caption, page_token)
+                        if created:
+                            created = created + (caption,)
+                        post_media = [post_media]
+                except Exception as e:
+                    self.record_exception_failure("staging", e)
+                    self.send_message(f"❌ Exception while staging {file.name}: {e}", level=logging.ERROR)
+                    created = None
+                if not created:
+                    pending = None
+                    self.settle_attempt(source, group, False)
+                    continue
+
+                creation_id, media_type, cover, story_id, caption = created
+                # Originals that were posted as-is move with the claim; derived copies stay where they are
+                moved = {}
+                try:
+                    for item in group:
+                        moved[item.path_lower] = source.move(item.path_lower, f"{self.staging_folder}/{item.name}", autorename=True)
+                except Exception as e:
+                    # The container just expires unused; the files go back through the retry queue
+                    self.record_exception_failure("staging", e)
+                    self.send_message(f"❌ Could not move {file.name} to {self.staging_folder}: {e}", level=logging.ERROR)
+                    pending = None
+                    self.settle_attempt(source, [moved.get(item.path_lower, item) for item in group], False)
+                    continue
+                pending = list(moved.values())
+                post_media = [moved.get(f.path_lower, f) for f in post_media]
+                encode = _attempt_state.get({}).get("encode")
+                if encode and encode.get("path") in moved:
+                    # Sampled when the slot run publishes it, wherever the posted file is then
+                    encode["path"] = moved[encode["path"]].path_lower
+                fb = self.facebook_post_on_record(source, file)
+                if not fb and self.fb_scheduling:
+                    fb = self.schedule_facebook_for_slot(source, media_type, post_media, caption, cover, slot, page_token)
+                created_at = time.time()
+                staged.append({
+                    "slot": slot.isoformat(),
+                    "name": carousel_prefix or file.name,
+                    "creation_id": creation_id,
+                    "story_creation_id": story_id,
+                    "media_type": media_type,
+                    "carousel_prefix": carousel_prefix,
+                    "caption": caption,
+                    "cover": cover,
+                    "hashes": [[f"{p:016x}", f"{d:016x}"] for p, d in hashes or []],
+                    "paths": [item.path_lower for item in moved.values()],
+                    "post_paths": [f.path_lower for f in post_media],
+                    "fb": fb,
+                    "created_at": created_at,
+                    "expires_at": created_at + self.STAGED_CONTAINER_TTL,
+                    # Journaled when the slot run publishes it
+                    "encode": _attempt_state.get({}).get("encode"),
+                    "processing": _attempt_state.get({}).get("processing"),
+                })
+                with self.state_lock:
+                    self.save_state(source, "staged_containers.json", staged)
+                pending = None
+                self.send_message(f"📦 Staged {carousel_prefix or file.name} for {slot.strftime('%a %H:%M')} (container {creation_id})")
+                count += 1
+        except Exception as e:
+            # Whatever was claimed but not staged goes back through the retry queue
+            if pending:
+                self.record_exception_failure("staging", e)
+                self.settle_attempt(source, pending, False)
+                if fb:
+                    self.settle_facebook_for_unpublished(source, pending[0], fb, page_token)
+            raise
+        finally:
+            self.release_claim(source)
+        return count
+
+    def facebook_schedule_fields(self, scheduled_at):
+        """Extra Graph fields that turn a Page photo/video/feed post into a scheduled one."""
+        if not scheduled_at:
+            return {}
+        return {"published": "false", "scheduled_publish_time": str(int(scheduled_at))}
+
+    def format_slot_time(self, timestamp):
+        return datetime.fromtimestamp(timestamp, self.ist).strftime('%a %d %b %H:%M IST')
+
+    def schedule_facebook_for_slot(self, source, media_type, post_media, caption, cover, slot, page_token):
+        """Upload a slot's Facebook post now for Facebook to publish at the slot.
+
+        Returns the tracking entry {"id", "kind", "scheduled_at"}, or None when the
+        slot is too close or the upload failed (the slot run then posts live).
+        """
+        scheduled_at = slot.timestamp()
+        if scheduled_at - time.time() < self.FB_SCHEDULE_MIN_LEAD_SECONDS:
+            self.log_console_only("🗓️ Slot %s is too close to schedule on Facebook; it will be posted live", slot.strftime('%H:%M'), level=logging.INFO, subsystem="graph")
+            return None
+        try:
+            if media_type == "CAROUSEL":
+                temp_links = [self.get_temporary_link(source, f.path_lower) for f in post_media]
+                scheduled = self.post_album_to_facebook_page(post_media, temp_links, caption, page_token, scheduled_at)
+            else:
+                scheduled = self.post_to_facebook_page(source, post_media[0], caption, page_token, None, cover, scheduled_at)
+        except Exception as e:
+            self.log_console_only("⚠️ Facebook scheduling failed: %s", e, level=logging.WARNING, subsystem="graph")
+            return None
+        fb = _attempt_state.get({}).get("post_ids", {}).get("fb")
+        if not scheduled or not fb:
+            return None
+        return {"id": fb["id"], "kind": fb["kind"], "scheduled_at": scheduled_at}
+
+    def reschedule_facebook_post(self, fb, scheduled_at, page_token):
+        """Move a scheduled Facebook post to ``scheduled_at`` (unix time), or publish it now when None."""
+        if scheduled_at is None:
+            data = {"is_published": "true"} if fb["kind"] == "post" else {"published": "true"}
+        else:
+            data = {"scheduled_publish_time": str(int(scheduled_at))}
+        res = self.session.post(f"https://graph.facebook.com/{fb['id']}", data={**data, "access_token": page_token})
+        if res.status_code != 200:
+            self.log_console_only("⚠️ Could not reschedule Facebook %s %s: %s", fb["kind"], fb["id"], res.text[:200], level=logging.WARNING, subsystem="graph")
+            return False
+        fb["scheduled_at"] = scheduled_at or time.time()
+        self.log_console_only("🗓️ Facebook %s %s now publishes at %s", fb["kind"], fb["id"], self.format_slot_time(fb["scheduled_at"]), level=logging.INFO, subsystem="graph")
+        return True
+
+    def cancel_facebook_post(self, fb, page_token):
+        """Delete a scheduled (not yet published) Facebook post."""
+        res = self.session.delete(f"https://graph.facebook.com/{fb['id']}", params={"access_token": page_token})
+        if res.status_code != 200:
+            self.log_console_only("⚠️ Could not cancel Facebook %s %s: %s", fb["kind"], fb["id"], res.text[:200], level=logging.WARNING, subsystem="graph")
+            return False
+        self.send_message(f"🗑️ Cancelled scheduled Facebook {fb['kind']} {fb['id']}", level=logging.WARNING)
+        return True
+
+    def take_due_staged_containers(self, source, count):
+        """Remove and return up to ``count`` staged containers whose slot has arrived, earliest first."""
+        with self.state_lock:
+            staged = self.load_state(source, "staged_containers.json", [])
+            if not staged:
+                return []
+            staged = self.expire_staged_containers(source, staged)
+            cutoff = datetime.now(self.ist) + timedelta(minutes=self.staging_slot_grace_minutes)
+            # A /skip'ed entry stays staged until its container expires and the files return to the inbox
+            due = sorted((e for e in staged if datetime.fromisoformat(e["slot"]) <= cutoff and e["name"].lower() not in self.skipped_files),
+                         key=lambda e: e["slot"])[:count]
+            self.save_state(source, "staged_containers.json", [e for e in staged if e not in due])
+        return due
+
+    def publish_staged_container(self, source, entry, page_token):
+        """Publish a pre-staged container (one media_publish call), then post to Facebook and settle.
+
+        Returns (group, media_type, instagram_success, facebook_success) like process_claim_async.
+        """
+        _attempt_state.set({"started_at": time.time(), "encode": entry.get("encode"), "processing": entry.get("processing")})
+        group = [source.get_metadata(path) for path in entry["paths"]]
+        media_type, carousel_prefix = entry["media_type"], entry.get("carousel_prefix")
+        hashes = [(int(p, 16), int(d, 16)) for p, d in entry.get("hashes") or []]
+        instagram_id = self.publish_container(entry["creation_id"], page_token)
+        if not instagram_id:
+            self.send_message(f"❌ Publishing staged container failed: {entry['name']}\n📸 Error: {self.last_failure['message']}\n📸 Code: {self.last_failure['code']}", level=logging.ERROR)
+            if entry.get("fb"):
+                # Keep Facebook in step with Instagram: the files go back through settle_attempt
+                self.settle_facebook_for_unpublished(source, group[0], entry["fb"], page_token)
+            self.finish_attempt(source, group[0], group, hashes, carousel_prefix, media_type, False)
+            return group, media_type, False, False
+
+        self.note_post_id("ig", instagram_id)
+        lag = (datetime.now(self.ist) - datetime.fromisoformat(entry["slot"])).total_seconds()
+        self.send_message(f"✅ Staged Instagram post published!\n📸 Media ID: {instagram_id}\n⏱️ {lag:+.0f}s from slot {entry['slot']}")
+        self.verify_instagram_post_by_media_id(instagram_id, page_token)
+        if entry.get("story_creation_id"):
+            self.publish_story(entry["story_creation_id"], page_token, entry["name"])
+
+        post_media = [source.get_metadata(path) for path in entry["post_paths"]]
+        if entry.get("fb"):
+            # Uploaded during staging; Facebook publishes it at the slot by itself, or now when we are early
+            if entry["fb"]["scheduled_at"] - time.time() > self.FB_RESCHEDULE_TOLERANCE_SECONDS:
+                self.reschedule_facebook_post(entry["fb"], None, page_token)
+            self.note_post_id("fb", entry["fb"]["id"], kind=entry["fb"]["kind"])
+            facebook_success = True
+        elif media_type == "CAROUSEL":
+            temp_links = [self.get_temporary_link(source, f.path_lower) for f in post_media]
+            facebook_success = self.post_album_to_facebook_page(post_media, temp_links, entry["caption"], page_token)
+        else:
+            facebook_success = self.post_to_facebook_page(source, post_media[0], entry["caption"], page_token, None, entry.get("cover"))
+        self.finish_attempt(source, group[0], group, hashes, carousel_prefix, media_type, True)
+        return group, media_type, True, facebook_success
+
+    def put_back_staged_container(self, source, entry):
+        with self.state_lock:
+            self.save_state(source, "staged_containers.json", self.load_state(source, "staged_containers.json", []) + [entry])
+
+    def recover_staged_container(self, source, entry):
+        """Settle a staged entry whose publish raised, so its files never sit in .staged unaccounted for.
+
+        Before Instagram went live the entry is put back for the next run (or for
+        expiry to return its files); after, the post is journaled and settled as
+        published even if Facebook did not follow. Returns the outcome, or None.
+        """
+        if "ig" not in _attempt_state.get({}).get("post_ids", {}):
+            self.put_back_staged_container(source, entry)
+            self.send_message(f"↩️ {entry['name']} stays staged for the next run", level=logging.WARNING)
+            return None
+        try:
+            group = [source.get_metadata(path) for path in entry["paths"]]
+        except Exception as e:
+            self.send_message(f"❌ {entry['name']} is live on Instagram but its staged files could not be settled: {e}", level=logging.ERROR)
+            return None
+        hashes = [(int(p, 16), int(d, 16)) for p, d in entry.get("hashes") or []]
+        self.finish_attempt(source, group[0], group, hashes, entry.get("carousel_prefix"), entry["media_type"], True)
+        return group, entry["media_type"], True, False
+
+    def publish_due_staged_containers(self, source, count):
+        """Publish staged containers due at this slot; returns their outcomes."""
+        due = self.take_due_staged_containers(source, count)
+        if not due:
+            return []
+        page_token = self.get_verified_page_token()
+        outcomes = []
+        for entry in due:
+            if not page_token:
+                # Put it back for the next run rather than losing the container
+                self.put_back_staged_container(source, entry)
+                continue
+            try:
+                outcomes.append(self.publish_staged_container(source, entry, page_token))
+            except Exception as e:
+                self.record_exception_failure("publish", e)
+                self.send_message(f"❌ Exception publishing staged container {entry['name']}: {e}", level=logging.ERROR)
+                outcome = self.recover_staged_container(source, entry)
+                if outcome:
+                    outcomes.append(outcome)
+        return outcomes
+
+    def run_staging(self):
+        """Off-peak run: stage IG containers for the upcoming slots without publishing anything."""
+        self.log_console_only("📦 Staging run started at: %s", datetime.now(self.ist).strftime('%Y-%m-%d %H:%M:%S'), level=logging.INFO)
         try:
-            # Check token expiry first
-            token_valid = self.check_token_expiry()
-            if not token_valid:
+            if not self.check_token_expiry():
                 self.send_message("❌ Token validation failed. Stopping execution.", level=logging.ERROR)
                 return
-            
-            # List available pages for configuration help
-            self.list_available_pages()
-            
-            # Get caption from config
-            caption, description = self.get_caption_from_config()
-            
-            # Authenticate with Dropbox
-            dbx = self.authenticate_dropbox()
-            
-            # Try posting one file only
-            success = self.process_files_with_retries(dbx, caption, description, max_retries=1)
-            
-            if success:
-                self.send_message("🎉 Instagram post completed successfully!", level=logging.INFO)
-                self.log_console_only("📊 Summary: Instagram ✅ | Facebook status reported separately above", level=logging.INFO)
+            source = self.open_media_source()
+            count = self.stage_containers(source)
+            self.send_message(f"📦 Staging run complete: {count} container(s) staged")
+        finally:
+            self.export_metrics()
+
+    async def send_message_async(self, client, msg, level=logging.INFO):
+        """Async counterpart of send_message using the Telegram Bot HTTP API directly."""
+        full_msg = f"[{self.script_name}]\n{msg}"
+        try:
+            if self.telegram_token and self.telegram_chat_id:
+                await client.post(f"https://api.telegram.org/bot{self.telegram_token}/sendMessage",
+                                  data={"chat_id": self.telegram_chat_id, "text": full_msg})
+            self.logger.log(level, msg, extra={"script": self.script_name, "telegram": True})
+        except Exception as e:
+            self.loggers["telegram"].error("Telegram send error for message %r: %s", msg, e, extra={"script": self.script_name})
+
+    async def post_to_instagram_async(self, client, source, file, caption, page_token, total_files, post_facebook=True):
+        """Post a single IMAGE/REELS file through the same container helpers staging uses.
+
+        Returns (success, media_type, instagram_success, facebook_success). Container
+        creation, polling and Facebook uploads run in worker threads so other posts
+        keep moving on the event loop.
+        """
+        name = file.name
+        media_type = "REELS" if name.lower().endswith((".mp4", ".mov")) else "IMAGE"
+        await self.send_message_async(client, f"🚀 Starting upload process for: {name}")
+        caption = self.build_caption_with_filename(file, caption)
+        created = await asyncio.to_thread(self.create_instagram_container, source, file, caption, page_token)
+        if not created:
+            return False, media_type, False, False
+        creation_id, media_type, cover, story_id = created
+        if media_type == "REELS":
+            await self.pause_async(15)
+
+        instagram_id = await asyncio.to_thread(self.publish_container, creation_id, page_token)
+        if not instagram_id:
+            await self.send_message_async(client, f"❌ Instagram publish failed: {name}\n📸 Error: {self.last_failure['message']}\n📸 Code: {self.last_failure['code']}", level=logging.ERROR)
+            return False, media_type, False, False
+        self.note_post_id("ig", instagram_id)
+        await self.send_message_async(client, f"✅ Instagram post published successfully!\n📸 Media ID: {instagram_id}\n📸 Account ID: {self.ig_id}\n📦 Files left: {total_files}")
+
+        self.verify_instagram_post_by_media_id(instagram_id, page_token)
+        if story_id:
+            await asyncio.to_thread(self.publish_story, story_id, page_token, name)
+        if not post_facebook:
+            return True, media_type, True, True
+        facebook_success = await asyncio.to_thread(self.post_to_facebook_page, source, file, caption, page_token, None, cover)
+        return True, media_type, True, facebook_success
+
+    async def process_claim_async(self, client, source, claim, files, caption, description, page_token, total_files):
+        """Post one claimed file (or carousel) and settle it; returns Instagram success."""
+        _attempt_state.set({"started_at": time.time()})
+        file, group, hashes, carousel_prefix = claim
+        try:
+            post_facebook = not await asyncio.to_thread(self.facebook_post_on_record, source, file)
+            post_media = await asyncio.to_thread(self.prepare_post_media, source, file, group, carousel_prefix, files)
+            if carousel_prefix:
+                result = await asyncio.to_thread(self.post_carousel_to_instagram, source, carousel_prefix, post_media, caption, description, post_facebook)
+            elif not page_token:
+                result = False
             else:
-                self.send_message("❌ Instagram post failed.", level=logging.ERROR)
-            
+                result = await self.post_to_instagram_async(client, source, post_media, caption, page_token, total_files, post_facebook)
+            media_type, instagram_success, facebook_success = self.unpack_post_result(result)
         except Exception as e:
-            self.send_message(f"❌ Script crashed:\n{str(e)}", level=logging.ERROR)
-            raise
-        finally:
-            # Send token expiry info before completion
-            self.send_token_expiry_info()
-            duration = time.time() - self.start_time
-            self.log_console_only(f"🏁 Run complete in {duration:.1f} seconds", level=logging.INFO)
+            self.record_exception_failure("exception", e)
+            await self.send_message_async(client, f"❌ Exception during post for {file.name}: {e}", level=logging.ERROR)
+            media_type, instagram_success, facebook_success = None, False, False
+        await asyncio.to_thread(self.finish_attempt, source, file, group, hashes, carousel_prefix, media_type, instagram_success)
+        return group, media_type, instagram_success, facebook_success
+
+    def claim_batch(self, source, files, count):
+        """Claim up to ``count`` files (with carousel siblings) for this run."""
+        claims = []
+        for _ in range(count):
+            if not files:
+                break
+            claim = self.claim_selected_files(source, files)
+            if claim[0] is None:
+                break
+            claims.append(claim)
+            claimed_names = {item.name for item in claim[1]}
+            files = [f for f in files if f.name not in claimed_names]
+        return claims, files
+
+    async def process_files_async(self, client, source, caption, description, max_posts):
+        """Publish containers staged for this slot, then claim and post new files up to max_posts."""
+        await asyncio.to_thread(self.reap_stale_claims, source)
+        # Staged containers only need media_publish, so they go first
+        outcomes = await asyncio.to_thread(self.publish_due_staged_containers, source, max_posts)
+        if len(outcomes) < max_posts:
+            outcomes += await self.process_new_files_async(client, source, caption, description, max_posts - len(outcomes))
+        self.last_outcomes = outcomes
+        if not outcomes:
+            return False
+
+        remaining_files = await asyncio.to_thread(self.get_remaining_files_count, source)
+        for group, media_type, instagram_success, facebook_success in outcomes:
+            await asyncio.to_thread(self.report_attempt, group, media_type, instagram_success, facebook_success, remaining_files)
+        return all(outcome[2] for outcome in outcomes)
+
+    async def process_new_files_async(self, client, source, caption, description, max_posts):
+        """Claim up to max_posts inbox files and post them concurrently on one event loop."""
+        files = await asyncio.to_thread(lambda: self.drop_skipped_files(self.filter_retry_backoff(source, self.list_inbox_files(source))))
+        if not files:
+            self.log_console_only("📭 No files found in the inbox folder.", level=logging.INFO)
+            return []
+
+        claims, files = await asyncio.to_thread(self.claim_batch, source, files, max_posts)
+        if not claims:
+            await asyncio.to_thread(self.release_claim, source)
+            self.log_console_only("📭 No files could be claimed for this run.", level=logging.INFO)
+            return []
+        self.log_console_only("🎯 Processing %s file(s): %s", len(claims), ', '.join((c[0].name for c in claims)), level=logging.INFO)
+
+        page_token = await asyncio.to_thread(self.get_verified_page_token)
+        semaphore = asyncio.Semaphore(self.async_concurrency)
+
+        async def guarded(claim):
+            async with semaphore:
+                return await self.process_claim_async(client, source, claim, files, caption, description, page_token, len(files))
+
+        outcomes = await asyncio.gather(*(guarded(claim) for claim in claims))
+        await asyncio.to_thread(self.release_claim, source)
+        return list(outcomes)
+
+    async def run_async(self, max_posts=None):
+        """Async engine: posts run concurrently on one event loop, blocking Graph and media source calls in worker threads."""
+        import httpx
+        max_posts = max_posts or self.posts_per_run
+        self.start_time = time.time()
+        self.last_outcomes = []
+        success, error = None, None
+        self.log_console_only("📡 Run started at: %s", datetime.now(self.ist).strftime('%Y-%m-%d %H:%M:%S'), level=logging.INFO)
+
+        # Every in-flight post holds a worker thread while it waits on Graph; the default executor
+        # (min(32, cpus + 4) threads) would otherwise cap ASYNC_CONCURRENCY on small runners
+        from concurrent.futures import ThreadPoolExecutor
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self.async_concurrency + 4, thread_name_prefix="inkwisps-worker"))
+
+        limits = httpx.Limits(max_connections=self.async_concurrency * 2)
+        event_hooks = {"request": [self.on_httpx_request], "response": [self.on_httpx_response]}
+        transport = self.cassette_transport() if self.cassette else None
+        async with httpx.AsyncClient(timeout=60, limits=limits, event_hooks=event_hooks, transport=transport) as client:
+            try:
+                # Check token expiry first
+                token_valid = await asyncio.to_thread(self.check_token_expiry)
+                if not token_valid:
+                    await self.send_message_async(client, "❌ Token validation failed. Stopping execution.", level=logging.ERROR)
+                    return
+
+                # List available pages for configuration help
+                await asyncio.to_thread(self.list_available_pages)
+
+                caption, description = self.get_caption_from_config()
+                source = await asyncio.to_thread(self.open_media_source)
+
+                success = await self.process_files_async(client, source, caption, description, max_posts)
+
+                try:
+                    await asyncio.to_thread(self.collect_insights, source)
+                except Exception as e:
+                    self.log_console_only("⚠️ Insights collection failed: %s", e, level=logging.WARNING)
+
+                if success:
+                    await self.send_message_async(client, "🎉 Instagram post completed successfully!")
+                    self.log_console_only("📊 Summary: Instagram ✅ | Facebook status reported separately above", level=logging.INFO)
+                else:
+                    await self.send_message_async(client, "❌ Instagram post failed.", level=logging.ERROR)
+
+            except Exception as e:
+                error = str(e)
+                await self.send_message_async(client, f"❌ Script crashed:\n{str(e)}", level=logging.ERROR)
+                raise
+            finally:
+                # Verifications resolve in the background; report them before the run ends
+                await asyncio.to_thread(self.verifier.drain, self.VERIFY_INTERVAL_SECONDS * (self.VERIFY_ATTEMPTS + 1))
+                if self.verifier.resolved:
+                    self.log_console_only("🔍 %s verification(s) settled with %s multi-ID lookup(s)", self.verifier.resolved, self.verifier.lookups, level=logging.INFO, subsystem="graph")
+                # Send token expiry info before completion
+                await asyncio.to_thread(self.send_token_expiry_info)
+                duration = time.time() - self.start_time
+                self.last_run = {"finished_at": time.time(), "duration": duration, "success": success, "error": error,
+                                 "outcomes": [(", ".join(f.name for f in group), media_type, ig, fb)
+                                              for group, media_type, ig, fb in self.last_outcomes]}
+                self.log_console_only("🏁 Run complete in %.1f seconds", duration, level=logging.INFO)
+                self.metrics.observe("run_duration_seconds", duration, "Wall time of a posting run")
+                self.metrics.set("last_run_timestamp_seconds", time.time(), "Unix time the last run finished")
+                await asyncio.to_thread(self.export_metrics)
+                if self.cassette and self.cassette.mode == "record":
+                    self.cassette.save()
+                    self.log_console_only("📼 Recorded %s HTTP interactions to %s", len(self.cassette.interactions), self.cassette.path, level=logging.INFO)
+                elif self.cassette and self.cassette.unused():
+                    self.log_console_only("⚠️ %s recorded interactions were not replayed (flow diverged from the recording)", self.cassette.unused(), level=logging.WARNING)
+
+    def run(self):
+        """Main execution method: a thin synchronous wrapper around run_async."""
+        asyncio.run(self.run_async())
+
+    def get_posting_slots(self):
+        """Daily posting times ("HH:MM", IST) for daemon mode from scheduler/config.json."""
+        try:
+            with open(self.schedule_file, 'r') as f:
+                config = json.load(f)
+            return config.get(self.account_key, {}).get("slots") or list(self.DEFAULT_POSTING_SLOTS)
+        except (OSError, ValueError) as e:
+            self.log_console_only("⚠️ Could not read posting slots, using defaults: %s", e, level=logging.WARNING)
+            return list(self.DEFAULT_POSTING_SLOTS)
+
+    def get_upcoming_slots(self, now, until):
+        """Return the posting slots in (now, until] as aware IST datetimes, earliest first."""
+        times = [tuple(int(part) for part in slot.split(":")) for slot in self.get_posting_slots()]
+        day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        upcoming = []
+        while day <= until:
+            upcoming += [at for at in (day.replace(hour=h, minute=m) for h, m in times) if now < at <= until]
+            day += timedelta(days=1)
+        return sorted(upcoming)
+
+    def get_next_slot(self, now=None):
+        """Return the next posting slot after ``now`` as an aware IST datetime."""
+        now = now or datetime.now(self.ist)
+        return self.get_upcoming_slots(now, now + timedelta(days=1))[0]
+
+    def run_daemon(self):
+        """Stay resident: post at each slot, serve live metrics and answer Telegram commands between runs."""
+        self.daemon_started_at = time.time()
+        self.start_metrics_server()
+        self.refresh_command_state()
+        self.start_command_loop()
+        while True:
+            self.apply_facebook_cancellations()
+            if self.container_staging:
+                try:
+                    self.run_staging()
+                except Exception as e:
+                    self.log_console_only("❌ Staging failed: %s", e, level=logging.ERROR)
+            self.next_slot = next_slot = self.get_next_slot()
+            wait = (next_slot - datetime.now(self.ist)).total_seconds()
+            self.log_console_only("💤 Next slot at %s (in %.0f min)", next_slot.strftime('%Y-%m-%d %H:%M'), wait / 60, level=logging.INFO)
+            # Commands wake the daemon early; the slot it was waiting for still runs on the next pass
+            deadline = time.monotonic() + max(0, wait)
+            while not self.post_now.is_set() and self.daemon_wake.wait(max(0, deadline - time.monotonic())):
+                self.daemon_wake.clear()
+                self.apply_facebook_cancellations()
+            if self.post_now.is_set():
+                self.post_now.clear()
+                self.log_console_only("🚀 Running now on /postnow", level=logging.INFO)
+            self.run_in_progress = True
+            try:
+                self.run()
+            except Exception as e:
+                self.log_console_only("❌ Run at %s crashed: %s", next_slot.strftime('%H:%M'), e, level=logging.ERROR)
+            finally:
+                self.run_in_progress = False
+
+    def refresh_command_state(self):
+        """Prime the in-memory snapshots the Telegram commands read; runs keep them current afterwards."""
+        try:
+            source = self.open_media_source()
+            self.list_inbox_files(source)
+            self.load_state(source, "staged_containers.json", [])
+            self.load_state(source, "retry_queue.json", {})
+            self.load_state(source, "journal.json", [])
+            if self.selection_strategy == "priority":
+                self.sync_selection_index(source)
+        except Exception as e:
+            self.log_console_only("⚠️ Could not prime command state: %s", e, level=logging.WARNING)
+
+    def start_command_loop(self):
+        """Serve Telegram commands from the configured chat on a background long-poll thread."""
+        if not (self.telegram_token and self.telegram_chat_id) or self.cassette:
+            return
+        threading.Thread(target=self.poll_commands, name="telegram-commands", daemon=True).start()
+        self.log_console_only("🤖 Listening for Telegram commands", level=logging.INFO, subsystem="telegram")
+
+    def poll_commands(self):
+        """getUpdates long-poll loop; replies never touch the media source or the Graph API."""
+        api = f"https://api.telegram.org/bot{self.telegram_token}"
+        # Own session: long polls would skew HTTP metrics; the cassette still records and replays them
+        session = requests.Session()
+        self.mount_cassette(session)
+        offset = None
+        while True:
+            try:
+                res = session.get(f"{api}/getUpdates", params={"offset": offset, "timeout": self.COMMAND_POLL_TIMEOUT,
+                                                               "allowed_updates": '["message"]'},
+                                  timeout=self.COMMAND_POLL_TIMEOUT + 10)
+                for update in res.json().get("result", []):
+                    offset = update["update_id"] + 1
+                    message = update.get("message") or {}
+                    if str(message.get("chat", {}).get("id")) != str(self.telegram_chat_id):
+                        continue
+                    # Commands queued while the daemon was down are stale (a late /postnow would post off-slot)
+                    if message.get("date", 0) < self.daemon_started_at:
+                        continue
+                    reply = self.handle_command(message.get("text") or "")
+                    if reply:
+                        session.post(f"{api}/sendMessage", data={"chat_id": self.telegram_chat_id, "text": reply})
+            except Exception as e:
+                self.log_console_only("⚠️ Telegram command poll failed: %s", e, level=logging.WARNING, subsystem="telegram")
+                time.sleep(5)
+
+    def handle_command(self, text):
+        """Dispatch "/command args" to its command_* method and return the reply text."""
+        if not text.startswith("/"):
+            return None
+        name, *args = text.split()
+        name = name[1:].split("@")[0].lower()
+        handler = getattr(self, f"command_{name}", None)
+        if handler is None:
+            return self.command_help(args)
+        self.log_console_only("🤖 Command /%s %s", name, " ".join(args), level=logging.INFO, subsystem="telegram")
+        try:
+            return handler(args)
+        except Exception as e:
+            return f"❌ /{name} failed: {e}"
+
+    def format_age(self, seconds):
+        minutes = int(max(0, seconds) // 60)
+        return f"{minutes // 60}h {minutes % 60:02d}m" if minutes >= 60 else f"{minutes} min"
+
+    def snapshot_eligible_files(self):
+        """Inbox files from the last listing minus retry backoff and /skip, in the order selection would prefer."""
+        if not self.inbox_snapshot:
+            return []
+        queue = self.state_snapshots.get("retry_queue.json") or {}
+        now = time.time()
+        waiting = {h for h, entry in queue.items() if entry.get("next_attempt_at", 0) > now}
+        files = [f for f in self.inbox_snapshot[1]
+                 if f.content_hash not in waiting and f.name.lower() not in self.skipped_files]
+        index = self.selection_index
+        if self.selection_strategy == "priority" and index:
+            missing = float("inf")
+            return sorted(files, key=lambda f: (index.entries.get(f.path_lower) or {}).get("key", missing))
+        return sorted(files, key=lambda f: f.server_modified)
+
+    def staged_snapshot(self):
+        return sorted(self.state_snapshots.get("staged_containers.json") or [], key=lambda e: e["slot"])
+
+    def command_help(self, args):
+        return ("🤖 Commands:\n"
+                "/status – daemon, last run and backlog\n"
+                "/queue – staged containers and inbox order\n"
+                "/next – what the next slot will post\n"
+                "/skip <file> – hold a file back (/unskip <file> to release)\n"
+                "/postnow – run now instead of waiting for the slot")
+
+    def command_status(self, args):
+        now = time.time()
+        lines = [f"🟢 Daemon up {self.format_age(now - (self.daemon_started_at or now))}"
+                 + (" · ⏳ run in progress" if self.run_in_progress else "")]
+        if self.next_slot:
+            lines.append(f"⏰ Next slot: {self.next_slot.strftime('%a %H:%M')} (in {self.format_age(self.next_slot.timestamp() - now)})")
+        run = self.last_run
+        if run:
+            state = "❌ crashed" if run["error"] else ("✅" if run["success"] else "❌" if run["outcomes"] else "📭 nothing posted")
+            finished = datetime.fromtimestamp(run["finished_at"], self.ist).strftime('%a %H:%M')
+            lines.append(f"🏁 Last run: {finished}, {run['duration']:.0f}s — {state}")
+            for name, media_type, ig, fb in run["outcomes"]:
+                lines.append(f"  • {name} ({media_type}) IG {'✅' if ig else '❌'} FB {'✅' if fb else '❌'}")
+            if run["error"]:
+                lines.append(f"  {run['error']}")
+        else:
+            lines.append("🏁 No run since the daemon started")
+        if self.inbox_snapshot:
+            listed_at, files = self.inbox_snapshot
+            videos = sum(1 for f in files if f.name.lower().endswith(('.mp4', '.mov')))
+            lines.append(f"📥 Inbox: {len(files)} file(s) ({videos} video, {len(files) - videos} image) as of "
+                         f"{datetime.fromtimestamp(listed_at, self.ist).strftime('%H:%M')}")
+        queue = self.state_snapshots.get("retry_queue.json") or {}
+        waiting = sum(1 for entry in queue.values() if entry.get("next_attempt_at", 0) > now)
+        lines.append(f"📦 Staged: {len(self.staged_snapshot())} · 🔁 Retry backoff: {waiting} · ⏭️ Skipped: {len(self.skipped_files)}")
+        return "\n".join(lines)
+
+    def command_queue(self, args):
+        lines = []
+        staged = self.staged_snapshot()
+        if staged:
+            lines.append("📦 Staged:")
+            for entry in staged:
+                slot = datetime.fromisoformat(entry["slot"]).strftime('%a %H:%M')
+                held = " ⏭️" if entry["name"].lower() in self.skipped_files else ""
+                lines.append(f"  {slot} {entry['name']} ({entry['media_type']}){' + FB scheduled' if entry.get('fb') else ''}{held}")
+        files = self.snapshot_eligible_files()
+        if self.inbox_snapshot is None:
+            lines.append("📥 Inbox not listed yet")
+        else:
+            order = "priority order" if self.selection_strategy == "priority" and self.selection_index else "random selection, listed oldest first"
+            lines.append(f"📥 Inbox: {len(files)} eligible ({order})")
+            lines += [f"  {i}. {f.name}" for i, f in enumerate(files[:self.COMMAND_LIST_LIMIT], 1)]
+            if len(files) > self.COMMAND_LIST_LIMIT:
+                lines.append(f"  … and {len(files) - self.COMMAND_LIST_LIMIT} more")
+        if self.skipped_files:
+            lines.append(f"⏭️ Skipped: {', '.join(sorted(self.skipped_files))}")
+        return "\n".join(lines)
+
+    def command_next(self, args):
+        slot = self.next_slot or self.get_next_slot()
+        header = f"⏰ Next slot: {slot.strftime('%a %H:%M')} (in {self.format_age(slot.timestamp() - time.time())})"
+        cutoff = slot + timedelta(minutes=self.staging_slot_grace_minutes)
+        for entry in self.staged_snapshot():
+            if datetime.fromisoformat(entry["slot"]) <= cutoff and entry["name"].lower() not in self.skipped_files:
+                return f"{header}\n📦 Staged: {entry['name']} ({entry['media_type']})"
+        files = self.snapshot_eligible_files()
+        if not files:
+            return f"{header}\n📭 Nothing eligible in the inbox"
+        if self.selection_strategy == "priority" and self.selection_index:
+            journal = self.state_snapshots.get("journal.json") or []
+            last_type = journal[-1].get("media_type") if journal else None
+            for f in files:
+                entry = self.selection_index.entries.get(f.path_lower)
+                if entry and entry["type"] != last_type:
+                    return f"{header}\n🏆 Top candidate: {f.name}"
+            return f"{header}\n🏆 Top candidate: {files[0].name}"
+        return f"{header}\n🎲 Random pick from {len(files)} eligible file(s)"
+
+    def command_skip(self, args):
+        if not args:
+            return f"⏭️ Skipped: {', '.join(sorted(self.skipped_files)) or 'none'}\nUsage: /skip <file>"
+        name = " ".join(args).lower()
+        known = {f.name.lower() for f in (self.inbox_snapshot[1] if self.inbox_snapshot else [])}
+        staged = {entry["name"].lower(): entry for entry in self.staged_snapshot()}
+        if name not in known and name not in staged:
+            return f"❓ {name} is not in the inbox or staged (as of the last listing)"
+        self.skipped_files.add(name)
+        if name in staged:
+            note = ""
+            if staged[name].get("fb"):
+                # Handlers only touch memory; the daemon loop talks to the media source and Graph
+                self.pending_fb_cancellations.add(name)
+                self.daemon_wake.set()
+                note = " Its scheduled Facebook post will be cancelled."
+            return (f"⏭️ {name} is held back; its staged container returns to the inbox when it expires.{note}")
+        return f"⏭️ {name} will not be picked until /unskip {name}"
+
+    def apply_facebook_cancellations(self):
+        """Cancel the scheduled Facebook posts queued by /skip, unless the file was /unskip'ed meanwhile."""
+        while self.pending_fb_cancellations:
+            name = self.pending_fb_cancellations.pop()
+            if name in self.skipped_files and not self.cancel_staged_facebook_post(name):
+                self.send_message(f"⚠️ The Facebook post of {name} could not be cancelled; the retry will post to Instagram only.", level=logging.WARNING)
+
+    def cancel_staged_facebook_post(self, name):
+        """Cancel the scheduled Facebook post of a staged entry held back with /skip; True when cancelled."""
+        try:
+            source = self.open_media_source()
+            with self.state_lock:
+                staged = self.load_state(source, "staged_containers.json", [])
+                entry = next((e for e in staged if e["name"].lower() == name and e.get("fb")), None)
+                if entry is None or entry["fb"]["scheduled_at"] <= time.time():
+                    return False
+                page_token = self.get_page_access_token()
+                if not page_token or not self.cancel_facebook_post(entry["fb"], page_token):
+                    return False
+                # Without a Facebook post the entry is posted live if it is /unskip'ed in time
+                entry["fb"] = None
+                self.save_state(source, "staged_containers.json", staged)
+                return True
+        except Exception as e:
+            self.log_console_only("⚠️ Could not cancel the Facebook post of %s: %s", name, e, level=logging.WARNING)
+            return False
+
+    def command_unskip(self, args):
+        name = " ".join(args).lower()
+        if name not in self.skipped_files:
+            return f"❓ {name or '<file>'} is not skipped"
+        self.skipped_files.discard(name)
+        return f"▶️ {name} is eligible again"
+
+    def command_postnow(self, args):
+        if self.run_in_progress:
+            return "⏳ A run is already in progress"
+        self.post_now.set()
+        self.daemon_wake.set()
+        return "🚀 Starting a run now"
 
     def check_token_expiry(self):
         """Check Meta token expiry and send Telegram notification."""
         try:
-            self.log_console_only("🔍 Checking token expiry...", level=logging.INFO)
+            self.log_console_only("🔍 Checking token expiry...", level=logging.INFO, subsystem="graph")
             url = "https://graph.facebook.com/debug_token"
             params = {
                 "input_token": self.meta_token,
@@ -765,9 +4590,9 @@ class DropboxToInstagramUploader:
                 
                 if expires_at:
                     dt = datetime.fromtimestamp(expires_at).astimezone(self.ist)
-                    self.log_console_only(f"🔐 Token Valid: {is_valid}\n⏳ Expires at: {dt.strftime('%Y-%m-%d %H:%M:%S')}", level=logging.INFO)
+                    self.log_console_only("🔐 Token Valid: %s\n⏳ Expires at: %s", is_valid, dt.strftime('%Y-%m-%d %H:%M:%S'), level=logging.INFO, subsystem="graph")
                 else:
-                    self.log_console_only("🔐 Token is long-lived or does not expire.", level=logging.INFO)
+                    self.log_console_only("🔐 Token is long-lived or does not expire.", level=logging.INFO, subsystem="graph")
                 
                 return is_valid
             else:
@@ -781,23 +4606,23 @@ class DropboxToInstagramUploader:
     def check_page_permissions(self, page_token):
         """Check what permissions the page access token has."""
         try:
-            self.log_console_only("🔍 Checking page permissions...", level=logging.INFO)
+            self.log_console_only("🔍 Checking page permissions...", level=logging.INFO, subsystem="graph")
             url = f"https://graph.facebook.com/v18.0/me/permissions"
             params = {"access_token": page_token}
             
-            self.log_console_only(f"📡 Permission check URL: {url}", level=logging.INFO)
+            self.log_console_only("📡 Permission check URL: %s", url, level=logging.INFO, subsystem="graph")
             
             res = self.session.get(url, params=params)
-            self.log_console_only(f"📊 Permission check response status: {res.status_code}", level=logging.INFO)
+            self.log_console_only("📊 Permission check response status: %s", res.status_code, level=logging.INFO, subsystem="graph")
             
             if res.status_code == 200:
                 permissions = res.json().get("data", [])
-                self.log_console_only(f"📋 Found {len(permissions)} permissions:", level=logging.INFO)
+                self.log_console_only("📋 Found %s permissions:", len(permissions), level=logging.INFO, subsystem="graph")
                 
                 for perm in permissions:
                     permission_name = perm.get("permission", "Unknown")
                     status = perm.get("status", "Unknown")
-                    self.log_console_only(f"🔑 {permission_name}: {status}", level=logging.INFO)
+                    self.log_console_only("🔑 %s: %s", permission_name, status, level=logging.INFO, subsystem="graph")
                 
                 # Check for specific permissions needed for video upload
                 has_publish_video = any(p.get("permission") == "publish_video" and p.get("status") == "granted" for p in permissions)
@@ -805,11 +4630,11 @@ class DropboxToInstagramUploader:
                 has_manage_pages = any(p.get("permission") == "manage_pages" and p.get("status") == "granted" for p in permissions)
                 has_pages_show_list = any(p.get("permission") == "pages_show_list" and p.get("status") == "granted" for p in permissions)
                 
-                self.log_console_only("📊 Permission Analysis:", level=logging.INFO)
-                self.log_console_only(f"   🎥 publish_video: {'✅' if has_publish_video else '❌'}", level=logging.INFO)
-                self.log_console_only(f"   📝 publish_actions: {'✅' if has_publish_actions else '❌'}", level=logging.INFO)
-                self.log_console_only(f"   ⚙️ manage_pages: {'✅' if has_manage_pages else '❌'}", level=logging.INFO)
-                self.log_console_only(f"   📋 pages_show_list: {'✅' if has_pages_show_list else '❌'}", level=logging.INFO)
+                self.log_console_only("📊 Permission Analysis:", level=logging.INFO, subsystem="graph")
+                self.log_console_only("   🎥 publish_video: %s", '✅' if has_publish_video else '❌', level=logging.INFO, subsystem="graph")
+                self.log_console_only("   📝 publish_actions: %s", '✅' if has_publish_actions else '❌', level=logging.INFO, subsystem="graph")
+                self.log_console_only("   ⚙️ manage_pages: %s", '✅' if has_manage_pages else '❌', level=logging.INFO, subsystem="graph")
+                self.log_console_only("   📋 pages_show_list: %s", '✅' if has_pages_show_list else '❌', level=logging.INFO, subsystem="graph")
                 
                 if not has_publish_video:
                     self.send_message("⚠️ Missing 'publish_video' permission! This is required for video uploads.", level=logging.WARNING)
@@ -820,7 +4645,7 @@ class DropboxToInstagramUploader:
                 
                 # For Facebook video uploads, we need publish_video
                 if has_publish_video and has_publish_actions:
-                    self.log_console_only("✅ Page has all required permissions for video publishing!", level=logging.INFO)
+                    self.log_console_only("✅ Page has all required permissions for video publishing!", level=logging.INFO, subsystem="graph")
                     return True
                 else:
                     self.send_message("❌ Page missing required permissions for video publishing", level=logging.ERROR)
@@ -828,10 +4653,10 @@ class DropboxToInstagramUploader:
             else:
                 error_response = res.text
                 self.send_message(f"❌ Failed to check permissions: {res.status_code}", level=logging.ERROR)
-                self.log_console_only(f"📄 Error response: {error_response}", level=logging.INFO)
+                self.log_console_only("📄 Error response: %s", error_response, level=logging.INFO, subsystem="graph")
                 
                 # If permission check fails, let's try a different approach
-                self.log_console_only("🔄 Trying alternative permission check...", level=logging.INFO)
+                self.log_console_only("🔄 Trying alternative permission check...", level=logging.INFO, subsystem="graph")
                 return self.check_page_permissions_alternative(page_token)
                 
         except Exception as e:
@@ -841,7 +4666,7 @@ class DropboxToInstagramUploader:
     def check_page_permissions_alternative(self, page_token):
         """Alternative method to check page permissions using page info."""
         try:
-            self.log_console_only("🔍 Alternative permission check using page info...", level=logging.INFO)
+            self.log_console_only("🔍 Alternative permission check using page info...", level=logging.INFO, subsystem="graph")
             
             # Try to get page info and check if it has video publishing capabilities
             url = f"https://graph.facebook.com/v18.0/{self.fb_page_id}"
@@ -850,7 +4675,7 @@ class DropboxToInstagramUploader:
                 "access_token": page_token
             }
             
-            self.log_console_only(f"📡 Alternative check URL: {url}", level=logging.INFO)
+            self.log_console_only("📡 Alternative check URL: %s", url, level=logging.INFO, subsystem="graph")
             
             res = self.session.get(url, params=params)
             if res.status_code == 200:
@@ -858,13 +4683,13 @@ class DropboxToInstagramUploader:
                 page_name = page_info.get("name", "Unknown")
                 page_category = page_info.get("category", "Unknown")
                 
-                self.log_console_only(f"✅ Alternative check successful!", level=logging.INFO)
-                self.log_console_only(f"📄 Page Name: {page_name}", level=logging.INFO)
-                self.log_console_only(f"📄 Page Category: {page_category}", level=logging.INFO)
+                self.log_console_only("✅ Alternative check successful!", level=logging.INFO, subsystem="graph")
+                self.log_console_only("📄 Page Name: %s", page_name, level=logging.INFO, subsystem="graph")
+                self.log_console_only("📄 Page Category: %s", page_category, level=logging.INFO, subsystem="graph")
                 
                 # Since we can access the page info, the token has basic permissions
                 # Let's assume it can publish videos (we'll find out when we try)
-                self.log_console_only("✅ Assuming page has video publishing permissions (will test during upload)", level=logging.INFO)
+                self.log_console_only("✅ Assuming page has video publishing permissions (will test during upload)", level=logging.INFO, subsystem="graph")
                 return True
             else:
                 self.send_message(f"❌ Alternative check also failed: {res.status_code}", level=logging.ERROR)
@@ -877,7 +4702,7 @@ class DropboxToInstagramUploader:
     def refresh_page_access_token(self, page_token):
         """Refresh the page access token if it's expired."""
         try:
-            self.log_console_only("🔄 Refreshing page access token...", level=logging.INFO)
+            self.log_console_only("🔄 Refreshing page access token...", level=logging.INFO, subsystem="graph")
             url = f"https://graph.facebook.com/v18.0/oauth/access_token"
             params = {
                 "grant_type": "fb_exchange_token",
@@ -902,7 +4727,7 @@ class DropboxToInstagramUploader:
     def list_available_pages(self):
         """List all available pages for the user to help with configuration."""
         try:
-            self.log_console_only("🔍 Listing all available pages for configuration...", level=logging.INFO)
+            self.log_console_only("🔍 Listing all available pages for configuration...", level=logging.INFO, subsystem="graph")
             url = f"https://graph.facebook.com/v18.0/me/accounts"
             params = {"access_token": self.meta_token}
             
@@ -912,7 +4737,7 @@ class DropboxToInstagramUploader:
                 return
 
             pages = res.json().get("data", [])
-            self.log_console_only(f"📋 Found {len(pages)} pages:", level=logging.INFO)
+            self.log_console_only("📋 Found %s pages:", len(pages), level=logging.INFO, subsystem="graph")
             
             for i, page in enumerate(pages):
                 page_id = page.get("id", "Unknown")
@@ -920,19 +4745,19 @@ class DropboxToInstagramUploader:
                 category = page.get("category", "Unknown")
                 tasks = page.get("tasks", [])
                 
-                self.log_console_only(f"📄 Page {i+1}:", level=logging.INFO)
-                self.log_console_only(f"   📝 Name: {page_name}", level=logging.INFO)
-                self.log_console_only(f"   🆔 ID: {page_id}", level=logging.INFO)
-                self.log_console_only(f"   📂 Category: {category}", level=logging.INFO)
-                self.log_console_only(f"   🔧 Tasks: {', '.join(tasks)}", level=logging.INFO)
+                self.log_console_only("📄 Page %s:", i + 1, level=logging.INFO, subsystem="graph")
+                self.log_console_only("   📝 Name: %s", page_name, level=logging.INFO, subsystem="graph")
+                self.log_console_only("   🆔 ID: %s", page_id, level=logging.INFO, subsystem="graph")
+                self.log_console_only("   📂 Category: %s", category, level=logging.INFO, subsystem="graph")
+                self.log_console_only("   🔧 Tasks: %s", ', '.join(tasks), level=logging.INFO, subsystem="graph")
                 
                 # Check if this matches current configuration
                 if page_id == self.fb_page_id:
-                    self.log_console_only(f"   ✅ CURRENTLY CONFIGURED", level=logging.INFO)
+                    self.log_console_only("   ✅ CURRENTLY CONFIGURED", level=logging.INFO, subsystem="graph")
                 else:
-                    self.log_console_only(f"   ⚙️ To use this page, set FB_PAGE_ID={page_id}", level=logging.INFO)
+                    self.log_console_only("   ⚙️ To use this page, set FB_PAGE_ID=%s", page_id, level=logging.INFO, subsystem="graph")
             
-            self.log_console_only("💡 Copy the ID of the page you want to use and set it as FB_PAGE_ID environment variable.", level=logging.INFO)
+            self.log_console_only("💡 Copy the ID of the page you want to use and set it as FB_PAGE_ID environment variable.", level=logging.INFO, subsystem="graph")
             
         except Exception as e:
             self.send_message(f"❌ Exception listing pages: {e}", level=logging.ERROR)
@@ -966,7 +4791,6 @@ class DropboxToInstagramUploader:
                 
                 if page_token:
                     self.send_message("✅ Page access token obtained successfully!")
-                    self.send_message(f"🔐 Page token starts with: {page_token[:20]}...", level=logging.INFO)
                     return page_token
                 else:
                     self.send_message("❌ No access_token in response", level=logging.ERROR)
@@ -983,7 +4807,7 @@ class DropboxToInstagramUploader:
     def check_instagram_page_connection(self, page_token):
         """Check if Instagram account is properly connected to the Facebook page."""
         try:
-            self.log_console_only("🔍 Checking Instagram-Facebook page connection...", level=logging.INFO)
+            self.log_console_only("🔍 Checking Instagram-Facebook page connection...", level=logging.INFO, subsystem="graph")
             
             # Check if the page has Instagram account connected
             url = f"https://graph.facebook.com/v18.0/{self.fb_page_id}"
@@ -992,7 +4816,7 @@ class DropboxToInstagramUploader:
                 "access_token": page_token
             }
             
-            self.log_console_only(f"📡 Checking page Instagram connection: {url}", level=logging.INFO)
+            self.log_console_only("📡 Checking page Instagram connection: %s", url, level=logging.INFO, subsystem="graph")
             
             res = self.session.get(url, params=params)
             if res.status_code == 200:
@@ -1006,7 +4830,7 @@ class DropboxToInstagramUploader:
                     
                     # Verify this matches our configured IG_ID
                     if instagram_id == self.ig_id:
-                        self.log_console_only("✅ Instagram ID matches configured IG_ID", level=logging.INFO)
+                        self.log_console_only("✅ Instagram ID matches configured IG_ID", level=logging.INFO, subsystem="graph")
                         return True
                     else:
                         self.send_message(f"⚠️ Instagram ID mismatch! Configured: {self.ig_id}, Connected: {instagram_id}", level=logging.WARNING)
@@ -1029,7 +4853,7 @@ class DropboxToInstagramUploader:
     def test_page_token(self, page_token):
         """Test the page access token by making a simple API call."""
         try:
-            self.log_console_only("🧪 Testing page access token...", level=logging.INFO)
+            self.log_console_only("🧪 Testing page access token...", level=logging.INFO, subsystem="graph")
             
             # Test the token by getting page info
             url = f"https://graph.facebook.com/v18.0/me"
@@ -1038,14 +4862,14 @@ class DropboxToInstagramUploader:
                 "access_token": page_token
             }
             
-            self.log_console_only(f"📡 Testing token with: {url}", level=logging.INFO)
+            self.log_console_only("📡 Testing token with: %s", url, level=logging.INFO, subsystem="graph")
             
             start_time = time.time()
             res = self.session.get(url, params=params)
             request_time = time.time() - start_time
             
-            self.log_console_only(f"⏱️ Token test completed in {request_time:.2f} seconds", level=logging.INFO)
-            self.log_console_only(f"📊 Test response status: {res.status_code}", level=logging.INFO)
+            self.log_console_only("⏱️ Token test completed in %.2f seconds", request_time, level=logging.INFO, subsystem="graph")
+            self.log_console_only("📊 Test response status: %s", res.status_code, level=logging.INFO, subsystem="graph")
             
             if res.status_code == 200:
                 page_info = res.json()
@@ -1053,14 +4877,14 @@ class DropboxToInstagramUploader:
                 page_name = page_info.get("name", "Unknown")
                 page_category = page_info.get("category", "Unknown")
                 
-                self.log_console_only(f"✅ Page token test successful!", level=logging.INFO)
-                self.log_console_only(f"📄 Page ID: {page_id}", level=logging.INFO)
-                self.log_console_only(f"📄 Page Name: {page_name}", level=logging.INFO)
-                self.log_console_only(f"📄 Page Category: {page_category}", level=logging.INFO)
+                self.log_console_only("✅ Page token test successful!", level=logging.INFO, subsystem="graph")
+                self.log_console_only("📄 Page ID: %s", page_id, level=logging.INFO, subsystem="graph")
+                self.log_console_only("📄 Page Name: %s", page_name, level=logging.INFO, subsystem="graph")
+                self.log_console_only("📄 Page Category: %s", page_category, level=logging.INFO, subsystem="graph")
                 
                 # Verify this matches our expected page
                 if page_id == self.fb_page_id:
-                    self.log_console_only("✅ Page ID matches expected page!", level=logging.INFO)
+                    self.log_console_only("✅ Page ID matches expected page!", level=logging.INFO, subsystem="graph")
                     return True
                 else:
                     self.send_message(f"⚠️ Page ID mismatch! Expected: {self.fb_page_id}, Got: {page_id}", level=logging.WARNING)
@@ -1121,100 +4945,67 @@ class DropboxToInstagramUploader:
             return False
 
     def verify_instagram_post_by_media_id(self, media_id, page_token):
-        """Verify Instagram post is live by polling the published media_id."""
-        try:
-            self.send_message("🔍 Verifying Instagram post is live...", level=logging.INFO)
-            
-            # Poll the media_id to get post details
-            url = f"{self.INSTAGRAM_API_BASE}/{media_id}"
-            params = {
-                "fields": "id,permalink_url,media_type,media_url,thumbnail_url,created_time",
-                "access_token": page_token
-            }
-            
-            self.log_console_only(f"📡 Verification URL: {url}", level=logging.INFO)
-            
-            # Try up to 10 times with 5-second intervals (increased from 5 attempts, 3 seconds)
-            for attempt in range(10):
-                self.log_console_only(f"🔄 Verification attempt {attempt + 1}/10", level=logging.INFO)
-                
-                res = self.session.get(url, params=params)
-                if res.status_code == 200:
-                    post_data = res.json()
-                    post_id = post_data.get("id", "Unknown")
-                    permalink = post_data.get("permalink_url", "Not available")
-                    media_type = post_data.get("media_type", "Unknown")
-                    created_time = post_data.get("created_time", "Unknown")
-                    
-                    self.send_message(f"✅ Instagram post verified as live!", level=logging.INFO)
-                    self.log_console_only(f"📸 Post ID: {post_id}", level=logging.INFO)
-                    self.log_console_only(f"🔗 Permalink: {permalink}", level=logging.INFO)
-                    self.log_console_only(f"📂 Media Type: {media_type}", level=logging.INFO)
-                    self.log_console_only(f"⏰ Created: {created_time}", level=logging.INFO)
-                    return True
-                elif res.status_code == 400:
-                    self.send_message("⚠️ Permanent error on verification (400 Bad Request), stopping early.", level=logging.WARNING)
-                    self.log_console_only(f"❌ Unrecoverable error on attempt {attempt + 1}: {res.status_code}", level=logging.INFO)
-                    break
-                else:
-                    self.log_console_only(f"❌ Verification failed (attempt {attempt + 1}): {res.status_code}", level=logging.INFO)
-                    if attempt < 9:  # Don't sleep on last attempt
-                        time.sleep(5)  # Increased from 3 seconds
-            
-            self.send_message("⚠️ Could not verify Instagram post is live after 10 attempts", level=logging.WARNING)
-            return False
-            
-        except Exception as e:
-            self.send_message(f"❌ Exception verifying Instagram post: {e}", level=logging.ERROR)
-            return False
+        """Queue a published IG media ID for the verification sweep; the result is reported when it resolves.
+
+        Returns the sweep's Future (fields dict, or None if the post never became readable).
+        """
+        self.log_console_only("🔍 Queued Instagram post %s for verification", media_id, level=logging.INFO, subsystem="graph")
+        future = self.verifier.submit(self.INSTAGRAM_API_BASE, media_id, self.VERIFY_IG_FIELDS, page_token)
+        future.add_done_callback(lambda f: self.report_instagram_verification(media_id, f.result()))
+        return future
+
+    def report_instagram_verification(self, media_id, post_data):
+        if not post_data:
+            self.send_message(f"⚠️ Could not verify Instagram post {media_id} is live", level=logging.WARNING)
+            return
+        self.send_message(f"✅ Instagram post verified as live!\n🔗 Permalink: {post_data.get('permalink', 'Not available')}", level=logging.INFO)
+        self.log_console_only("📸 Post ID: %s", post_data.get("id", "Unknown"), level=logging.INFO, subsystem="graph")
+        self.log_console_only("📂 Media Type: %s", post_data.get("media_type", "Unknown"), level=logging.INFO, subsystem="graph")
+        self.log_console_only("⏰ Created: %s", post_data.get("timestamp", "Unknown"), level=logging.INFO, subsystem="graph")
 
     def verify_facebook_post_by_video_id(self, video_id, page_token):
-        """Verify Facebook video post is live by polling the video_id."""
-        try:
-            self.send_message("🔍 Verifying Facebook video post is live...", level=logging.INFO)
-            
-            # Poll the video_id to get post details
-            url = f"https://graph.facebook.com/{video_id}"
-            params = {
-                "fields": "id,permalink_url,created_time,length,title,description",
-                "access_token": page_token
-            }
-            
-            self.log_console_only(f"📡 Verification URL: {url}", level=logging.INFO)
-            
-            # Try up to 10 times with 5-second intervals (increased from 5 attempts, 3 seconds)
-            for attempt in range(10):
-                self.log_console_only(f"🔄 Verification attempt {attempt + 1}/10", level=logging.INFO)
-                
-                res = self.session.get(url, params=params)
-                if res.status_code == 200:
-                    post_data = res.json()
-                    fb_video_id = post_data.get("id", "Unknown")
-                    permalink = post_data.get("permalink_url", "Not available")
-                    created_time = post_data.get("created_time", "Unknown")
-                    length = post_data.get("length", "Unknown")
-                    
-                    self.send_message(f"✅ Facebook video post verified as live!", level=logging.INFO)
-                    self.log_console_only(f"📘 Video ID: {fb_video_id}", level=logging.INFO)
-                    self.log_console_only(f"🔗 Permalink: {permalink}", level=logging.INFO)
-                    self.log_console_only(f"⏰ Created: {created_time}", level=logging.INFO)
-                    self.log_console_only(f"⏱️ Length: {length} seconds", level=logging.INFO)
-                    return True
-                elif res.status_code == 400:
-                    self.send_message("⚠️ Permanent error on Facebook verification (400 Bad Request), stopping early.", level=logging.WARNING)
-                    self.log_console_only(f"❌ Unrecoverable error on attempt {attempt + 1}: {res.status_code}", level=logging.INFO)
-                    break
-                else:
-                    self.log_console_only(f"❌ Verification failed (attempt {attempt + 1}): {res.status_code}", level=logging.INFO)
-                    if attempt < 9:  # Don't sleep on last attempt
-                        time.sleep(5)  # Increased from 3 seconds
-            
-            self.send_message("⚠️ Could not verify Facebook video post is live after 10 attempts", level=logging.WARNING)
-            return False
-            
-        except Exception as e:
-            self.send_message(f"❌ Exception verifying Facebook video post: {e}", level=logging.ERROR)
-            return False
+        """Queue a published Facebook video ID for the verification sweep; see verify_instagram_post_by_media_id."""
+        self.log_console_only("🔍 Queued Facebook video %s for verification", video_id, level=logging.INFO, subsystem="graph")
+        future = self.verifier.submit("https://graph.facebook.com", video_id, self.VERIFY_FB_FIELDS, page_token)
+        future.add_done_callback(lambda f: self.report_facebook_verification(video_id, f.result()))
+        return future
+
+    def report_facebook_verification(self, video_id, post_data):
+        if not post_data:
+            self.send_message(f"⚠️ Could not verify Facebook video post {video_id} is live", level=logging.WARNING)
+            return
+        self.send_message("✅ Facebook video post verified as live!", level=logging.INFO)
+        self.log_console_only("📘 Video ID: %s", post_data.get("id", "Unknown"), level=logging.INFO, subsystem="graph")
+        self.log_console_only("🔗 Permalink: %s", post_data.get("permalink_url", "Not available"), level=logging.INFO, subsystem="graph")
+        self.log_console_only("⏰ Created: %s", post_data.get("created_time", "Unknown"), level=logging.INFO, subsystem="graph")
+        self.log_console_only("⏱️ Length: %s seconds", post_data.get("length", "Unknown"), level=logging.INFO, subsystem="graph")
 
 if __name__ == "__main__":
-    DropboxToInstagramUploader().run()
+    import argparse
+    parser = argparse.ArgumentParser(description="Post the next inbox media file to Instagram and the Facebook Page.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running, post at every slot in scheduler/config.json and serve live metrics")
+    parser.add_argument("--stage", action="store_true",
+                        help="create and process IG containers for the upcoming slots; slot runs then only publish them")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="replay the whole run from a recorded HTTP cassette instead of calling real services")
+    parser.add_argument("--record", action="store_true",
+                        help="run for real and record every HTTP interaction (tokens redacted) to the cassette")
+    parser.add_argument("--cassette", help="cassette file (default: CASSETTE_PATH or .cache/cassette.json)")
+    parser.add_argument("--speed", type=float,
+                        help="replay timing: 0 skips recorded latencies and waits, 1 reproduces them")
+    args = parser.parse_args()
+    if args.dry_run or args.record:
+        os.environ["CASSETTE_MODE"] = "replay" if args.dry_run else "record"
+    if args.cassette:
+        os.environ["CASSETTE_PATH"] = args.cassette
+    if args.speed is not None:
+        os.environ["CASSETTE_SPEED"] = str(args.speed)
+    configure_logging()
+    uploader = DropboxToInstagramUploader()
+    if args.daemon:
+        uploader.run_daemon()
+    elif args.stage:
+        uploader.run_staging()
+    else:
+        uploader.run()